@@ -0,0 +1,161 @@
+#!/usr/bin/python3
+
+# Copyright (c) 2017-2021, Virtuozzo International GmbH
+#
+# Our contact details: Virtuozzo International GmbH, Vordergasse 59, 8200
+# Schaffhausen, Switzerland.
+
+# Archives of the finished runs: a zstd-compressed tar file per run with the
+# logs of the packages, the *.list files and the timing spans of the run.
+#
+# Every member of the tar is compressed as a separate zstd frame and the
+# index of the members (their offsets and sizes in the archive) is appended
+# in a skippable frame, so a single log can be read without decompressing
+# the whole archive, while the archive is still a valid .tar.zst for the
+# usual tools:
+#       zstd -dc <archive> | tar t
+#
+# The python 'zstandard' module is used if available, 'zstd' command
+# otherwise.
+#
+# Usage:
+#       python3 archive.py <archive> [<member> ...]
+# lists the members of the archive or prints the given ones.
+
+import argparse
+import io
+import json
+import os
+import shutil
+import struct
+import subprocess
+import sys
+import tarfile
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Compression level of the archives
+LEVEL = 10
+
+# The index is stored in a skippable frame (ignored by decompressors) ending
+# with the length of the index and INDEX_MAGIC
+SKIPPABLE_MAGIC = 0x184D2A50
+INDEX_MAGIC = b'VZAI'
+
+# The end of a tar file: two zero blocks
+TAR_END = b'\0' * 2 * tarfile.BLOCKSIZE
+
+
+class Error(Exception):
+    pass
+
+
+def available():
+    '''Check if the archives can be written and read.'''
+    return zstandard is not None or shutil.which('zstd') is not None
+
+
+def compress(data):
+    if zstandard is not None:
+        return zstandard.ZstdCompressor(level=LEVEL).compress(data)
+    return subprocess.run(['zstd', '-q', '-c', '-%d' % LEVEL], input=data,
+                          stdout=subprocess.PIPE, check=True).stdout
+
+
+def decompress(data):
+    if zstandard is not None:
+        return zstandard.ZstdDecompressor().decompress(data)
+    return subprocess.run(['zstd', '-q', '-d', '-c'], input=data,
+                          stdout=subprocess.PIPE, check=True).stdout
+
+
+def tar_member(name, path):
+    '''Returns the tar header and the padded contents of the file.'''
+    with open(path, 'rb') as f:
+        data = f.read()
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    info.mtime = os.path.getmtime(path)
+    info.mode = 0o644
+    padding = (tarfile.BLOCKSIZE - len(data) % tarfile.BLOCKSIZE) % tarfile.BLOCKSIZE
+    return info.tobuf(format=tarfile.PAX_FORMAT) + data + b'\0' * padding
+
+
+def write(path, members, meta=None):
+    '''Write the archive of the given files.
+
+    'members' - list of (name in the archive, path to the file) pairs, the
+    missing files are skipped.
+    'meta' - dict of other data to store in the index, e.g. the target.
+
+    Returns the index of the archive, see read_index().
+    '''
+    index = {'members': {}}
+    index.update(meta or {})
+    with open(path + '.part', 'wb') as out:
+        for (name, src) in members:
+            if not os.path.isfile(src):
+                continue
+            data = tar_member(name, src)
+            frame = compress(data)
+            index['members'][name] = [out.tell(), len(frame), os.path.getsize(src)]
+            out.write(frame)
+        out.write(compress(TAR_END))
+        data = json.dumps(index, sort_keys=True).encode()
+        trailer = data + struct.pack('<I', len(data)) + INDEX_MAGIC
+        out.write(struct.pack('<II', SKIPPABLE_MAGIC, len(trailer)) + trailer)
+    os.rename(path + '.part', path)
+    return index
+
+
+def read_index(path):
+    '''Returns the index of the archive: a dict with the data given to
+    write() and 'members' mapping the names of the members to [offset of
+    their frame, size of the frame, size of the file].'''
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        end = f.tell()
+        if end < 8:
+            raise Error('%s is not an indexed archive' % path)
+        f.seek(end - 8)
+        (length, magic) = struct.unpack('<I4s', f.read(8))
+        if magic != INDEX_MAGIC or length > end - 8:
+            raise Error('%s is not an indexed archive' % path)
+        f.seek(end - 8 - length)
+        return json.loads(f.read(length).decode())
+
+
+def read_member(path, name, index=None):
+    '''Returns the contents of the member of the archive as bytes.'''
+    if index is None:
+        index = read_index(path)
+    if name not in index['members']:
+        raise Error('%s has no member %s' % (path, name))
+    (offset, size, _) = index['members'][name]
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        data = decompress(f.read(size))
+    with tarfile.open(fileobj=io.BytesIO(data + TAR_END), mode='r:') as tar:
+        return tar.extractfile(tar.next()).read()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Show the archive of a test run")
+    parser.add_argument('archive', action='store')
+    parser.add_argument('member', action='store', nargs='*',
+                               help='Print the member with given name')
+    cmdline = parser.parse_args(sys.argv[1:])
+
+    try:
+        index = read_index(cmdline.archive)
+        if not cmdline.member:
+            for (name, (offset, size, orig)) in sorted(index['members'].items()):
+                print('%10d %10d  %s' % (orig, size, name))
+        for name in cmdline.member:
+            sys.stdout.buffer.write(read_member(cmdline.archive, name, index))
+    except (OSError, Error) as e:
+        print(str(e))
+        sys.exit(1)
@@ -0,0 +1,477 @@
+#!/usr/bin/python3
+
+# Copyright (c) 2017-2021, Virtuozzo International GmbH
+#
+# Our contact details: Virtuozzo International GmbH, Vordergasse 59, 8200
+# Schaffhausen, Switzerland.
+
+# Benchmark of the overhead of the test harness itself: launcher.py with
+# check_apps_in_chroot.py and check_services_in_vm.py, run on synthetic
+# packages on any Linux box, without real repositories, chroots, X servers
+# or services.
+#
+# Fake mock, chroot, sudo, mount, rpm, yum, systemctl, journalctl, Xvfb,
+# xauth and xwininfo are put first in PATH. Each of them sleeps for the
+# latency given in the environment (BENCH_<TOOL>_LATENCY, in seconds) and
+# keeps its state in the sandbox directory: yum "installs" a synthetic
+# package by copying its files to the root of the fake chroot, systemctl
+# "starts" a unit by creating a file. The applications from the synthetic
+# .desktop files are a fake app that shows a "window" (seen by the fake
+# xwininfo), crashes or exits, depending on the package.
+#
+# The launcher is imported and its app and service test runners are called
+# with its paths pointed to the sandbox, for every combination of list
+# size and parallelism given. The report shows wall time, per-package time,
+# throughput and the harness overhead per package, i.e. the time not spent
+# in the simulated latencies, along with the slowest phases of the run
+# (see timing.py).
+#
+# Usage:
+#       python3 bench_harness.py [options]
+# e.g.
+#       python3 bench_harness.py --mode apps --sizes 4,16 --jobs 1,4 --desktop 2
+#
+# A Python 2 interpreter with psutil is needed for the checkers, see
+# --python2.
+
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import launcher
+import resultstore
+import timing
+
+# Fake tools, they get the sandbox in BENCH_STATE. The root of the fake
+# chroot (or VM) a command works in is AUTOTEST_ROOT, it is set by the fake
+# chroot and by the benchmark itself for the services.
+FAKES = {
+'sudo': '''#!/bin/sh
+case "$*" in
+*core_pattern*) exit 0;;
+esac
+exec "$@"
+''',
+
+'chroot': '''#!/bin/sh
+root=$(cd "$1" && pwd); shift
+cd "$root" && AUTOTEST_ROOT="$root" exec "$@"
+''',
+
+'python': '''#!/bin/sh
+exec "$BENCH_PYTHON2" "$@"
+''',
+
+'mock': '''#!/bin/sh
+sleep ${BENCH_MOCK_LATENCY:-0}
+echo "mock $*" >> "$BENCH_STATE/sleeps.mock"
+name=
+for arg in "$@"; do
+    case "$arg" in
+    -r) next=config;;
+    --uniqueext=*) uniqueext=-${arg#--uniqueext=};;
+    --init) action=init;;
+    *) [ "$next" = config ] && config=$arg; next=;;
+    esac
+done
+if [ "$action" = init ]; then
+    root="$BENCH_MOCK_DIR/$config$uniqueext/root"
+    mkdir -p "$root/tmp" "$root/root" "$root/var/lib/bench"
+    : > "$root/var/lib/bench/installed"
+fi
+exit 0
+''',
+
+'mount': '''#!/bin/sh
+sleep ${BENCH_MOUNT_LATENCY:-0}
+echo "mount $*" >> "$BENCH_STATE/sleeps.mount"
+''',
+
+'rpm': '''#!/bin/sh
+db="$AUTOTEST_ROOT/var/lib/bench/installed"
+sleep ${BENCH_RPM_LATENCY:-0}
+echo "rpm $*" >> "$BENCH_STATE/sleeps.rpm"
+[ "$1" = -q ] || exit 1
+case "$2" in
+-a) cat "$db";;
+-l) if grep -qx "$3" "$db"; then cat "$BENCH_STATE/repo/$3.files"
+    else echo "package $3 is not installed"; exit 1; fi;;
+--quiet) grep -qx "$3" "$db";;
+*) grep -qx "$2" "$db" || exit 1; echo "$2";;
+esac
+''',
+
+'yum': '''#!/bin/sh
+db="$AUTOTEST_ROOT/var/lib/bench/installed"
+action=$1; shift
+pkgs=
+for arg in "$@"; do
+    case "$arg" in
+    -*) ;;
+    *) pkgs="$pkgs $arg";;
+    esac
+done
+for pkg in $pkgs; do
+    sleep ${BENCH_YUM_PKG_LATENCY:-0}
+    echo "yum-pkg $action $pkg" >> "$BENCH_STATE/sleeps.yum_pkg"
+done
+sleep ${BENCH_YUM_LATENCY:-0}
+echo "yum $action$pkgs" >> "$BENCH_STATE/sleeps.yum"
+case "$action" in
+install)
+    for pkg in $pkgs; do
+        if [ -e "$BENCH_STATE/repo/$pkg.fail-install" ]; then
+            echo "Error: failed to install $pkg"; exit 1
+        fi
+    done
+    for pkg in $pkgs; do
+        cp -R "$BENCH_STATE/repo/$pkg/." "$AUTOTEST_ROOT/"
+        echo "$pkg" >> "$db"
+    done;;
+remove)
+    for pkg in $pkgs; do
+        sed "s,^\\(/.*\\),$AUTOTEST_ROOT\\1," "$BENCH_STATE/repo/$pkg.files" | xargs rm -f
+        grep -vx "$pkg" "$db" > "$db.new"; mv "$db.new" "$db"
+    done;;
+esac
+exit 0
+''',
+
+'systemctl': '''#!/bin/sh
+active="$AUTOTEST_ROOT/var/lib/bench/active"
+mkdir -p "$active"
+units=
+props=
+for arg in "$@"; do
+    case "$arg" in
+    --property=*) props="$props ${arg#--property=}";;
+    -*) ;;
+    *) [ -z "$action" ] && action=$arg || units="$units $arg";;
+    esac
+done
+unit=${units# }
+case "$action" in
+show)
+    sep=
+    for unit in $units; do
+        printf "$sep"; sep='\\n'
+        for prop in $(echo $props | tr , ' '); do
+            if [ $prop = ActiveState ]; then
+                if [ -e "$active/$unit" ]; then echo ActiveState=active
+                elif [ -e "$active/$unit.failed" ]; then echo ActiveState=failed
+                else echo ActiveState=inactive; fi
+            else
+                echo "$prop=$(sed -n "s/^$prop=//p" "$AUTOTEST_ROOT/usr/lib/systemd/system/$unit")"
+            fi
+        done
+    done;;
+start)
+    sleep ${BENCH_SYSTEMCTL_LATENCY:-0}
+    echo "systemctl start $unit" >> "$BENCH_STATE/sleeps.systemctl"
+    case "$unit" in
+    *fail*) touch "$active/$unit.failed"; exit 1;;
+    esac
+    touch "$active/$unit";;
+stop)
+    sleep ${BENCH_SYSTEMCTL_LATENCY:-0}
+    echo "systemctl stop $unit" >> "$BENCH_STATE/sleeps.systemctl"
+    rm -f "$active/$unit";;
+status)
+    echo "$unit - fake unit";;
+esac
+exit 0
+''',
+
+'journalctl': '''#!/bin/sh
+case "$*" in
+*--show-cursor*) echo "-- cursor: s=bench;i=1";;
+*) echo "-- No entries --";;
+esac
+''',
+
+'xauth': '''#!/bin/sh
+exit 0
+''',
+
+'Xvfb': '''#!/bin/sh
+socket=/tmp/.X11-unix/X${1#:}
+mkdir -p /tmp/.X11-unix
+trap 'rm -f $socket; exit 0' TERM INT
+sleep ${BENCH_XVFB_LATENCY:-0}
+echo "Xvfb $1" >> "$BENCH_STATE/sleeps.xvfb"
+touch $socket
+while :; do sleep 3600 & wait $!; done
+''',
+
+'xwininfo': '''#!/bin/sh
+display=${2#:}
+case "$3" in
+-root)
+    for win in "$BENCH_STATE"/windows/$display.*; do
+        [ -e "$win" ] && echo "     0x${win##*.} \\"bench\\": ()  640x480+0+0  +0+0"
+    done;;
+-id)
+    echo "  Map State: IsViewable";;
+esac
+exit 0
+''',
+
+# The application: 'bench-app <kind> <id>', kind is 'ok', 'crash' or 'exit'
+'bench-app': '''#!/bin/sh
+sleep ${BENCH_APP_LATENCY:-0}
+echo "app $*" >> "$BENCH_STATE/sleeps.app"
+case "$1" in
+crash) kill -SEGV $$;;
+exit) exit 1;;
+esac
+win="$BENCH_STATE/windows/${DISPLAY#:}.$$"
+trap 'rm -f "$win"; kill $! 2>/dev/null; exit 0' TERM INT
+touch "$win"
+while :; do sleep 3600 & wait $!; done
+''',
+}
+FAKES['umount'] = FAKES['mount'].replace('mount', 'umount')
+
+# Latencies of the fake tools, see --latency
+LATENCIES = ['mock', 'mount', 'rpm', 'yum', 'yum_pkg', 'systemctl', 'xvfb', 'app']
+
+DESKTOP_ENTRY = '''[Desktop Entry]
+Type=Application
+Name=%(name)s
+Exec=bench-app %(kind)s %(name)s %%U
+'''
+
+UNIT = '''[Unit]
+Description=%(name)s
+After=%(after)s
+
+[Service]
+ExecStart=/bin/true
+'''
+
+
+def make_sandbox(path, python2):
+    '''Create the sandbox with the fake tools in 'path'/bin.'''
+    os.makedirs(os.path.join(path, 'bin'))
+    for (name, script) in FAKES.items():
+        fake = os.path.join(path, 'bin', name)
+        with open(fake, 'w') as f:
+            f.write(script)
+        os.chmod(fake, 0o755)
+    os.makedirs(os.path.join(path, 'repo'))
+    os.makedirs(os.path.join(path, 'windows'))
+    os.environ['PATH'] = os.path.join(path, 'bin') + ':' + os.environ['PATH']
+    os.environ['BENCH_STATE'] = path
+    os.environ['BENCH_MOCK_DIR'] = os.path.join(path, 'mock')
+    os.environ['BENCH_PYTHON2'] = python2
+
+
+def make_packages(sandbox, count, mode, nfiles, options, rnd):
+    '''Create synthetic packages with 'nfiles' .desktop or .service files.
+
+    Returns (names of the packages, dict mapping them to their files).
+    '''
+    pkgs = []
+    files = {}
+    for i in range(count):
+        pkg = 'bench-%s-%d' % (mode, i)
+        root = os.path.join(sandbox, 'repo', pkg)
+        kind = 'ok'
+        if rnd.random() < options.crash_rate:
+            kind = 'crash'
+        if rnd.random() < options.fail_install_rate:
+            open(root + '.fail-install', 'w').close()
+        files[pkg] = []
+        for j in range(nfiles):
+            name = '%s-%d' % (pkg, j)
+            if mode == 'apps':
+                path = '/usr/share/applications/%s.desktop' % name
+                content = DESKTOP_ENTRY % {'name': name, 'kind': kind}
+            else:
+                if kind == 'crash':
+                    name += '-fail'
+                path = '/usr/lib/systemd/system/%s.service' % name
+                # Every third unit is ordered after the previous one
+                after = ''
+                if j % 3 == 2:
+                    after = os.path.basename(files[pkg][-1])
+                content = UNIT % {'name': name, 'after': after}
+            os.makedirs(os.path.dirname(root + path), exist_ok=True)
+            with open(root + path, 'w') as f:
+                f.write(content)
+            files[pkg].append(path)
+        with open(root + '.files', 'w') as f:
+            f.write(''.join(path + '\n' for path in files[pkg]))
+        pkgs.append(pkg)
+    return (pkgs, files)
+
+
+def simulated_time(sandbox, latencies):
+    '''Returns the total time the fake tools slept, from their logs.'''
+    total = 0.0
+    for name in LATENCIES:
+        log = os.path.join(sandbox, 'sleeps.' + name)
+        if os.path.exists(log):
+            with open(log, 'r') as f:
+                total += sum(1 for line in f) * latencies[name]
+            os.remove(log)
+    return total
+
+
+def point_launcher(run_dir):
+    '''Point the paths of the launcher to the given directory.'''
+    launcher.MOCK_DIR = os.environ['BENCH_MOCK_DIR'] + '/'
+    launcher.LOG_DIR = os.path.join(run_dir, 'log') + '/'
+    launcher.CACHE_DIR = os.path.join(run_dir, 'cache') + '/'
+    launcher.STATE_DIR = os.path.join(run_dir, 'state') + '/'
+    launcher.SPANS_DIR = launcher.STATE_DIR + 'spans/'
+    launcher.ARCHIVE_DIR = launcher.LOG_DIR + 'archive/'
+    launcher.AUTOTEST_DIR = os.path.dirname(os.path.abspath(__file__)) + '/'
+    launcher.SERVICE_RESULT_DIR = os.path.join(run_dir, 'vm', 'tmp', 'results') + '/'
+    resultstore.DB_PATH = os.path.join(run_dir, 'results.db')
+    for path in [launcher.LOG_DIR, launcher.STATE_DIR,
+                 os.path.join(run_dir, 'vm', 'tmp'),
+                 os.path.join(run_dir, 'vm', 'var', 'lib', 'bench')]:
+        os.makedirs(path)
+    open(os.path.join(run_dir, 'vm', 'var', 'lib', 'bench', 'installed'), 'w').close()
+    launcher.spans = timing.Recorder()
+    # The fake chroots get no cgroups, the host ones are not touched
+    launcher.cgroup2_root = lambda: None
+
+
+def run_once(sandbox, mode, pkgs, files, jobs, options):
+    '''Check the packages with the launcher, returns (wall time, simulated
+    time, spans).'''
+    run_dir = tempfile.mkdtemp(prefix='run-', dir=sandbox)
+    shutil.rmtree(os.environ['BENCH_MOCK_DIR'], ignore_errors=True)
+    point_launcher(run_dir)
+    simulated_time(sandbox, options.latencies)
+    args = argparse.Namespace(jobs=jobs, launches=options.launches,
+                              batch=options.batch, snapshot=False,
+                              no_cache=True, cache_size=0, offline=False, journal_dump=False,
+                              nspawn=False, cores=None,
+                              core_limit=launcher.CORE_LIMIT)
+    if not options.index:
+        files = None
+
+    pool = None
+    if options.daemon and mode == 'apps':
+        # The daemon sets up its slots once, so they are warmed up by the
+        # first package before the clock starts
+        pool = launcher.SlotPool(options.target, mode, list(range(jobs)), args)
+        launcher.run_app_tests(options.target, pkgs[:1], args, files, pool=pool)
+        simulated_time(sandbox, options.latencies)
+
+    start = time.time()
+    if mode == 'apps':
+        launcher.run_app_tests(options.target, pkgs, args, files, pool=pool)
+    else:
+        os.environ['AUTOTEST_ROOT'] = os.path.join(run_dir, 'vm')
+        try:
+            launcher.run_service_tests(options.target, pkgs, args, files)
+        finally:
+            del os.environ['AUTOTEST_ROOT']
+    wall = time.time() - start
+    if pool:
+        pool.close()
+    return (wall, simulated_time(sandbox, options.latencies), launcher.spans.spans)
+
+
+def top_phases(spans, count):
+    '''Returns the phases taking most time as a list of (phase, seconds).'''
+    totals = {}
+    for span in spans:
+        totals[span['phase']] = totals.get(span['phase'], 0.0) + span['duration']
+    return sorted(totals.items(), key=lambda item: -item[1])[:count]
+
+
+def parse_latencies(values):
+    latencies = dict((name, 0.0) for name in LATENCIES)
+    for value in values or []:
+        (name, _, seconds) = value.partition('=')
+        if name not in latencies:
+            raise argparse.ArgumentTypeError('unknown tool: %s' % name)
+        latencies[name] = float(seconds)
+    return latencies
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark of the test harness overhead')
+    parser.add_argument('--mode', action='append', choices=['apps', 'services'],
+                               help='What to check (default: both)')
+    parser.add_argument('--target', action='store', default='vzlinux-8')
+    parser.add_argument('--sizes', action='store', default='4,16',
+                               help='Comma-separated numbers of packages to check '\
+                                    '(default: %(default)s)')
+    parser.add_argument('--jobs', action='store', default='1,2',
+                               help='Comma-separated numbers of chroots to check '\
+                                    'applications in (default: %(default)s)')
+    parser.add_argument('--launches', action='store', type=int, default=1,
+                               help='Number of applications of a package to check at once')
+    parser.add_argument('--batch', action='store', type=int, default=1,
+                               help='Number of packages to install in one yum transaction')
+    parser.add_argument('--desktop', action='store', type=int, default=2,
+                               help='Number of .desktop files in a package (default: %(default)s)')
+    parser.add_argument('--units', action='store', type=int, default=2,
+                               help='Number of .service files in a package (default: %(default)s)')
+    parser.add_argument('--crash-rate', action='store', type=float, default=0.0,
+                               help='Fraction of the packages whose applications crash '\
+                                    '(services fail to start)')
+    parser.add_argument('--fail-install-rate', action='store', type=float, default=0.0,
+                               help='Fraction of the packages which fail to install')
+    parser.add_argument('--latency', action='append', metavar='TOOL=SECONDS',
+                               help='Latency of a fake tool, one of: %s. This option can be '\
+                                    'specified more than once (default: 0 for all)' %
+                                    ', '.join(LATENCIES))
+    parser.add_argument('--daemon', action='store_true',
+                               help='Check the applications in the chroots kept set up '\
+                                    'between the runs, as the daemon mode of the launcher does')
+    parser.add_argument('--index', action='store_true',
+                               help='Pass the index of the files of the packages to the checkers')
+    parser.add_argument('--python2', action='store', default='python2',
+                               help='Python 2 interpreter with psutil to run the checkers with '\
+                                    '(default: %(default)s)')
+    parser.add_argument('--seed', action='store', type=int, default=0)
+    parser.add_argument('--keep', action='store_true',
+                               help='Do not remove the sandbox, to look at the logs')
+    cmdline = parser.parse_args(sys.argv[1:])
+    cmdline.latencies = parse_latencies(cmdline.latency)
+    for name in LATENCIES:
+        os.environ['BENCH_%s_LATENCY' % name.upper()] = str(cmdline.latencies[name])
+    sizes = [int(size) for size in cmdline.sizes.split(',')]
+    jobs = [int(n) for n in cmdline.jobs.split(',')]
+
+    # Do not clash with real X servers
+    launcher.DISPLAY_BASE = 500
+
+    sandbox = tempfile.mkdtemp(prefix='vzlinux-autotest-bench-')
+    make_sandbox(sandbox, cmdline.python2)
+    rnd = random.Random(cmdline.seed)
+    print('%-8s %5s %4s %9s %9s %8s %10s  %s' % ('mode', 'pkgs', 'jobs', 'wall, s', 's/pkg',
+                                                'pkg/min', 'overhead', 'top phases, s'))
+    try:
+        for mode in cmdline.mode or ['apps', 'services']:
+            nfiles = cmdline.desktop if mode == 'apps' else cmdline.units
+            (all_pkgs, files) = make_packages(sandbox, max(sizes), mode, nfiles, cmdline, rnd)
+            for size in sizes:
+                # Services are checked in one VM
+                for n in (jobs if mode == 'apps' else [1]):
+                    (wall, simulated, spans) = run_once(sandbox, mode, all_pkgs[:size],
+                                                        files, n, cmdline)
+                    # Simulated latencies are spread over the parallel chroots
+                    # and launches, this is an estimate
+                    overhead = (wall - simulated / (n * cmdline.launches)) / size
+                    phases = ', '.join('%s %.1f' % phase for phase in top_phases(spans, 4))
+                    print('%-8s %5d %4d %9.2f %9.3f %8.1f %10.3f  %s' % (
+                        mode, size, n, wall, wall / size, size * 60 / wall,
+                        overhead, phases))
+    finally:
+        if cmdline.keep:
+            print('Sandbox: %s' % sandbox)
+        else:
+            shutil.rmtree(sandbox, ignore_errors=True)
@@ -11,16 +11,24 @@
 #
 # The script is based on check_apps_in_vm.py from rosa-autotest
 # (https://abf.io/spectre/rosa-autotest) but intended to be run inside
-# chroot and doesn't use cgroups.
+# chroot. If the launcher mounts a cgroup v2 there (see CGROUP_DIR), every
+# application is run in a cgroup of its own.
 #
 # Usage:
-#       python check_apps_in_vm.py <packages_list_file>
+#       python check_apps_in_vm.py [options] <packages_list_file>
+# or
+#       python check_apps_in_vm.py [options] --serve
+# to check the lists requested on stdin one by one, see serve().
 #
 # <packages_list_file> file should contain names of the packages (without
 # versions, etc.) from the repository to be processed.
 # For simplicity, all currently enabled repositories will be used when
 # installing the packages.
 #
+# An application is considered started once it shows a window (this is
+# checked with xwininfo from xorg-x11-utils, if available) and it does not
+# crash for a few seconds after that.
+#
 # The results will be available in the appropriate files in 'results'
 # subdirectory of the current directory, see RES_* below.
 # Each '*.list' file contains the list of packages of the particular kind.
@@ -33,12 +41,20 @@ import re
 import sys
 import time
 import resource
+import select
 import signal
 import shutil
 import psutil
 import string
+import binascii
+import Queue
+import tempfile
+import json
+import threading
 
+from contextlib import contextmanager
 from datetime import datetime
+from optparse import OptionParser
 from ConfigParser import RawConfigParser
 from ConfigParser import Error as ConfigParserError
 from glob import glob
@@ -53,14 +69,50 @@ SEP = 72 * '='
 SECTION = 'Desktop Entry'
 
 # How long (in seconds) to wait after starting the application before
-# killing it.
+# killing it if the outcome of the launch is still unknown.
 DEFAULT_TIMEOUT = 30
 
 # How long (in seconds) to wait for the application to exit.
 EXIT_TIMEOUT = 10
 
+# How long (in seconds) the application window should stay on the screen to
+# consider the application started successfully.
+STABLE_TIMEOUT = 3
+
+# How often (in seconds) to check the state of the application and whether
+# it has shown a window.
+POLL_INTERVAL = 0.2
+WINDOW_POLL_INTERVAL = 1
+
+# Outcomes of the application launch, see wait_for_app().
+APP_STARTED = 'started'
+APP_EXITED = 'exited'
+APP_CRASHED = 'crashed'
+APP_TIMEOUT = 'timeout'
+
+# Signals which mean the application has crashed if it is killed by them.
+CRASH_SIGNALS = [signal.SIGSEGV, signal.SIGABRT, signal.SIGBUS, signal.SIGILL,
+                 signal.SIGFPE]
+
+# Number of the first X display to run the applications on.
+DEFAULT_DISPLAY = 99
+
+# Screen configuration of the X servers.
+XVFB_SCREEN = '1280x1024x24'
+
+# How long (in seconds) to wait for an X server to start.
+XVFB_START_TIMEOUT = 10
+
+# Root of the file system the checker works in. It is normally '/' (the
+# checker is run in a chroot or a VM); bench_harness.py runs the checker
+# in a fake chroot and points it to the chroot directory.
+ROOT = os.environ.get('AUTOTEST_ROOT', '')
+
 # The directory with the results
-RESULT_DIR = '/tmp/results'
+RESULT_DIR = ROOT + '/tmp/results'
+
+# Additional options for yum.
+YUM_OPTIONS = []
 
 # Files with package lists of the given kind.
 RES_FAILED_TO_INSTALL = RESULT_DIR + '/failed-to-install.list'
@@ -70,10 +122,41 @@ RES_CRASHED = RESULT_DIR + '/crashed.list'
 RES_SUCCEEDED = RESULT_DIR + '/succeeded.list'
 RES_SKIPPED = RESULT_DIR + '/skipped.list'
 
-# Cgroup with subsystems
-CGROUP = 'cpu,cpuacct:autotest'
-# The file with the pids of the running processes that belong to the cgroup.
-TASKS_FILE = '/cgroup/testing/autotest/tasks'
+# Machine-readable records of the results of the packages and of their
+# checks, one JSON object per line, see add_record().
+RES_RECORDS = RESULT_DIR + '/results.jsonl'
+
+# Timing spans of the phases of the checks, one JSON object per line, see
+# timed().
+RES_SPANS = RESULT_DIR + '/spans.jsonl'
+
+# Core dumps of the applications are collected by collect_core.py registered
+# as core_pattern on the host, if the mode (CORE_MODES) is set: 'full' to
+# keep the compressed cores of at most CORE_LIMIT megabytes, 'backtrace' to
+# keep only the backtraces. The applications are tagged for the collector
+# with these environment variables (the same as in collect_core.py).
+CORE_MODES = ['full', 'backtrace']
+CORE_MODE = None
+CORE_LIMIT = 256
+CORE_ENV_PACKAGE = 'AUTOTEST_PACKAGE'
+CORE_ENV_COMMAND = 'AUTOTEST_COMMAND'
+CORE_ENV_DIR = 'AUTOTEST_CORE_DIR'
+CORE_ENV_MODE = 'AUTOTEST_CORE_MODE'
+CORE_ENV_LIMIT = 'AUTOTEST_CORE_LIMIT'
+
+# How long (in seconds) to wait for the collector to save a core.
+CORE_WAIT_TIMEOUT = 60
+
+# Printed by the checker running with --serve when it is done with a request,
+# see serve().
+SERVE_DONE = '@@autotest-done@@'
+
+# Every application is run in a leaf cgroup (v2) of its own under
+# CGROUP_DIR, if the launcher has mounted the cgroup of the chroot slot
+# there: the application and all its descendants are killed at once then,
+# and their peak memory usage and CPU time are accounted. Otherwise only the
+# application itself is terminated.
+CGROUP_DIR = ROOT + '/sys/fs/cgroup'
 
 # Regexps to match when checking the output for exception information.
 regexps_exception = [
@@ -90,6 +173,13 @@ regexps_exception = [
     # TODO: add more
 ]
 
+# All of the above as a single pattern, to check each line only once.
+re_exception = re.compile(
+    '|'.join(['(?:%s)' % reg.pattern for reg in regexps_exception]))
+
+# How much of the output to read at once when looking for exceptions.
+READ_CHUNK = 64 * 1024
+
 
 class Error(Exception):
     '''The custom error.'''
@@ -129,10 +219,47 @@ def mem_to_str(val, delta=False):
     return fmt % (float(val) / (1024 * 1024))
 
 
+# Serializes writes to RES_RECORDS and RES_SPANS.
+records_lock = threading.Lock()
+
+
+def add_record(record, fname=None):
+    '''Append the record (a dict) to the file (RES_RECORDS by default) as
+    a line of JSON.
+
+    The launcher loads the records into the result store.
+    '''
+    line = json.dumps(record) + '\n'
+    with records_lock:
+        with open(fname or RES_RECORDS, 'a') as f:
+            f.write(line)
+
+
+@contextmanager
+def timed(phase, **tags):
+    '''Record the time spent in the enclosed block to RES_SPANS as a span
+    of the given phase with the given tags (package, command, ...).'''
+    start = time.time()
+    try:
+        yield
+    finally:
+        span = {'phase': phase, 'start': start,
+                'duration': time.time() - start}
+        span.update(tags)
+        add_record(span, RES_SPANS)
+
+
 def add_to_list(pkgname, fname):
-    '''Add the given package name to the given file.'''
+    '''Add the given package name to the given file.
+
+    The result is recorded in RES_RECORDS as well, the status is the name
+    of the list, e.g. 'succeeded'.
+    '''
     with open(fname, 'a') as f:
         f.write(pkgname + '\n')
+    add_record({'type': 'package', 'package': pkgname,
+                'status': os.path.basename(fname)[:-len('.list')],
+                'time': time.time()})
 
 
 def get_installed_list():
@@ -143,7 +270,86 @@ def get_installed_list():
     return set(out.split('\n'))
 
 
-def check_apps(pkg, pkg_log):
+def run_checks(pkg, checks, pkg_log, displays, jobs=1):
+    '''Check the applications concurrently.
+
+    'checks' - list of (name, command) pairs, see do_check().
+    'jobs' - how many applications to run at once.
+
+    Each application gets its own display from 'displays', its own file
+    for the output and its own working directory, so core dumps can be
+    attributed to the command. When all the checks are done, their output
+    is appended to 'pkg_log' in the order of 'checks'.
+
+    Returns the list of do_check() results in the same order, None for the
+    checks that could not be run (e.g. no display is available).
+    '''
+    results = [None] * len(checks)
+    stats = [{} for i in range(len(checks))]
+    workdirs = []
+    todo = Queue.Queue()
+    for i in range(len(checks)):
+        workdirs.append(tempfile.mkdtemp(prefix='check_', dir=RESULT_DIR))
+        todo.put(i)
+
+    def worker():
+        while True:
+            try:
+                i = todo.get_nowait()
+            except Queue.Empty:
+                return
+            name, command = checks[i]
+            out = open(os.path.join(workdirs[i], 'output.log'), 'w')
+            try:
+                try:
+                    display = displays.lease()
+                    try:
+                        results[i] = do_check(pkg, name, command, out,
+                                              display, workdirs[i],
+                                              stats=stats[i])
+                    finally:
+                        displays.release(display)
+                except Exception, e:
+                    # The result stays None: failed to check
+                    out.write('Failed to check \'%s\': %s\n' % (command,
+                                                                  str(e)))
+            finally:
+                out.close()
+
+    threads = []
+    for i in range(min(jobs, len(checks))):
+        t = threading.Thread(target=worker)
+        t.start()
+        threads.append(t)
+    for t in threads:
+        t.join()
+
+    for i in range(len(checks)):
+        pkg_log.flush()
+        log_start = pkg_log.tell()
+        output = os.path.join(workdirs[i], 'output.log')
+        if os.path.exists(output):
+            with open(output, 'r') as f:
+                shutil.copyfileobj(f, pkg_log)
+        else:
+            pkg_log.write('\'%s\' has not been checked.\n' % checks[i][1])
+        shutil.rmtree(workdirs[i])
+        pkg_log.flush()
+        if results[i] is None:
+            status = 'failed-to-check'
+        elif results[i]:
+            status = 'succeeded'
+        else:
+            status = 'crashed'
+        record = {'type': 'check', 'package': pkg, 'name': checks[i][0],
+                  'command': checks[i][1], 'status': status,
+                  'log_start': log_start, 'log_end': pkg_log.tell()}
+        record.update(stats[i])
+        add_record(record)
+    return results
+
+
+def check_apps(pkg, pkg_log, displays, jobs=1, files=None):
     '''Check the apps from the given package via their .desktop files.
 
     Returns True if all the apps have been checked successfully or the
@@ -152,35 +358,41 @@ def check_apps(pkg, pkg_log):
 
     'pkg' - name of the package.
     'pkg_log' - file object for the log file.
+    'displays' - XvfbPool to take X displays for the apps from.
+    'jobs' - how many apps to check at once.
+    'files' - the files of the package if known (see read_index()),
+    otherwise they are queried from rpm.
     '''
     print '\n', SEP, '\n'
     print 'Processing', pkg
 
-    try:
-        out = subprocess.Popen(['sudo', 'rpm', '-q', '-l', pkg],
-                                      stdout=subprocess.PIPE,
-                                      stderr=pkg_log).communicate()[0]
-
-    except subprocess.CalledProcessError as e:
-        pkg_log.write(
-            '\'sudo rpm -q -l %s\' returned %d.\n' % (pkg, e.returncode))
-        pkg_log.write('Failed to check %s\n' % pkg)
-        add_to_list(pkg, RES_FAILED_TO_CHECK)
-        return False
+    if files is None:
+        try:
+            with timed('rpm_query', package=pkg):
+                out = subprocess.Popen(['sudo', 'rpm', '-q', '-l', pkg],
+                                       stdout=subprocess.PIPE,
+                                       stderr=pkg_log).communicate()[0]
+
+        except subprocess.CalledProcessError as e:
+            pkg_log.write(
+                '\'sudo rpm -q -l %s\' returned %d.\n' % (pkg, e.returncode))
+            pkg_log.write('Failed to check %s\n' % pkg)
+            add_to_list(pkg, RES_FAILED_TO_CHECK)
+            return False
+        files = out.split('\n')
 
     cfg = RawConfigParser()
 
-    nfiles = 0
-    failed = False
+    checks = []
     processed_commands = {}
 
     # For Qt3 apps
     os.environ['PATH'] = os.environ['PATH'] + ":/usr/lib64/qt-3.3/bin/"
 
-    for fl in out.split('\n'):
+    for fl in files:
         if re_desktop.match(fl):
             try:
-                res = cfg.read(fl)
+                res = cfg.read(ROOT + fl)
             except ConfigParserError as e:
                 pkg_log.write('Error while parsing %s: %s.\n' % (fl, str(e)))
                 continue
@@ -233,16 +445,21 @@ def check_apps(pkg, pkg_log):
 
             # Got a .desktop file of the needed type with the needed
             # content, check it.
-            nfiles = nfiles + 1
-            if not do_check(pkg, name, command, pkg_log):
-                failed = True
+            checks.append((name, command))
+
+    pkg_log.flush()
+    results = run_checks(pkg, checks, pkg_log, displays, jobs)
+    nfiles = len(checks)
 
     if nfiles == 0:
         add_to_list(pkg, RES_SKIPPED)
         ret = True
-    elif failed:
+    elif False in results:
         add_to_list(pkg, RES_CRASHED)
         ret = False
+    elif None in results:
+        add_to_list(pkg, RES_FAILED_TO_CHECK)
+        ret = False
     else:
         add_to_list(pkg, RES_SUCCEEDED)
         ret = True
@@ -251,16 +468,171 @@ def check_apps(pkg, pkg_log):
     return ret
 
 
-def check_packages(available_file, installed):
+def read_index(path):
+    '''Read the index of the files of the packages.
+
+    Each line of the index is a package name and a path to a .desktop file of
+    the package separated by a tab; a line with just a name means the
+    package has no such files. Returns a dict mapping package names to the
+    lists of the paths, the packages missing from the index are unknown.
+    '''
+    index = {}
+    f = open(path, 'r')
+    for line in f:
+        fields = line.rstrip('\n').split('\t', 1)
+        files = index.setdefault(fields[0], [])
+        if len(fields) > 1:
+            files.append(fields[1])
+    f.close()
+    return index
+
+
+def skip_without_files(pkgs, index):
+    '''Add the packages which have no .desktop files according to the index
+    to RES_SKIPPED without installing them.
+
+    Returns the list of the rest of the packages.
+    '''
+    rest = []
+    for pkg in pkgs:
+        if index.get(pkg) == []:
+            print 'Skipping %s: no .desktop files in the package' % pkg
+            with open(pkg_log_path(pkg), 'a') as pkg_log:
+                pkg_log.write('No .desktop files in the package according to the '
+                              'index, skipped.\n')
+            add_to_list(pkg, RES_SKIPPED)
+        else:
+            rest.append(pkg)
+    return rest
+
+
+def pkg_log_path(pkg):
+    '''Returns path to the log file of the given package.'''
+    return os.path.join(RESULT_DIR, 'pkg_' + pkg + '.log')
+
+
+def yum_logged(action, pkgs):
+    '''Run 'yum <action> -y' for the given packages in one transaction.
+
+    The output of yum is appended to the logs of all the packages.
+    Returns the exit code of yum.
+    '''
+    cmd = ['sudo', 'yum', action, '-y'] + YUM_OPTIONS + pkgs
+    if len(pkgs) == 1:
+        with open(pkg_log_path(pkgs[0]), 'a') as pkg_log:
+            with timed('yum_' + action, package=pkgs[0]):
+                return subprocess.call(cmd, stdout=pkg_log, stderr=pkg_log)
+
+    out = tempfile.TemporaryFile()
+    try:
+        with timed('yum_' + action, package=' '.join(pkgs)):
+            ret = subprocess.call(cmd, stdout=out, stderr=out)
+        for pkg in pkgs:
+            out.seek(0)
+            with open(pkg_log_path(pkg), 'a') as pkg_log:
+                pkg_log.write('In one transaction with: %s\n' % ' '.join(
+                    [p for p in pkgs if p != pkg]))
+                shutil.copyfileobj(out, pkg_log)
+    finally:
+        out.close()
+    return ret
+
+
+def install_packages(pkgs, installed):
+    '''Install the packages which are not installed yet, update the rest.
+
+    The new packages are installed in one yum transaction, if possible.
+    If the transaction fails (e.g. due to a conflict between the packages)
+    or some packages are still not installed after it, these are installed
+    one by one. The packages that failed to install are added to
+    RES_FAILED_TO_INSTALL.
+
+    'installed' - the collection of the names of installed packages.
+
+    Returns the list of the packages that have been installed.
+    '''
+    new = []
+    old = []
+    for pkg in pkgs:
+        with open(pkg_log_path(pkg), 'a') as pkg_log:
+            if pkg in installed:
+                pkg_log.write('Already installed: ' + pkg + '\n')
+                old.append(pkg)
+            else:
+                pkg_log.write('Installing ' + pkg + '\n')
+                new.append(pkg)
+
+    if old:
+        # It is possible that latest version of pkg is already installed
+        yum_logged('update', old)
+
+    alone = new
+    if len(new) > 1 and yum_logged('install', new) == 0:
+        now_installed = get_installed_list()
+        alone = [pkg for pkg in new if pkg not in now_installed]
+
+    for pkg in alone:
+        if len(new) > 1:
+            with open(pkg_log_path(pkg), 'a') as pkg_log:
+                pkg_log.write('Installing ' + pkg + ' alone\n')
+        ret = yum_logged('install', [pkg])
+        if ret != 0:
+            with open(pkg_log_path(pkg), 'a') as pkg_log:
+                pkg_log.write('Failed to install ' + pkg + '\n')
+                pkg_log.write('yum returned %d\n' % ret)
+            add_to_list(pkg, RES_FAILED_TO_INSTALL)
+            new.remove(pkg)
+
+    return new
+
+
+def remove_packages(pkgs):
+    '''Remove the packages, in one yum transaction if possible.
+
+    If the transaction fails, the packages are removed one by one, the ones
+    that failed to remove are added to RES_FAILED_TO_REMOVE.
+    '''
+    for pkg in pkgs:
+        with open(pkg_log_path(pkg), 'a') as pkg_log:
+            pkg_log.write('\nRemoving ' + pkg + '\n')
+
+    if len(pkgs) > 1 and yum_logged('remove', pkgs) == 0:
+        return
+
+    for pkg in pkgs:
+        # Might have been removed along with another package
+        if len(pkgs) > 1 and subprocess.call(['rpm', '-q', '--quiet', pkg]):
+            continue
+        ret = yum_logged('remove', [pkg])
+        if ret != 0:
+            with open(pkg_log_path(pkg), 'a') as pkg_log:
+                pkg_log.write('Failed to remove ' + pkg + '\n')
+                pkg_log.write('yum returned %d.\n' % ret)
+            add_to_list(pkg, RES_FAILED_TO_REMOVE)
+
+
+def check_packages(available_file, installed, displays, remove=True, jobs=1,
+                   batch=1, index=None):
     '''Check the packages listed in 'available_file'.
 
     'available_file' - the file with the list of available packages.
     'installed' - the collection of the names of installed packages.
+    'displays' - XvfbPool to take X displays for the apps from.
+    'remove' - whether to remove the packages installed for the check.
+    'jobs' - how many apps of a package to check at once.
+    'batch' - how many packages to install and remove in one transaction.
+    'index' - the files of the packages, see read_index(), if known.
     '''
-    to_check = set()
+    # The packages are checked in the order of the list, the launcher
+    # schedules them so
+    to_check = []
+    seen = set()
     with open(available_file, 'r') as f:
         for line in f:
-            to_check.add(line.rstrip())
+            pkg = line.rstrip()
+            if pkg and pkg not in seen:
+                seen.add(pkg)
+                to_check.append(pkg)
 
     print 'Number of packages to check:', len(to_check)
 
@@ -282,73 +654,66 @@ def check_packages(available_file, installed):
     if not os.path.exists(RESULT_DIR):
         os.mkdir(RESULT_DIR)
 
-    for pkg in to_check:
-        #print 40 * '=', '\n'
-
-        pkg_log_path = os.path.join(RESULT_DIR, 'pkg_' + pkg + '.log')
-        if os.path.exists(pkg_log_path):
-            os.remove(pkg_log_path)
-
-        with open(pkg_log_path, 'w') as pkg_log:
-
-            to_install = False
-            if not pkg in installed:
-                pkg_log.write('Installing ' + pkg + '\n')
-                pkg_log.flush()
-                to_install = True
+    for i in range(0, len(to_check), batch):
+        chunk = to_check[i : i + batch]
+        for pkg in chunk:
+            if os.path.exists(pkg_log_path(pkg)):
+                os.remove(pkg_log_path(pkg))
+            add_record({'type': 'package', 'package': pkg,
+                        'status': 'started', 'time': time.time()})
+
+        if index is not None:
+            rest = skip_without_files(chunk, index)
+            passed = passed + len(chunk) - len(rest)
+            chunk = rest
+
+        # The time of the transactions is shared out among the packages of
+        # the chunk, the rest is the time of their own checks
+        start = time.time()
+        to_remove = install_packages(chunk, installed)
+        shared = time.time() - start
+        durations = {}
+
+        for pkg in chunk:
+            if not pkg in installed and not pkg in to_remove:
+                continue
 
-                try:
-                    subprocess.check_call(
-                        ['sudo', 'yum', 'install', '-y', pkg],
-                        stdout=pkg_log, stderr=pkg_log)
-
-                except subprocess.CalledProcessError as e:
-                    pkg_log.write('Failed to install ' + pkg + '\n')
-                    pkg_log.write('yum returned %d\n' % e.returncode)
-                    add_to_list(pkg, RES_FAILED_TO_INSTALL)
-                    continue
-            else:
-                pkg_log.write('Already installed: ' + pkg + '\n')
-                subprocess.check_call(
-                        ['sudo', 'yum', 'update', '-y', pkg],
-                        stdout=pkg_log, stderr=pkg_log)
+            start = time.time()
+            with open(pkg_log_path(pkg), 'a') as pkg_log:
+                files = None
+                if index is not None:
+                    files = index.get(pkg)
+                if check_apps(pkg, pkg_log, displays, jobs, files):
+                    passed = passed + 1
+            durations[pkg] = time.time() - start
 
-            if check_apps(pkg, pkg_log):
-                passed = passed + 1
+        if to_remove and remove:
+            start = time.time()
+            remove_packages(to_remove)
+            shared += time.time() - start
 
-            if to_install:
-                try:
-                    pkg_log.write('\nRemoving ' + pkg + '\n')
-                    subprocess.check_call(
-                        ['sudo', 'yum', 'remove', '-y', pkg],
-                        stdout=pkg_log, stderr=pkg_log)
-                    #subprocess.check_call(
-                    #    ['sudo', 'urpme', '--auto', '--auto-orphans'],
-                    #    stdout=pkg_log, stderr=pkg_log)
-
-                except subprocess.CalledProcessError as e:
-                    pkg_log.write('Failed to remove ' + pkg + '\n')
-                    pkg_log.write('yum returned %d.\n' % e.returncode)
-                    add_to_list(pkg, RES_FAILED_TO_REMOVE)
-                    continue
+        for pkg in chunk:
+            add_record({'type': 'timing', 'package': pkg,
+                        'duration': durations.get(pkg, 0) + shared / len(chunk),
+                        'time': time.time()})
 
-            vmem_used_prev = vmem.total - vmem.available
-            swap_used_prev = swap.used
+        vmem_used_prev = vmem.total - vmem.available
+        swap_used_prev = swap.used
 
-            vmem = psutil.virtual_memory()
-            swap = psutil.swap_memory()
+        vmem = psutil.virtual_memory()
+        swap = psutil.swap_memory()
 
-            vmem_used = vmem.total - vmem.available
+        vmem_used = vmem.total - vmem.available
 
-            print 'Memory: total = %s, used = %s (%s)' % (
-                mem_to_str(vmem.total),
-                mem_to_str(vmem_used),
-                mem_to_str(vmem_used - vmem_used_prev, delta=True))
+        print 'Memory: total = %s, used = %s (%s)' % (
+            mem_to_str(vmem.total),
+            mem_to_str(vmem_used),
+            mem_to_str(vmem_used - vmem_used_prev, delta=True))
 
-            print 'Swap: total = %s, used = %s (%s)' % (
-                mem_to_str(swap.total),
-                mem_to_str(swap.used),
-                mem_to_str(swap.used - swap_used_prev, delta=True))
+        print 'Swap: total = %s, used = %s (%s)' % (
+            mem_to_str(swap.total),
+            mem_to_str(swap.used),
+            mem_to_str(swap.used - swap_used_prev, delta=True))
 
     mem_log_path = os.path.join(RESULT_DIR, 'memory_summary.log')
     with open(mem_log_path, 'w') as mem_log:
@@ -365,127 +730,661 @@ def check_packages(available_file, installed):
     print SEP
 
 
-def kill_as_root(pid, sig, pkg_log):
-    '''Send the signal to the process with the given PID as root.'''
+def remove_results():
+    '''Remove the results of the previous run, except the logs of the
+    packages.'''
+    for fname in [RES_FAILED_TO_INSTALL, RES_FAILED_TO_REMOVE,
+                  RES_FAILED_TO_CHECK, RES_CRASHED, RES_SUCCEEDED,
+                  RES_SKIPPED, RES_RECORDS, RES_SPANS]:
+        if os.path.exists(fname):
+            os.remove(fname)
+
+
+def serve(installed, displays, remove=True, jobs=1, batch=1):
+    '''Check the packages of the lists requested on stdin until it is closed.
+
+    A request is a line with a JSON object: 'list' - the file with the list
+    of the packages, 'index' - their index, see read_index() (optional).
+    The results of the previous request are removed before the check,
+    SERVE_DONE is printed after it.
+
+    The X servers and the set of installed packages are kept between the
+    requests, the latter is only queried again if some packages could not
+    be removed. See check_packages() for the other arguments.
+    '''
+    while True:
+        line = sys.stdin.readline()
+        if not line:
+            break
+        try:
+            request = json.loads(line)
+            available_file = request['list']
+        except (ValueError, KeyError, TypeError):
+            print 'Invalid request: %s' % line.rstrip()
+            print SERVE_DONE
+            continue
+
+        remove_results()
+        index = None
+        if request.get('index'):
+            index = read_index(request['index'])
+        print 'Processing the packages listed in \'%s\'' % available_file
+        try:
+            check_packages(available_file, installed, displays, remove, jobs,
+                           batch, index)
+        except Exception, e:
+            print 'Failed to process \'%s\': %s' % (available_file, str(e))
+        if os.path.exists(RES_FAILED_TO_REMOVE):
+            installed = get_installed_list()
+        print SERVE_DONE
+
+
+def create_cgroup():
+    '''Create a leaf cgroup for an application under CGROUP_DIR.
+
+    Returns its path, None if the cgroups are not available.
+    '''
+    if not os.path.exists(os.path.join(CGROUP_DIR, 'cgroup.subtree_control')):
+        return None
+    try:
+        return tempfile.mkdtemp(prefix='app_', dir=CGROUP_DIR)
+    except OSError:
+        return None
+
+
+def enter_cgroup(path):
+    '''Returns a function moving the calling process to the cgroup. It is
+    run by the application before exec, so all its descendants are in the
+    cgroup from the start.'''
+    def enter():
+        with open(os.path.join(path, 'cgroup.procs'), 'w') as f:
+            f.write('0')
+    return enter
+
+
+def cgroup_populated(fd):
+    '''Check if there are processes in the cgroup, 'fd' - descriptor of
+    its cgroup.events file.'''
+    os.lseek(fd, 0, os.SEEK_SET)
+    for line in os.read(fd, 4096).splitlines():
+        if line.startswith('populated '):
+            return line.split()[1] != '0'
+    return False
+
+
+def wait_for_cgroup(path, timeout):
+    '''Wait for at most 'timeout' seconds until no processes are left in
+    the cgroup.
+
+    The kernel notifies the readers of cgroup.events when it changes, so the
+    wait ends as soon as the last process exits.
+
+    Returns True if the cgroup is empty, False otherwise.
+    '''
+    deadline = time.time() + timeout
+    fd = os.open(os.path.join(path, 'cgroup.events'), os.O_RDONLY)
     try:
-        subprocess.check_call(
-            ['sudo', 'kill', '-' + str(sig), str(pid)],
-            stdout=pkg_log, stderr=pkg_log)
-
-    except subprocess.CalledProcessError as e:
-        pkg_log.write(''.join([
-            'Failed to execute ',
-            '\'kill -%d %d\', exit code: %d\n' % (sig, pid, e.returncode)]))
+        poller = select.poll()
+        poller.register(fd, select.POLLPRI)
+        while cgroup_populated(fd):
+            left = deadline - time.time()
+            if left <= 0:
+                return False
+            poller.poll(int(left * 1000) + 1)
+        return True
+    finally:
+        os.close(fd)
+
+
+def kill_cgroup(path, sig, pkg_log):
+    '''Send signal 'sig' to all the processes of the cgroup.
+
+    SIGKILL is sent by the kernel itself via cgroup.kill (Linux 5.14+), so
+    the processes forking meanwhile do not escape it; otherwise the signal
+    is sent to the processes listed in cgroup.procs.
+    '''
+    kill_file = os.path.join(path, 'cgroup.kill')
+    if sig == signal.SIGKILL and os.path.exists(kill_file):
+        pkg_log.write('Killing the processes of the application.\n')
+        with open(kill_file, 'w') as f:
+            f.write('1')
+        return
+
+    with open(os.path.join(path, 'cgroup.procs'), 'r') as f:
+        pids = [int(line) for line in f if line.strip()]
+    for pid in pids:
+        pkg_log.write('Sending signal %d to the process %d.\n' % (sig, pid))
+        try:
+            os.kill(pid, sig)
+        except OSError:
+            # Has exited already
+            pass
+
+
+def terminate_cgroup(path, pkg_log):
+    '''Terminate all the processes of the cgroup: SIGTERM first, then
+    SIGKILL if some of them are still running in EXIT_TIMEOUT seconds.
+
+    Returns True if no processes are left, False otherwise.
+    '''
+    if wait_for_cgroup(path, 0):
+        return True
+    kill_cgroup(path, signal.SIGTERM, pkg_log)
+    if wait_for_cgroup(path, EXIT_TIMEOUT):
+        return True
+
+    deadline = time.time() + EXIT_TIMEOUT
+    kill_cgroup(path, signal.SIGKILL, pkg_log)
+    while not wait_for_cgroup(path, min(WINDOW_POLL_INTERVAL,
+                                        deadline - time.time())):
+        if time.time() >= deadline:
+            return False
+        # The processes forked before the previous signal could reach them
+        kill_cgroup(path, signal.SIGKILL, pkg_log)
+    return True
+
+
+def cgroup_usage(path):
+    '''Returns the resources used by the processes of the cgroup: a dict
+    with 'memory_peak' (in bytes; needs the memory controller and Linux
+    5.19+), 'cpu_user' and 'cpu_system' (in seconds).'''
+    usage = {}
+    try:
+        with open(os.path.join(path, 'memory.peak'), 'r') as f:
+            usage['memory_peak'] = int(f.read())
+    except (IOError, ValueError):
+        pass
+    try:
+        with open(os.path.join(path, 'cpu.stat'), 'r') as f:
+            for line in f:
+                (key, value) = line.split()
+                if key == 'user_usec':
+                    usage['cpu_user'] = int(value) / 1000000.0
+                elif key == 'system_usec':
+                    usage['cpu_system'] = int(value) / 1000000.0
+    except (IOError, ValueError):
+        pass
+    return usage
+
+
+def remove_cgroup(path, pkg_log):
+    '''Remove the cgroup, killing its processes if some are left.'''
+    if not wait_for_cgroup(path, 0):
+        kill_cgroup(path, signal.SIGKILL, pkg_log)
+        wait_for_cgroup(path, EXIT_TIMEOUT)
+    try:
+        os.rmdir(path)
     except OSError, e:
-        pkg_log.write(''.join([
-            'Failed to execute ',
-            '\'kill -%d %d\': %s\n' % (sig, pid, str(e))]))
+        pkg_log.write('Failed to remove cgroup %s: %s\n' % (path, str(e)))
 
 
-def kill_group(sig, pkg_log, as_root=False):
-    '''Send signal 'sig' to all running processes that belong to the cgroup.
+class ExceptionDetector(object):
+    '''Looks for exception information in the output of a command.
 
-    Returns True if there was at least one process there, False otherwise.
+    'path' - path to the file the command writes its output to.
+    'command' - the command.
+    'start' - offset in the file where the output of the command begins.
 
-    If 'as_root' is True, the signal will be sent as root, otherwise - as
-    the current user.
+    The output is consumed incrementally: each call to poll() reads only
+    the data written since the previous call, so the output is scanned once
+    however often the detector is polled, even while the command is running.
     '''
-    ret = False
+    def __init__(self, path, command, start=0):
+        self.path = path
+        self.command = command
+        self.start = start
+        self.offset = start
+        self.partial = ''
+        self.match = None
+        self.f = None
+
+    def scan(self, data, final=False):
+        '''Check complete lines of 'data' appended to the partial line.'''
+        line_offset = self.offset - len(self.partial)
+        lines = (self.partial + data).split('\n')
+        if final:
+            self.partial = ''
+        else:
+            self.partial = lines.pop()
+        for line in lines:
+            if re_exception.match(line.strip()):
+                self.match = (line_offset - self.start, line)
+                return
+            line_offset += len(line) + 1
+
+    def poll(self, final=False):
+        '''Consume the new output.
+
+        If 'final' is True, the output is considered complete, so the last
+        line is checked even if it is not terminated.
+
+        Returns the first match as (offset in the output, line) or None.
+        '''
+        if not self.match:
+            if self.f is None:
+                self.f = open(self.path, 'rb')
+            self.f.seek(self.offset)
+            while not self.match:
+                data = self.f.read(READ_CHUNK)
+                if not data:
+                    break
+                self.scan(data)
+                self.offset += len(data)
+            if final and not self.match:
+                self.scan('', final=True)
+        if final:
+            self.close()
+        return self.match
+
+    def close(self):
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+
+
+class Display(object):
+    '''A long-lived Xvfb server.
+
+    'num' - number of the X display.
+
+    The server is started on demand and can be restarted if it dies or
+    needs to be reset. Applications should be run with the environment
+    returned by env().
+    '''
+    def __init__(self, num):
+        self.num = num
+        self.name = ':%d' % num
+        self.auth_file = '/tmp/.autotest-Xauthority-%d' % num
+        self.socket = '/tmp/.X11-unix/X%d' % num
+        self.proc = None
+
+    def env(self):
+        '''Returns the environment for X clients of this display.'''
+        env = dict(os.environ)
+        env['DISPLAY'] = self.name
+        env['XAUTHORITY'] = self.auth_file
+        return env
+
+    def remove_stale_lock(self):
+        '''Remove the lock of the display left by a killed X server.'''
+        lock = '/tmp/.X%d-lock' % self.num
+        try:
+            with open(lock, 'r') as f:
+                pid = int(f.read().strip())
+            os.kill(pid, 0)
+        except (IOError, ValueError):
+            pass
+        except OSError:
+            os.remove(lock)
+            if os.path.exists(self.socket):
+                os.remove(self.socket)
+
+    def start(self):
+        '''Start the X server and wait until it accepts connections.'''
+        self.remove_stale_lock()
+        cookie = binascii.hexlify(os.urandom(16))
+        devnull = open(os.devnull, 'w')
+        try:
+            subprocess.call(['xauth', '-q', '-f', self.auth_file, 'add',
+                             self.name, '.', cookie],
+                            stdout=devnull, stderr=devnull)
+            self.proc = subprocess.Popen(
+                ['Xvfb', self.name, '-screen', '0', XVFB_SCREEN,
+                 '-nolisten', 'tcp', '-auth', self.auth_file],
+                stdout=devnull, stderr=devnull)
+        except OSError, e:
+            raise Error('Failed to start X server %s: %s' % (self.name, str(e)))
+        finally:
+            devnull.close()
+
+        deadline = time.time() + XVFB_START_TIMEOUT
+        while not self.healthy():
+            if self.proc.poll() is not None or time.time() >= deadline:
+                self.stop()
+                raise Error('X server %s has failed to start' % self.name)
+            time.sleep(POLL_INTERVAL)
+
+    def stop(self):
+        '''Stop the X server, if it is running.'''
+        if self.proc is not None:
+            if self.proc.poll() is None:
+                self.proc.send_signal(signal.SIGTERM)
+                if not wait_for_exit(self.proc, EXIT_TIMEOUT):
+                    self.proc.send_signal(signal.SIGKILL)
+                    self.proc.wait()
+            self.proc = None
+
+    def healthy(self):
+        '''Check if the X server is running and listening.'''
+        return (self.proc is not None and self.proc.poll() is None and
+                os.path.exists(self.socket))
+
+
+class XvfbPool(object):
+    '''A pool of long-lived X servers.
+
+    'base' - number of the first X display of the pool.
+    'size' - number of the X displays in the pool.
+
+    A display is leased for one application at a time. The X server resets
+    itself when its last client disconnects; if it dies or windows of stray
+    processes are still shown when the display is returned to the pool, the
+    server is restarted.
+    '''
+    def __init__(self, base, size):
+        self.displays = []
+        self.free = Queue.Queue()
+        for num in range(base, base + size):
+            display = Display(num)
+            self.displays.append(display)
+            self.free.put(display)
+
+    def start(self):
+        for display in self.displays:
+            display.start()
+
+    def stop(self):
+        for display in self.displays:
+            display.stop()
+
+    def lease(self):
+        '''Returns a running Display, waits for one if all are in use.'''
+        display = self.free.get()
+        try:
+            if not display.healthy():
+                display.stop()
+                display.start()
+        except Error:
+            self.free.put(display)
+            raise
+        return display
+
+    def release(self, display):
+        '''Return the Display to the pool.'''
+        if display.healthy() and window_shown(display):
+            display.stop()
+        self.free.put(display)
+
+
+def window_shown(display):
+    '''Check if there is a viewable top-level window on the Display.
+
+    Returns True or False, None if it cannot be checked (e.g. xwininfo from
+    xorg-x11-utils is not installed).
+    '''
+    env = display.env()
+    devnull = open(os.devnull, 'w')
+    try:
+        try:
+            out = subprocess.Popen(
+                ['xwininfo', '-display', display.name, '-root', '-children'],
+                stdout=subprocess.PIPE, stderr=devnull, env=env).communicate()[0]
+            for line in out.split('\n'):
+                wid = line.strip().split(' ')[0]
+                if not wid.startswith('0x'):
+                    continue
+                info = subprocess.Popen(
+                    ['xwininfo', '-display', display.name, '-id', wid],
+                    stdout=subprocess.PIPE, stderr=devnull,
+                    env=env).communicate()[0]
+                if 'Map State: IsViewable' in info:
+                    return True
+            return False
+        except OSError:
+            return None
+    finally:
+        devnull.close()
 
-    with open(TASKS_FILE, 'r') as f:
-        for line in f:
-            pid_str = line.strip()
-            pid = int(pid_str)
-            if pid > 0:
-                pkg_log.write(
-                    'Sending signal %d to the process %d.\n' % (sig, pid))
-                if as_root:
-                    kill_as_root(pid, sig, pkg_log)
-                else:
-                    os.kill(pid, sig)
-                ret = True
 
-    return ret
+def wait_for_exit(proc, timeout):
+    '''Wait up to 'timeout' seconds for the process to exit.
+
+    Returns True if the process has exited, False otherwise.
+    '''
+    deadline = time.time() + timeout
+    while proc.poll() is None:
+        if time.time() >= deadline:
+            return False
+        time.sleep(POLL_INTERVAL)
+    return True
+
+
+def wait_for_app(proc, display, detector, timeout, workdir='.'):
+    '''Wait until the outcome of the application launch is known.
+
+    'proc' - Popen object of the application.
+    'display' - Display the application is run on.
+    'detector' - ExceptionDetector for the output of the application.
+    'timeout' - how long (in seconds) to wait at most.
+    'workdir' - working directory of the application, core dumps are
+    looked for there.
+
+    Returns APP_STARTED if a top-level window has been shown and the
+    application has survived STABLE_TIMEOUT seconds after that, APP_EXITED
+    if the application has exited, APP_CRASHED if an exception has been
+    found in its output or a core dump has appeared and APP_TIMEOUT if none
+    of these has happened in time.
+    '''
+    deadline = time.time() + timeout
+    shown_at = None
+    next_window_check = 0
+    while True:
+        if proc.poll() is not None:
+            return APP_EXITED
+        if detector.poll() or glob(os.path.join(workdir, 'core.*')):
+            return APP_CRASHED
+
+        now = time.time()
+        if shown_at is not None:
+            if now - shown_at >= STABLE_TIMEOUT:
+                return APP_STARTED
+        elif next_window_check is not None and now >= next_window_check:
+            shown = window_shown(display)
+            if shown is None:
+                # Can only wait for exit, crash or timeout
+                next_window_check = None
+            elif shown:
+                shown_at = now
+            else:
+                next_window_check = now + WINDOW_POLL_INTERVAL
+
+        if now >= deadline:
+            return APP_TIMEOUT
+        time.sleep(POLL_INTERVAL)
 
 
-def do_check(pkg, name, command, pkg_log, timeout=DEFAULT_TIMEOUT):
+def do_check(pkg, name, command, pkg_log, display, workdir,
+             timeout=DEFAULT_TIMEOUT, stats=None):
     '''Run the given application and see if it crashes.
 
+    The application is run on the given Display in 'workdir' directory,
+    which should be empty. 'pkg_log' is the file object for the output of
+    the application.
+
+    If 'stats' dict is given, the details of the launch are stored there:
+    its 'outcome' (see wait_for_app()), 'exit_code' or 'signal' the
+    application has been terminated with, 'time' and 'duration'.
+
     Returns False if the application crashed, True otherwise.
     '''
+    if stats is None:
+        stats = {}
+    stats['time'] = time.time()
     pkg_log.write(SEP + '\n\n')
     if name:
         pkg_log.write('Checking %s.\n' % name)
     pkg_log.write('Command: \'%s\'\n\n' % command)
 
-    # Remove all core.* files first
-    files = glob('./core.*')
-    for fl in files:
-        os.remove(fl)
-
     crashed = False
+    cgroup = create_cgroup()
 
     try:
         cmd = string.split(command, " ")
-        proc = subprocess.Popen(
-            ["xvfb-run"] + cmd, stdout=pkg_log, stderr=pkg_log)
-#            ['cgexec', '-g', CGROUP, command], stdout=pkg_log,
-#            stderr=pkg_log)
-        time.sleep(timeout)
-        proc.send_signal(signal.SIGTERM)
-        time.sleep(EXIT_TIMEOUT)
-        proc.send_signal(signal.SIGKILL)
-
-        # Kill the process as well as any other processes it has spawned.
-#        if kill_group(signal.SIGTERM, pkg_log):
-#            time.sleep(EXIT_TIMEOUT)
-
-        # Just to make sure they are killed
-#        if kill_group(signal.SIGKILL, pkg_log):
-#            time.sleep(EXIT_TIMEOUT)
+        pkg_log.flush()
+        start = pkg_log.tell()
+        env = display.env()
+        if CORE_MODE:
+            env[CORE_ENV_PACKAGE] = pkg
+            env[CORE_ENV_COMMAND] = command
+            env[CORE_ENV_DIR] = os.path.abspath(workdir)
+            env[CORE_ENV_MODE] = CORE_MODE
+            env[CORE_ENV_LIMIT] = str(CORE_LIMIT)
+        with timed('launch', package=pkg, command=command):
+            proc = subprocess.Popen(
+                cmd, stdout=pkg_log, stderr=pkg_log, env=env, cwd=workdir,
+                preexec_fn=cgroup and enter_cgroup(cgroup))
+            detector = ExceptionDetector(pkg_log.name, command, start)
+            outcome = wait_for_app(proc, display, detector, timeout, workdir)
+        stats['outcome'] = outcome
+        if outcome == APP_STARTED:
+            pkg_log.write('\nThe application has started.\n')
+        elif outcome == APP_EXITED:
+            pkg_log.write(
+                '\nThe application has exited, code %d.\n' % proc.returncode)
+            if -proc.returncode in CRASH_SIGNALS:
+                pkg_log.write('The application has been killed by signal '
+                              '%d.\n' % -proc.returncode)
+                crashed = True
+        elif outcome == APP_TIMEOUT:
+            pkg_log.write('\nNo window has been shown in %d seconds.\n' %
+                          timeout)
+        pkg_log.flush()
+
+        if outcome == APP_CRASHED:
+            # A process being dumped must not be killed
+            with timed('core_dump', package=pkg, command=command):
+                wait_for_cores(workdir)
+
+        if cgroup:
+            # Kill the process as well as any other processes it has spawned.
+            with timed('terminate', package=pkg, command=command):
+                if terminate_cgroup(cgroup, pkg_log):
+                    proc.wait()
+            usage = cgroup_usage(cgroup)
+            stats.update(usage)
+            if 'memory_peak' in usage:
+                pkg_log.write('Peak memory usage: %d KiB.\n' %
+                              (usage['memory_peak'] // 1024))
+            if 'cpu_user' in usage:
+                pkg_log.write('CPU time: %.2f s user, %.2f s system.\n' % (
+                    usage['cpu_user'], usage.get('cpu_system', 0)))
+        elif proc.poll() is None:
+            with timed('terminate', package=pkg, command=command):
+                proc.send_signal(signal.SIGTERM)
+                if not wait_for_exit(proc, EXIT_TIMEOUT):
+                    proc.send_signal(signal.SIGKILL)
+                    wait_for_exit(proc, EXIT_TIMEOUT)
 
         pkg_log.flush()
-        crashed = crashed_procs(pkg, pkg_log)
-	ldproc = subprocess.Popen('ldd' + ' ' '$(which '+ command + ')', shell=True, stdout=pkg_log, stderr=pkg_log)
+        with timed('crash_scan', package=pkg, command=command):
+            if crashed_procs(pkg, pkg_log, detector, workdir):
+                crashed = True
+        with timed('ldd', package=pkg, command=command):
+            ldproc = subprocess.Popen('ldd' + ' ' '$(which '+ command + ')', shell=True, stdout=pkg_log, stderr=pkg_log)
+            ldproc.wait()
 
         # Just in case (zombies, uninterruptible sleeps in a driver, ...)
         ret = proc.poll()
         if ret is None:
             pkg_log.write('Failed to kill the process.\n')
             #crashed = True
-
-    except OSError, e:
+        elif ret < 0:
+            # Not the signals the checker has terminated the application by
+            if outcome == APP_EXITED or -ret in CRASH_SIGNALS:
+                stats['signal'] = -ret
+        else:
+            stats['exit_code'] = ret
+
+    except (OSError, IOError), e:
         pkg_log.write('Failed to execute the command: %s\n' % str(e))
+        stats['outcome'] = 'error'
         #crashed = True
+    except Error, e:
+        pkg_log.write('%s\n' % str(e))
+        stats['outcome'] = 'error'
 
     # Just in case, to avoid stray processes.
-#    kill_group(signal.SIGKILL, pkg_log, as_root=True)
+    if cgroup:
+        remove_cgroup(cgroup, pkg_log)
+    stats['duration'] = time.time() - stats['time']
     return not crashed
 
 
 def enable_core_dumps():
-    '''Enable generation of core dumps for this process and its children'''
+    '''Enable generation of core dumps for this process and its children.
+
+    The core dumps are passed to collect_core.py, which the launcher
+    registers as core_pattern (core_pattern is not per chroot, so the checker
+    does not touch it).
+    '''
 
     # Similar to 'ulimit -c unlimited'.
     resource.setrlimit(resource.RLIMIT_CORE, (-1, -1))
 
-    # Make sure the core dumps are created as plain files and not passed to
-    # systemd or whatever.
-    # The files will be named 'core.<pid>'.
-    subprocess.call(['sudo', 'sh', '-c',
-                     'echo core > /proc/sys/kernel/core_pattern'])
-
 
-def crashed_procs(pkg, pkg_log):
-    '''Returns True if some processes have crashed, False otherwise.'''
+def read_core_info(path):
+    '''Returns the details of a crash written by collect_core.py, None if
+    they cannot be read.'''
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+
+def wait_for_cores(workdir, timeout=CORE_WAIT_TIMEOUT):
+    '''Wait until collect_core.py has saved all the cores it has started to
+    save in 'workdir'. Returns the details of the crashes as a list.'''
+    deadline = time.time() + timeout
+    while True:
+        infos = []
+        for path in glob(os.path.join(workdir, 'core.*.json')):
+            info = read_core_info(path)
+            if info is not None:
+                infos.append(info)
+        if time.time() >= deadline or \
+           not [info for info in infos if info['status'] == 'dumping']:
+            return infos
+        time.sleep(POLL_INTERVAL)
+
+
+def crashed_procs(pkg, pkg_log, detector, workdir='.'):
+    '''Returns True if some processes have crashed, False otherwise.
+
+    The output of the command is checked by the given ExceptionDetector,
+    core dumps are looked for in 'workdir'.
+    '''
 
-    with open(pkg_log.name, 'r') as f:
-        for line in f:
-            for reg in regexps_exception:
-                if reg.match(line.strip()):
-                    return True
+    match = detector.poll(final=True)
+    if match:
+        pkg_log.write('Exception found at offset %d of the output of '
+                      '\'%s\':\n\t%s\n' % (match[0], detector.command,
+                                             match[1].strip()))
+        return True
 
-    files = glob('./core.*')
+    infos = wait_for_cores(workdir)
+    for info in infos:
+        pkg_log.write('The process %d (%s) has crashed with signal %d.\n' % (
+            info['pid'], info['comm'], info['signal']))
+        dump = os.path.join(RESULT_DIR, 'dump_%s.%d' % (pkg, info['pid']))
+        if info['status'] != 'done':
+            pkg_log.write('Failed to save its core: %s\n' % info.get(
+                'error', 'timed out'))
+        elif info.get('core'):
+            saved_dump = dump + '.core' + os.path.splitext(info['core'])[1]
+            pkg_log.write('Its core%s is saved to %s.\n' % (
+                info['truncated'] and ' (truncated)' or '',
+                os.path.basename(saved_dump)))
+            shutil.move(os.path.join(workdir, info['core']), saved_dump)
+        if info.get('backtrace'):
+            pkg_log.write('Backtrace:\n%s\n' % info['backtrace'])
+        with open(dump + '.json', 'w') as f:
+            json.dump(info, f, indent=1, sort_keys=True)
+        os.remove(os.path.join(workdir, 'core.%d.json' % info['pid']))
+
+    # Plain core files if core_pattern is 'core'
+    files = [fl for fl in glob(os.path.join(workdir, 'core.*'))
+             if fl.rpartition('.')[2].isdigit()]
     if files:
         pkg_log.write('The processes with the following PIDs have crashed:\n')
         for fl in files:
@@ -496,16 +1395,56 @@ def crashed_procs(pkg, pkg_log):
             if not os.path.exists(saved_dump):
                 shutil.move(fl, saved_dump)
 
-        return True
-
-    return False
+    return bool(infos or files)
 
 
 # main
 if __name__ == '__main__':
-    if len(sys.argv) != 2:
-        print 'Usage: '
-        print '\t' + sys.argv[0] + ' <packages_list_file>'
+    parser = OptionParser(usage='%prog [options] <packages_list_file>\n'
+                                '       %prog [options] --serve')
+    parser.add_option('-d', '--display', type='int', default=DEFAULT_DISPLAY,
+                      help='number of the first X display to run the '
+                           'applications on (default: %default); checkers '
+                           'running in parallel must use different displays')
+    parser.add_option('-k', '--keep-installed', action='store_true',
+                      default=False,
+                      help='do not remove the packages after the check, '
+                           'useful if the chroot is reset by the caller')
+    parser.add_option('-j', '--jobs', type='int', default=1,
+                      help='number of applications of a package to check '
+                           'at once, each on its own X display '
+                           '(default: %default)')
+    parser.add_option('-c', '--keep-cache', action='store_true',
+                      default=False,
+                      help='keep the downloaded packages in yum cache, '
+                           'useful if the caller collects them')
+    parser.add_option('--only-repo', metavar='REPO',
+                      help='install the packages from the given repository '
+                           'only, disabling all the others')
+    parser.add_option('-b', '--batch', type='int', default=1,
+                      help='number of packages to install and remove in one '
+                           'yum transaction (default: %default); packages '
+                           'are installed one by one if the transaction fails')
+    parser.add_option('-i', '--index', metavar='FILE',
+                      help='index of the .desktop files of the packages '
+                           'prepared from the repository metadata; the '
+                           'packages having none are skipped without '
+                           'installation')
+    parser.add_option('--cores', type='choice', choices=CORE_MODES,
+                      help='tag the applications for collect_core.py, which '
+                           'must be registered as core_pattern, to keep '
+                           'their core dumps: ' + ' or '.join(CORE_MODES))
+    parser.add_option('--core-limit', type='int', default=CORE_LIMIT,
+                      metavar='MB',
+                      help='maximum size of a core dump to keep, larger ones '
+                           'are truncated (default: %default)')
+    parser.add_option('-s', '--serve', action='store_true', default=False,
+                      help='check the lists of packages requested on stdin '
+                           'one by one, keeping the X servers running '
+                           'between them')
+    (options, args) = parser.parse_args()
+    if len(args) != int(not options.serve):
+        parser.print_usage()
         sys.exit(1)
 
     my_out = SyncedOut(sys.stdout)
@@ -513,19 +1452,43 @@ if __name__ == '__main__':
 
     print 'Started at', datetime.today()
 
-    fnames = [RES_FAILED_TO_INSTALL, RES_FAILED_TO_REMOVE,
-              RES_FAILED_TO_CHECK, RES_CRASHED, RES_SUCCEEDED, RES_SKIPPED]
-    for fname in fnames:
-        if os.path.exists(fname):
-            os.remove(fname)
+    remove_results()
 
-#    enable_core_dumps()
+    if options.cores:
+        CORE_MODE = options.cores
+        CORE_LIMIT = options.core_limit
+        enable_core_dumps()
 
     installed = get_installed_list()
     print 'Installed:', len(installed)
 
-    available_file = sys.argv[1]
-    print 'Processing the packages listed in \'%s\'' % available_file
-    check_packages(available_file, installed)
+    if options.keep_cache:
+        YUM_OPTIONS.append('--setopt=keepcache=1')
+    if options.only_repo:
+        YUM_OPTIONS += ['--disablerepo=*', '--enablerepo=' + options.only_repo]
+
+    displays = XvfbPool(options.display, max(options.jobs, 1))
+    try:
+        displays.start()
+    except Error, e:
+        print str(e)
+        sys.exit(1)
+
+    try:
+        if options.serve:
+            serve(installed, displays, not options.keep_installed,
+                  max(options.jobs, 1), max(options.batch, 1))
+        else:
+            index = None
+            if options.index:
+                index = read_index(options.index)
+
+            available_file = args[0]
+            print 'Processing the packages listed in \'%s\'' % available_file
+            check_packages(available_file, installed, displays,
+                           not options.keep_installed, max(options.jobs, 1),
+                           max(options.batch, 1), index)
+    finally:
+        displays.stop()
 
     print 'Completed at', datetime.today()
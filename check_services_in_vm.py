@@ -9,7 +9,7 @@
 # information.
 #
 # Usage:
-#       python check_services_in_vm.py <packages_list_file>
+#       python check_services_in_vm.py [options] <packages_list_file>
 #
 # <packages_list_file> file should contain names of the packages (without
 # versions, etc.) from the repositories to be processed.
@@ -27,8 +27,26 @@ import re
 import sys
 import shutil
 import psutil
+import tempfile
+import json
+import threading
+import Queue
+import time
 
+from contextlib import contextmanager
 from datetime import datetime
+from optparse import OptionParser
+
+# dbus-python (with GLib main loop) is optional, systemctl is used without it.
+try:
+    import dbus
+    import dbus.mainloop.glib
+    try:
+        from gi.repository import GLib as glib
+    except ImportError:
+        import gobject as glib
+except ImportError:
+    dbus = None
 
 
 # Regexp for the needed paths to the .service files.
@@ -36,8 +54,13 @@ re_service = re.compile('.*/lib/systemd/system/[^/]*[^@]\\.service')
 
 SEP = 72 * '='
 
+# Root of the file system the checker works in. It is normally '/' (the
+# checker is run in a VM); bench_harness.py runs the checker on the host
+# and points it to the directory of a fake VM.
+ROOT = os.environ.get('AUTOTEST_ROOT', '')
+
 # The directory with the results
-RESULT_DIR = '/tmp/results'
+RESULT_DIR = ROOT + '/tmp/results'
 
 # Files with package lists of the given kind.
 RES_FAILED_TO_INSTALL = RESULT_DIR + '/failed-to-install.list'
@@ -47,6 +70,14 @@ RES_FAILED = RESULT_DIR + '/failed.list'
 RES_SUCCEEDED = RESULT_DIR + '/succeeded.list'
 RES_SKIPPED = RESULT_DIR + '/skipped.list'
 
+# Machine-readable records of the results of the packages and of their
+# checks, one JSON object per line, see add_record().
+RES_RECORDS = RESULT_DIR + '/results.jsonl'
+
+# Timing spans of the phases of the checks, one JSON object per line, see
+# timed().
+RES_SPANS = RESULT_DIR + '/spans.jsonl'
+
 
 STATUS_ACTIVE = 'active'
 STATUS_INACTIVE = 'inactive'
@@ -56,6 +87,26 @@ STATUS_FAILED = 'failed'
 # Useful if we want to test only part of services provided by some package
 IGNORE_LIST = ['nfs-blkmap.service']
 
+# D-Bus names of systemd.
+SYSTEMD_BUS_NAME = 'org.freedesktop.systemd1'
+SYSTEMD_PATH = '/org/freedesktop/systemd1'
+SYSTEMD_MANAGER = 'org.freedesktop.systemd1.Manager'
+SYSTEMD_UNIT = 'org.freedesktop.systemd1.Unit'
+
+# Errors meaning that the checker is not allowed to start or stop units over
+# D-Bus (it is not run as root, the launcher runs it with sudo), systemctl is
+# run with sudo then.
+DBUS_ACCESS_DENIED = ['org.freedesktop.DBus.Error.AccessDenied',
+                      'org.freedesktop.DBus.Error.InteractiveAuthorizationRequired']
+
+# How long (in seconds) to wait for a start or stop job of a unit to finish.
+# The units have their own timeouts (TimeoutStartSec=, ...), so this is just
+# a safety net.
+JOB_TIMEOUT = 600
+
+# Connection to systemd, see SystemdClient; None if systemctl is used.
+systemd = None
+
 class SyncedOut(object):
     '''A wrapper around sys.stdout that flushes the output each time.
 
@@ -89,10 +140,186 @@ def mem_to_str(val, delta=False):
     return fmt % (float(val) / (1024 * 1024))
 
 
+# Serializes writes to RES_RECORDS and RES_SPANS.
+records_lock = threading.Lock()
+
+
+def add_record(record, fname=None):
+    '''Append the record (a dict) to the file (RES_RECORDS by default) as
+    a line of JSON.
+
+    The launcher loads the records into the result store.
+    '''
+    line = json.dumps(record) + '\n'
+    with records_lock:
+        with open(fname or RES_RECORDS, 'a') as f:
+            f.write(line)
+
+
+@contextmanager
+def timed(phase, **tags):
+    '''Record the time spent in the enclosed block to RES_SPANS as a span
+    of the given phase with the given tags (package, command, ...).'''
+    start = time.time()
+    try:
+        yield
+    finally:
+        span = {'phase': phase, 'start': start,
+                'duration': time.time() - start}
+        span.update(tags)
+        add_record(span, RES_SPANS)
+
+
 def add_to_list(pkgname, fname):
-    '''Add the given package name to the given file.'''
+    '''Add the given package name to the given file.
+
+    The result is recorded in RES_RECORDS as well, the status is the name
+    of the list, e.g. 'succeeded'.
+    '''
     with open(fname, 'a') as f:
         f.write(pkgname + '\n')
+    add_record({'type': 'package', 'package': pkgname,
+                'status': os.path.basename(fname)[:-len('.list')],
+                'time': time.time()})
+
+
+class SystemdClient(object):
+    '''A persistent connection to systemd over D-Bus.
+
+    The client subscribes to the signals of systemd and keeps the results of
+    the jobs it has started (JobRemoved signals), so starting or stopping a unit
+    waits for the result of its job rather than polling the state of the
+    unit. The signals are dispatched by a GLib main loop in a separate
+    thread; the methods can be called from any thread.
+    '''
+    def __init__(self):
+        glib.threads_init()
+        dbus.mainloop.glib.threads_init()
+        self.bus = dbus.SystemBus(mainloop=dbus.mainloop.glib.DBusGMainLoop())
+        self.manager = dbus.Interface(
+            self.bus.get_object(SYSTEMD_BUS_NAME, SYSTEMD_PATH), SYSTEMD_MANAGER)
+        self.can_manage = True
+        self.cond = threading.Condition()
+        # Results of the jobs, only of the started ones, unless a StartUnit()
+        # or StopUnit() call is in progress: the job may finish before the
+        # call returns its path
+        self.jobs = {}
+        self.started = set()
+        self.calls = 0
+        self.bus.add_signal_receiver(self.job_removed, 'JobRemoved',
+                                     SYSTEMD_MANAGER, SYSTEMD_BUS_NAME,
+                                     SYSTEMD_PATH)
+        self.manager.Subscribe()
+        self.loop = glib.MainLoop()
+        t = threading.Thread(target=self.loop.run)
+        t.daemon = True
+        t.start()
+
+    def close(self):
+        self.loop.quit()
+
+    def job_removed(self, job_id, job, unit, result):
+        with self.cond:
+            if self.calls or str(job) in self.started:
+                self.jobs[str(job)] = str(result)
+                self.cond.notify_all()
+
+    def unit(self, name):
+        '''Returns the D-Bus object of the unit, loading it if needed.'''
+        return self.bus.get_object(SYSTEMD_BUS_NAME, self.manager.LoadUnit(name))
+
+    def properties(self, names, props):
+        '''Returns the given properties of the units as a dict mapping the
+        names of the units to the dicts of the properties.'''
+        result = {}
+        for name in names:
+            values = self.unit(name).GetAll(SYSTEMD_UNIT,
+                                            dbus_interface=dbus.PROPERTIES_IFACE)
+            result[name] = dict((prop, values.get(prop)) for prop in props)
+        return result
+
+    def active_state(self, name):
+        return str(self.unit(name).Get(SYSTEMD_UNIT, 'ActiveState',
+                                       dbus_interface=dbus.PROPERTIES_IFACE))
+
+    def run_job(self, method, name):
+        '''Call the given method of the manager (StartUnit, StopUnit) for the
+        unit and wait for the job to finish.
+
+        Returns the result of the job ('done', 'failed', 'timeout',
+        'dependency', ...), 'no-result' if it has not finished in
+        JOB_TIMEOUT seconds, None if the checker is not allowed to manage
+        the units.
+        '''
+        if not self.can_manage:
+            return None
+        with self.cond:
+            self.calls += 1
+        job = None
+        try:
+            job = str(getattr(self.manager, method)(name, 'replace'))
+        except dbus.DBusException as e:
+            if e.get_dbus_name() in DBUS_ACCESS_DENIED:
+                self.can_manage = False
+                return None
+            raise
+        finally:
+            with self.cond:
+                if job is not None:
+                    self.started.add(job)
+                self.calls -= 1
+                if not self.calls:
+                    for other in set(self.jobs) - self.started:
+                        del self.jobs[other]
+        deadline = time.time() + JOB_TIMEOUT
+        with self.cond:
+            try:
+                # The job may have finished before StartUnit() returned
+                while job not in self.jobs:
+                    left = deadline - time.time()
+                    if left <= 0:
+                        return 'no-result'
+                    self.cond.wait(left)
+                return self.jobs.pop(job)
+            finally:
+                self.started.discard(job)
+
+
+def connect_systemd():
+    '''Returns a SystemdClient or None if D-Bus cannot be used.'''
+    if dbus is None:
+        print 'dbus-python is not available, using systemctl'
+        return None
+    try:
+        return SystemdClient()
+    except dbus.DBusException as e:
+        print 'Failed to connect to systemd over D-Bus, using systemctl: %s' % (
+            e.get_dbus_message())
+        return None
+
+
+def run_unit_job(action, service, pkg_log):
+    '''Start or stop ('action') the given service.
+
+    The job is run over D-Bus if possible and its result is logged,
+    otherwise 'sudo systemctl <action>' is run. Returns True on success.
+    '''
+    if systemd is not None:
+        method = {'start': 'StartUnit', 'stop': 'StopUnit'}[action]
+        start = time.time()
+        try:
+            result = systemd.run_job(method, service)
+        except dbus.DBusException as e:
+            pkg_log.write('Failed to %s %s: %s\n' % (action, service,
+                                                    e.get_dbus_message()))
+            return False
+        if result is not None:
+            pkg_log.write('Job %s %s: %s in %.2f s.\n' % (
+                action, service, result, time.time() - start))
+            return result == 'done'
+    pkg_log.flush()
+    return subprocess.call(['sudo', 'systemctl', action, service],
+                           stdout=pkg_log) == 0
 
 
 def get_installed_list():
@@ -102,7 +329,227 @@ def get_installed_list():
     return set(out.split('\n'))
 
 
-def check_services(pkg, pkg_log):
+def journal_cursor(pkg_log):
+    '''Returns the cursor of the last entry of the journal, None if it
+    cannot be obtained.'''
+    try:
+        out = subprocess.check_output(['sudo', 'journalctl', '-n', '1',
+                                       '--show-cursor', '-o', 'cat'],
+                                      stderr=pkg_log)
+    except subprocess.CalledProcessError as e:
+        pkg_log.write('Failed to obtain journal cursor (journalctl returned '
+                      '%d).\n' % e.returncode)
+        return None
+    for line in reversed(out.split('\n')):
+        if line.startswith('-- cursor: '):
+            return line[len('-- cursor: '):].strip()
+    return None
+
+
+def write_journal(pkg, service, cursor, since, pkg_log):
+    '''Append the journal entries of the given service logged after the
+    given cursor (or, if it is None, since the given time) to the log.'''
+    cmd = ['sudo', 'journalctl', '--no-pager', '-o', 'short-precise',
+           '-u', service]
+    if cursor:
+        cmd.append('--after-cursor=' + cursor)
+    else:
+        cmd += ['--since', time.strftime('%Y-%m-%d %H:%M:%S',
+                                         time.localtime(since))]
+    pkg_log.write('\nJournal of %s:\n' % service)
+    pkg_log.flush()
+    with timed('journal', package=pkg, command=service):
+        subprocess.call(cmd, stdout=pkg_log, stderr=pkg_log)
+
+
+def get_relations(services, pkg_log):
+    '''Returns the ordering and conflict relations of the given services as
+    a dict mapping each of them to a dict with 'After', 'Before' and
+    'Conflicts' sets of unit names.
+
+    The relations are read over D-Bus or queried by one 'systemctl show'
+    call; if it fails, the services are considered unrelated.
+    '''
+    relations = dict((service, {'After': set(), 'Before': set(),
+                                'Conflicts': set()}) for service in services)
+    if systemd is not None:
+        try:
+            props = systemd.properties(services, ['After', 'Before', 'Conflicts'])
+        except dbus.DBusException as e:
+            pkg_log.write('Failed to obtain relations of the services: %s\n' %
+                          e.get_dbus_message())
+            return relations
+        for service in services:
+            for (prop, units) in props[service].items():
+                relations[service][prop].update([str(unit) for unit in units or []])
+        return relations
+
+    try:
+        out = subprocess.check_output(
+            ['sudo', 'systemctl', 'show',
+             '--property=After,Before,Conflicts'] + services, stderr=pkg_log)
+    except subprocess.CalledProcessError as e:
+        pkg_log.write('Failed to obtain relations of the services '
+                      '(systemctl returned %d).\n' % e.returncode)
+        return relations
+
+    # The properties are shown for each unit in the order of the arguments,
+    # the units are separated by empty lines
+    for (service, block) in zip(services, out.strip().split('\n\n')):
+        for line in block.split('\n'):
+            (prop, _, value) = line.strip().partition('=')
+            if prop in relations[service]:
+                relations[service][prop].update(value.split())
+    return relations
+
+
+def plan_waves(services, relations):
+    '''Split the services into waves to be started concurrently.
+
+    A service ordered after another one (After=/Before=) gets into a later
+    wave, so its result does not depend on how the other one has started;
+    conflicting services (Conflicts=) never get into the same wave, as
+    starting one of them would stop the other. The services in an ordering
+    cycle are started one by one after all the others.
+
+    Returns the list of the waves (lists of the services).
+    '''
+    names = set(services)
+    after = dict((service, set()) for service in services)
+    for service in services:
+        for other in relations[service]['After'] & names:
+            after[service].add(other)
+        for other in relations[service]['Before'] & names:
+            after[other].add(service)
+
+    levels = []
+    placed = set()
+    rest = list(services)
+    while rest:
+        level = [service for service in rest
+                 if not (after[service] - placed - set([service]))]
+        if not level:
+            break
+        levels.append(level)
+        placed.update(level)
+        rest = [service for service in rest if service not in placed]
+
+    waves = []
+    for level in levels:
+        # Greedy colouring of the conflict graph of the level
+        level_waves = []
+        for service in level:
+            for wave in level_waves:
+                if not [other for other in wave
+                        if other in relations[service]['Conflicts'] or
+                        service in relations[other]['Conflicts']]:
+                    wave.append(service)
+                    break
+            else:
+                level_waves.append([service])
+        waves += level_waves
+    waves += [[service] for service in rest]
+    return waves
+
+
+def run_checks(pkg, services, pkg_log, jobs):
+    '''Check the services concurrently.
+
+    'services' - names of the services to check.
+    'jobs' - how many services to start at once.
+
+    The services are started wave by wave (see plan_waves()), up to 'jobs'
+    of them at once, each with its own 'systemctl start' job and its own
+    file for the output; when all the services of a wave are started and
+    their statuses are checked, they are stopped the same way. The journal
+    entries of every service since the start of its wave are added to its
+    output. When all the checks are done, their output is appended to
+    'pkg_log' in the order of 'services'.
+
+    Returns the list of the results (True or False) in the same order.
+    '''
+    results = [True] * len(services)
+    stats = [{} for i in range(len(services))]
+    outputs = []
+    for i in range(len(services)):
+        (fd, path) = tempfile.mkstemp(prefix='check_', dir=RESULT_DIR)
+        os.close(fd)
+        outputs.append(path)
+
+    def run_concurrently(func, todo):
+        '''Call func(i, out) for each index in 'todo', up to 'jobs' at once.'''
+        queue = Queue.Queue()
+        for i in todo:
+            queue.put(i)
+
+        def worker():
+            while True:
+                try:
+                    i = queue.get_nowait()
+                except Queue.Empty:
+                    return
+                with open(outputs[i], 'a') as out:
+                    func(i, out)
+
+        threads = []
+        for j in range(min(jobs, len(todo))):
+            t = threading.Thread(target=worker)
+            t.start()
+            threads.append(t)
+        for t in threads:
+            t.join()
+
+    started = [False] * len(services)
+
+    # The duration of a check ends with the stop of its service (or its
+    # failed start), the capture of the journal is not counted
+    def start(i, out):
+        stats[i]['time'] = time.time()
+        with timed('service_start', package=pkg, command=services[i]):
+            (results[i], started[i]) = start_service(services[i], out)
+        stats[i]['duration'] = time.time() - stats[i]['time']
+
+    def stop(i, out):
+        with timed('service_stop', package=pkg, command=services[i]):
+            if not stop_service(services[i], out):
+                results[i] = False
+        stats[i]['duration'] = time.time() - stats[i]['time']
+
+    relations = get_relations(services, pkg_log)
+    position = dict((service, i) for (i, service) in enumerate(services))
+    for wave in plan_waves(services, relations):
+        todo = [position[service] for service in wave]
+        if len(wave) > 1:
+            for i in todo:
+                with open(outputs[i], 'a') as out:
+                    out.write('Started in the same wave as: %s\n' % ', '.join(
+                        [service for service in wave if service != services[i]]))
+        since = time.time()
+        cursor = journal_cursor(pkg_log)
+        with timed('service_wave', package=pkg, command=' '.join(wave)):
+            run_concurrently(start, todo)
+            run_concurrently(stop, [i for i in todo if started[i]])
+        for i in todo:
+            with open(outputs[i], 'a') as out:
+                write_journal(pkg, services[i], cursor, since, out)
+
+    for i in range(len(services)):
+        pkg_log.flush()
+        log_start = pkg_log.tell()
+        with open(outputs[i], 'r') as f:
+            shutil.copyfileobj(f, pkg_log)
+        os.remove(outputs[i])
+        pkg_log.flush()
+        record = {'type': 'check', 'package': pkg, 'name': services[i],
+                  'command': 'systemctl start ' + services[i],
+                  'status': results[i] and 'succeeded' or 'failed',
+                  'log_start': log_start, 'log_end': pkg_log.tell()}
+        record.update(stats[i])
+        add_record(record)
+    return results
+
+
+def check_services(pkg, pkg_log, files=None, jobs=1):
     '''Check the services from the given package.
 
     Returns True if all the services have been checked successfully or the
@@ -111,29 +558,54 @@ def check_services(pkg, pkg_log):
 
     'pkg' - name of the package.
     'pkg_log' - file object for the log file.
+    'files' - the files of the package if known (see read_index()),
+    otherwise they are queried from rpm.
+    'jobs' - how many services to start at once, see run_checks().
     '''
     print '\n', SEP, '\n'
     print 'Processing', pkg
 
-    try:
-        out = subprocess.check_output(['sudo', 'rpm', '-q', '-l', pkg],
-                                      stderr=pkg_log)
-
-    except subprocess.CalledProcessError as e:
-        pkg_log.write(
-            '\'sudo rpm -q -l %s\' returned %d.\n' % (pkg, e.returncode))
-        pkg_log.write('Failed to check %s\n' % pkg)
-        add_to_list(pkg, RES_FAILED_TO_CHECK)
-        return False
+    if files is None:
+        try:
+            with timed('rpm_query', package=pkg):
+                out = subprocess.check_output(['sudo', 'rpm', '-q', '-l', pkg],
+                                              stderr=pkg_log)
 
-    nfiles = 0
+        except subprocess.CalledProcessError as e:
+            pkg_log.write(
+                '\'sudo rpm -q -l %s\' returned %d.\n' % (pkg, e.returncode))
+            pkg_log.write('Failed to check %s\n' % pkg)
+            add_to_list(pkg, RES_FAILED_TO_CHECK)
+            return False
+        files = out.split('\n')
+
+    services = []
+    for fl in files:
+        if re_service.match(fl) and os.path.basename(fl) not in services:
+            # Got a .service file, check it.
+            services.append(os.path.basename(fl))
+    nfiles = len(services)
     failed = False
 
-    for fl in out.split('\n'):
-        if re_service.match(fl):
-            # Got a .service file, check it.
-            nfiles = nfiles + 1
-            if not do_check(os.path.basename(fl), pkg_log):
+    if jobs > 1 and nfiles > 1:
+        failed = not all(run_checks(pkg, services, pkg_log, jobs))
+    else:
+        for service in services:
+            pkg_log.flush()
+            log_start = pkg_log.tell()
+            cursor = journal_cursor(pkg_log)
+            start = time.time()
+            with timed('service_check', package=pkg, command=service):
+                ok = do_check(service, pkg_log)
+            duration = time.time() - start
+            write_journal(pkg, service, cursor, start, pkg_log)
+            pkg_log.flush()
+            add_record({'type': 'check', 'package': pkg, 'name': service,
+                        'command': 'systemctl start ' + service,
+                        'status': ok and 'succeeded' or 'failed',
+                        'time': start, 'duration': duration,
+                        'log_start': log_start, 'log_end': pkg_log.tell()})
+            if not ok:
                 failed = True
 
     if nfiles == 0:
@@ -150,16 +622,168 @@ def check_services(pkg, pkg_log):
     return ret
 
 
-def check_packages(available_file, installed):
+def read_index(path):
+    '''Read the index of the files of the packages.
+
+    Each line of the index is a package name and a path to a .service file of
+    the package separated by a tab; a line with just a name means the
+    package has no such files. Returns a dict mapping package names to the
+    lists of the paths, the packages missing from the index are unknown.
+    '''
+    index = {}
+    f = open(path, 'r')
+    for line in f:
+        fields = line.rstrip('\n').split('\t', 1)
+        files = index.setdefault(fields[0], [])
+        if len(fields) > 1:
+            files.append(fields[1])
+    f.close()
+    return index
+
+
+def skip_without_files(pkgs, index):
+    '''Add the packages which have no .service files according to the index
+    to RES_SKIPPED without installing them.
+
+    Returns the list of the rest of the packages.
+    '''
+    rest = []
+    for pkg in pkgs:
+        if index.get(pkg) == []:
+            print 'Skipping %s: no .service files in the package' % pkg
+            with open(pkg_log_path(pkg), 'a') as pkg_log:
+                pkg_log.write('No .service files in the package according to the '
+                              'index, skipped.\n')
+            add_to_list(pkg, RES_SKIPPED)
+        else:
+            rest.append(pkg)
+    return rest
+
+
+def pkg_log_path(pkg):
+    '''Returns path to the log file of the given package.'''
+    return os.path.join(RESULT_DIR, 'pkg_' + pkg + '.log')
+
+
+def yum_logged(action, pkgs):
+    '''Run 'yum <action> -y' for the given packages in one transaction.
+
+    The output of yum is appended to the logs of all the packages.
+    Returns the exit code of yum.
+    '''
+    cmd = ['sudo', 'yum', action, '-y'] + pkgs
+    if len(pkgs) == 1:
+        with open(pkg_log_path(pkgs[0]), 'a') as pkg_log:
+            with timed('yum_' + action, package=pkgs[0]):
+                return subprocess.call(cmd, stdout=pkg_log, stderr=pkg_log)
+
+    out = tempfile.TemporaryFile()
+    try:
+        with timed('yum_' + action, package=' '.join(pkgs)):
+            ret = subprocess.call(cmd, stdout=out, stderr=out)
+        for pkg in pkgs:
+            out.seek(0)
+            with open(pkg_log_path(pkg), 'a') as pkg_log:
+                pkg_log.write('In one transaction with: %s\n' % ' '.join(
+                    [p for p in pkgs if p != pkg]))
+                shutil.copyfileobj(out, pkg_log)
+    finally:
+        out.close()
+    return ret
+
+
+def install_packages(pkgs, installed):
+    '''Install the packages which are not installed yet, update the rest.
+
+    The new packages are installed in one yum transaction, if possible.
+    If the transaction fails (e.g. due to a conflict between the packages)
+    or some packages are still not installed after it, these are installed
+    one by one. The packages that failed to install are added to
+    RES_FAILED_TO_INSTALL.
+
+    'installed' - the collection of the names of installed packages.
+
+    Returns the list of the packages that have been installed.
+    '''
+    new = []
+    old = []
+    for pkg in pkgs:
+        with open(pkg_log_path(pkg), 'a') as pkg_log:
+            if pkg in installed:
+                pkg_log.write('Already installed: ' + pkg + '\n')
+                old.append(pkg)
+            else:
+                pkg_log.write('Installing ' + pkg + '\n')
+                new.append(pkg)
+
+    if old:
+        # It is possible that latest version of pkg is already installed
+        yum_logged('update', old)
+
+    alone = new
+    if len(new) > 1 and yum_logged('install', new) == 0:
+        now_installed = get_installed_list()
+        alone = [pkg for pkg in new if pkg not in now_installed]
+
+    for pkg in alone:
+        if len(new) > 1:
+            with open(pkg_log_path(pkg), 'a') as pkg_log:
+                pkg_log.write('Installing ' + pkg + ' alone\n')
+        ret = yum_logged('install', [pkg])
+        if ret != 0:
+            with open(pkg_log_path(pkg), 'a') as pkg_log:
+                pkg_log.write('Failed to install ' + pkg + '\n')
+                pkg_log.write('yum returned %d\n' % ret)
+            add_to_list(pkg, RES_FAILED_TO_INSTALL)
+            new.remove(pkg)
+
+    return new
+
+
+def remove_packages(pkgs):
+    '''Remove the packages, in one yum transaction if possible.
+
+    If the transaction fails, the packages are removed one by one, the ones
+    that failed to remove are added to RES_FAILED_TO_REMOVE.
+    '''
+    for pkg in pkgs:
+        with open(pkg_log_path(pkg), 'a') as pkg_log:
+            pkg_log.write('\nRemoving ' + pkg + '\n')
+
+    if len(pkgs) > 1 and yum_logged('remove', pkgs) == 0:
+        return
+
+    for pkg in pkgs:
+        # Might have been removed along with another package
+        if len(pkgs) > 1 and subprocess.call(['rpm', '-q', '--quiet', pkg]):
+            continue
+        ret = yum_logged('remove', [pkg])
+        if ret != 0:
+            with open(pkg_log_path(pkg), 'a') as pkg_log:
+                pkg_log.write('Failed to remove ' + pkg + '\n')
+                pkg_log.write('yum returned %d.\n' % ret)
+            add_to_list(pkg, RES_FAILED_TO_REMOVE)
+
+
+def check_packages(available_file, installed, batch=1, index=None, jobs=1):
     '''Check the packages listed in 'available_file'.
 
     'available_file' - the file with the list of available packages.
     'installed' - the collection of the names of installed packages.
+    'batch' - how many packages to install and remove in one transaction.
+    'index' - the files of the packages, see read_index(), if known.
+    'jobs' - how many services of a package to start at once.
     '''
-    to_check = set()
+    # The packages are checked in the order of the list, the launcher
+    # schedules them so
+    to_check = []
+    seen = set()
     with open(available_file, 'r') as f:
         for line in f:
-            to_check.add(line.rstrip())
+            pkg = line.rstrip()
+            if pkg and pkg not in seen:
+                seen.add(pkg)
+                to_check.append(pkg)
 
     print 'Number of packages to check:', len(to_check)
 
@@ -181,74 +805,66 @@ def check_packages(available_file, installed):
     if not os.path.exists(RESULT_DIR):
             os.mkdir(RESULT_DIR)
 
-    for pkg in to_check:
-        #print 40 * '=', '\n'
-
-        pkg_log_path = os.path.join(RESULT_DIR, 'pkg_' + pkg + '.log')
-        if os.path.exists(pkg_log_path):
-            os.remove(pkg_log_path)
-
-        with open(pkg_log_path, 'w') as pkg_log:
-
-            to_install = False
-            if not pkg in installed:
-                pkg_log.write('Installing ' + pkg + '\n')
-                pkg_log.flush()
-                to_install = True
-
-                try:
-                    subprocess.check_call(
-                        ['sudo', 'yum', 'install', '-y', pkg],
-                        stdout=pkg_log, stderr=pkg_log)
-
-                except subprocess.CalledProcessError as e:
-                    pkg_log.write('Failed to install ' + pkg + '\n')
-                    pkg_log.write('yum returned %d\n' % e.returncode)
-                    add_to_list(pkg, RES_FAILED_TO_INSTALL)
-                    continue
-            else:
-                pkg_log.write('Already installed: ' + pkg + '\n')
-                try:
-                    subprocess.check_call(
-                            ['sudo', 'yum', 'update', '-y', pkg],
-                            stdout=pkg_log, stderr=pkg_log)
-                except:
-                    # It ispossible that latest version of pkg is already installed
-                    pass
-
-            if check_services(pkg, pkg_log):
-                passed = passed + 1
-
-            if to_install:
-                try:
-                    pkg_log.write('\nRemoving ' + pkg + '\n')
-                    subprocess.check_call(
-                        ['sudo', 'yum', 'remove', '-y', pkg],
-                        stdout=pkg_log, stderr=pkg_log)
-
-                except subprocess.CalledProcessError as e:
-                    pkg_log.write('Failed to remove ' + pkg + '\n')
-                    pkg_log.write('yum remove returned %d.\n' % e.returncode)
-                    add_to_list(pkg, RES_FAILED_TO_REMOVE)
-                    continue
+    for i in range(0, len(to_check), batch):
+        chunk = to_check[i : i + batch]
+        for pkg in chunk:
+            if os.path.exists(pkg_log_path(pkg)):
+                os.remove(pkg_log_path(pkg))
+            add_record({'type': 'package', 'package': pkg,
+                        'status': 'started', 'time': time.time()})
+
+        if index is not None:
+            rest = skip_without_files(chunk, index)
+            passed = passed + len(chunk) - len(rest)
+            chunk = rest
+
+        # The time of the transactions is shared out among the packages of
+        # the chunk, the rest is the time of their own checks
+        start = time.time()
+        to_remove = install_packages(chunk, installed)
+        shared = time.time() - start
+        durations = {}
+
+        for pkg in chunk:
+            if not pkg in installed and not pkg in to_remove:
+                continue
+
+            start = time.time()
+            with open(pkg_log_path(pkg), 'a') as pkg_log:
+                files = None
+                if index is not None:
+                    files = index.get(pkg)
+                if check_services(pkg, pkg_log, files, jobs):
+                    passed = passed + 1
+            durations[pkg] = time.time() - start
+
+        if to_remove:
+            start = time.time()
+            remove_packages(to_remove)
+            shared += time.time() - start
+
+        for pkg in chunk:
+            add_record({'type': 'timing', 'package': pkg,
+                        'duration': durations.get(pkg, 0) + shared / len(chunk),
+                        'time': time.time()})
+
+        vmem_used_prev = vmem.total - vmem.available
+        swap_used_prev = swap.used
 
-            vmem_used_prev = vmem.total - vmem.available
-            swap_used_prev = swap.used
-
-            vmem = psutil.virtual_memory()
-            swap = psutil.swap_memory()
+        vmem = psutil.virtual_memory()
+        swap = psutil.swap_memory()
 
-            vmem_used = vmem.total - vmem.available
+        vmem_used = vmem.total - vmem.available
 
-            print 'Memory: total = %s, used = %s (%s)' % (
-                mem_to_str(vmem.total),
-                mem_to_str(vmem_used),
-                mem_to_str(vmem_used - vmem_used_prev, delta=True))
+        print 'Memory: total = %s, used = %s (%s)' % (
+            mem_to_str(vmem.total),
+            mem_to_str(vmem_used),
+            mem_to_str(vmem_used - vmem_used_prev, delta=True))
 
-            print 'Swap: total = %s, used = %s (%s)' % (
-                mem_to_str(swap.total),
-                mem_to_str(swap.used),
-                mem_to_str(swap.used - swap_used_prev, delta=True))
+        print 'Swap: total = %s, used = %s (%s)' % (
+            mem_to_str(swap.total),
+            mem_to_str(swap.used),
+            mem_to_str(swap.used - swap_used_prev, delta=True))
 
     mem_log_path = os.path.join(RESULT_DIR, 'memory_summary.log')
     with open(mem_log_path, 'w') as mem_log:
@@ -272,6 +888,14 @@ def get_status(service, pkg_log):
     Return value: 'active', 'inactive', 'failed', ..., None if failed to
     determine the status.
     '''
+    if systemd is not None:
+        try:
+            return systemd.active_state(service).lower() or None
+        except dbus.DBusException as e:
+            pkg_log.write('Failed to obtain status of %s: %s\n' % (
+                service, e.get_dbus_message()))
+            return None
+
     try:
         out = subprocess.check_output(['sudo', 'systemctl', 'show',
                                        '--property=ActiveState', service],
@@ -321,25 +945,25 @@ def prepare_configs(service, pkg_log):
             conf.write("console name=\"c1\" dev=\"/dev/tty10\"")
 
 
-def do_check(service, pkg_log):
-    '''Check the given service if it is not already active.
-
-    If the service is not already active, try to activate it and check the
+def start_service(service, pkg_log):
+    '''Start the given service if it is not already active and check its
     status.
 
-    Returns False on failure, True otherwise.
+    Returns a tuple (success, started): 'started' is True if the service
+    has been started by the checker and should be stopped afterwards, see
+    stop_service().
     '''
     pkg_log.write(SEP + '\n\n')
     pkg_log.write('Checking %s.\n' % service)
 
     if service in IGNORE_LIST:
         pkg_log.write('Test for this service is blacklisted, skipping')
-        return True
+        return (True, False)
 
     status = get_status(service, pkg_log)
     if status == STATUS_ACTIVE:
         # The service is already running, assuming it is working OK.
-        return True
+        return (True, False)
     elif status == STATUS_FAILED:
         # The system tried to start the service before but failed.
         pkg_log.write('Service \"%s\" failed to start at boot.\n' % service)
@@ -351,22 +975,20 @@ def do_check(service, pkg_log):
 #        return False
     elif status != STATUS_INACTIVE:
         pkg_log.write('Unknown status: %s.\n' % status)
-        return False
+        return (False, False)
 
     # Setup config filesm if necessary
     prepare_configs(service, pkg_log)
 
     # The service is available but has not started yet (or the corresponding
     # process has already exited), try to start it.
-    ret = subprocess.call(['sudo', 'systemctl', 'start', service],
-                          stdout=pkg_log)
-    if ret != 0:
+    if not run_unit_job('start', service, pkg_log):
         pkg_log.write('Failed to start service \"%s\".\n' % service)
         pkg_log.write('Status:\n')
         pkg_log.flush()
         subprocess.call(['sudo', 'systemctl', 'status', service],
                         stdout=pkg_log)
-        return False
+        return (False, False)
 
     status = get_status(service, pkg_log)
     success = True
@@ -378,21 +1000,59 @@ def do_check(service, pkg_log):
                         stdout=pkg_log)
         success = False
 
-    # Stop the service
-    ret = subprocess.call(['sudo', 'systemctl', 'stop', service],
-                          stdout=pkg_log)
-    if ret != 0:
+    return (success, True)
+
+
+def stop_service(service, pkg_log):
+    '''Stop the given service. Returns False on failure, True otherwise.'''
+    if not run_unit_job('stop', service, pkg_log):
         pkg_log.write('Failed to stop service \"%s\".\n' % service)
         return False
+    return True
+
+
+def do_check(service, pkg_log):
+    '''Check the given service if it is not already active.
 
+    If the service is not already active, try to activate it and check the
+    status.
+
+    Returns False on failure, True otherwise.
+    '''
+    (success, started) = start_service(service, pkg_log)
+    if started and not stop_service(service, pkg_log):
+        return False
     return success
 
 
 # main
 if __name__ == '__main__':
-    if len(sys.argv) != 2:
-        print 'Usage: '
-        print '\t' + sys.argv[0] + ' <packages_list_file>'
+    parser = OptionParser(usage='%prog [options] <packages_list_file>')
+    parser.add_option('-b', '--batch', type='int', default=1,
+                      help='number of packages to install and remove in one '
+                           'yum transaction (default: %default); packages '
+                           'are installed one by one if the transaction fails')
+    parser.add_option('-j', '--jobs', type='int', default=1,
+                      help='number of services of a package to start at '
+                           'once (default: %default); the services ordered '
+                           'after each other or conflicting with each other '
+                           'are never started together')
+    parser.add_option('--journal-dump', action='store_true',
+                      help='write the whole journal of the current boot to '
+                           'journalctl_ab.log at the end; the journal '
+                           'entries of each service are written to the log '
+                           'of its package anyway')
+    parser.add_option('--no-dbus', action='store_true',
+                      help='manage the services with systemctl rather than '
+                           'over D-Bus')
+    parser.add_option('-i', '--index', metavar='FILE',
+                      help='index of the .service files of the packages '
+                           'prepared from the repository metadata; the '
+                           'packages having none are skipped without '
+                           'installation')
+    (options, args) = parser.parse_args()
+    if len(args) != 1:
+        parser.print_usage()
         sys.exit(1)
 
     my_out = SyncedOut(sys.stdout)
@@ -401,20 +1061,33 @@ if __name__ == '__main__':
     print 'Started at', datetime.today()
 
     fnames = [RES_FAILED_TO_INSTALL, RES_FAILED_TO_REMOVE,
-              RES_FAILED_TO_CHECK, RES_FAILED, RES_SUCCEEDED, RES_SKIPPED]
+              RES_FAILED_TO_CHECK, RES_FAILED, RES_SUCCEEDED, RES_SKIPPED,
+              RES_RECORDS, RES_SPANS]
     for fname in fnames:
         if os.path.exists(fname):
             os.remove(fname)
 
+    # systemd of the host has nothing to do with a fake root
+    if not options.no_dbus and not ROOT:
+        systemd = connect_systemd()
+
     installed = get_installed_list()
     print 'Installed:', len(installed)
 
-    available_file = sys.argv[1]
-    print 'Processing the packages listed in \'%s\'' % available_file
-    check_packages(available_file, installed)
+    index = None
+    if options.index:
+        index = read_index(options.index)
 
-    journal = os.path.join(RESULT_DIR, 'journalctl_ab.log')
-    with open(journal, 'w') as jrnl:
-        subprocess.call(['sudo', 'journalctl', '-ab'], stdout=jrnl)
+    available_file = args[0]
+    print 'Processing the packages listed in \'%s\'' % available_file
+    check_packages(available_file, installed, max(options.batch, 1), index,
+                   max(options.jobs, 1))
+    if systemd is not None:
+        systemd.close()
+
+    if options.journal_dump:
+        journal = os.path.join(RESULT_DIR, 'journalctl_ab.log')
+        with open(journal, 'w') as jrnl:
+            subprocess.call(['sudo', 'journalctl', '-ab'], stdout=jrnl)
 
     print 'Completed at', datetime.today()
@@ -0,0 +1,308 @@
+#!/usr/bin/python3
+
+# Copyright (c) 2017-2021, Virtuozzo International GmbH
+#
+# Our contact details: Virtuozzo International GmbH, Vordergasse 59, 8200
+# Schaffhausen, Switzerland.
+
+# Collector of the core dumps of the checked applications: a pipe handler
+# for /proc/sys/kernel/core_pattern.
+#
+# The kernel runs the handler on the host with the core on stdin, while the
+# crashed process is kept around, so the handler reads its environment. The
+# apps checker tags the applications with the environment variables below:
+# the package and the command under test, the directory (inside the chroot
+# of the application) to put the core to and what to keep of it. The cores
+# of untagged processes are dropped.
+#
+# The handler runs as root on the host for every crashing process, so it
+# trusts nothing in that environment: only the processes chrooted into a
+# mock chroot of the autotests (see CHROOT_RE) are handled, the directory
+# must be in /tmp/results of that chroot (RESULT_DIR) and the files are
+# created there relative to the opened directory, never following symlinks
+# or reusing existing files.
+#
+# For a process with PID <pid> the handler first writes core.<pid>.json
+# with the details of the crash, so the checker sees the crash at once,
+# then either streams the core (at most the given number of megabytes of
+# it) through zstd (gzip if zstd is not available) to core.<pid>.zst, or
+# only extracts the backtrace with gdb, if installed. The mapped modules of
+# the process are listed in core.<pid>.json anyway. Its 'status' is 'done'
+# when the handler has finished.
+#
+# Usage:
+#       python3 collect_core.py --install
+# registers the handler (as root), saving the previous core_pattern,
+#       python3 collect_core.py --uninstall
+# restores the previous one.
+
+import argparse
+import gzip
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import time
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+CORE_PATTERN_FILE = '/proc/sys/kernel/core_pattern'
+# Number of the cores piped to the handlers at once; unless it is not 0, the
+# kernel does not keep the crashed processes for the handlers
+CORE_PIPE_LIMIT_FILE = '/proc/sys/kernel/core_pipe_limit'
+CORE_PIPE_LIMIT = 16
+# The core_pattern and core_pipe_limit replaced by --install are kept here
+SAVED_PATH = '/var/lib/vzlinux-autotest/core_pattern.json'
+
+# The chroots of the autotests, see chroot_dir() in launcher.py
+CHROOT_RE = re.compile(r'^/var/lib/mock/[\w.+-]+-autotest-x86_64(-slot\d+)?/root$')
+# The directory of the results in a chroot, the cores are saved in it
+RESULT_DIR = '/tmp/results'
+
+# Files are created only, never replaced or followed if they are symlinks
+CREATE_FLAGS = os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_NOFOLLOW | os.O_CLOEXEC
+
+# Environment variables the applications are tagged with by the checker
+ENV_PACKAGE = 'AUTOTEST_PACKAGE'
+ENV_COMMAND = 'AUTOTEST_COMMAND'
+ENV_DIR = 'AUTOTEST_CORE_DIR'
+# 'full' - keep the (compressed) core, 'backtrace' - the backtrace only
+ENV_MODE = 'AUTOTEST_CORE_MODE'
+# Limit for the size of the core, in megabytes
+ENV_LIMIT = 'AUTOTEST_CORE_LIMIT'
+DEFAULT_LIMIT = 256
+
+COMPRESSION_LEVEL = 3
+READ_CHUNK = 1024 * 1024
+# How long (in seconds) gdb may take to extract the backtrace
+GDB_TIMEOUT = 60
+
+
+def handler_pattern():
+    '''Returns core_pattern value to run this handler.'''
+    return '|%s %s %%P %%s %%t %%e' % (sys.executable, os.path.abspath(__file__))
+
+
+def read_proc(path):
+    with open(path, 'r') as f:
+        return f.read().strip()
+
+
+def write_proc(path, value):
+    with open(path, 'w') as f:
+        f.write(value + '\n')
+
+
+def install():
+    pattern = read_proc(CORE_PATTERN_FILE)
+    if pattern != handler_pattern():
+        with open(SAVED_PATH, 'w') as f:
+            json.dump({'core_pattern': pattern,
+                       'core_pipe_limit': read_proc(CORE_PIPE_LIMIT_FILE)}, f)
+    write_proc(CORE_PIPE_LIMIT_FILE, str(CORE_PIPE_LIMIT))
+    write_proc(CORE_PATTERN_FILE, handler_pattern())
+
+
+def uninstall():
+    if read_proc(CORE_PATTERN_FILE) != handler_pattern() or not os.path.exists(SAVED_PATH):
+        return
+    with open(SAVED_PATH, 'r') as f:
+        saved = json.load(f)
+    write_proc(CORE_PATTERN_FILE, saved['core_pattern'])
+    write_proc(CORE_PIPE_LIMIT_FILE, saved['core_pipe_limit'])
+    os.remove(SAVED_PATH)
+
+
+def read_environ(pid):
+    '''Returns the environment of the process as a dict.'''
+    with open('/proc/%d/environ' % pid, 'rb') as f:
+        data = f.read().decode('utf-8', 'replace')
+    env = {}
+    for item in data.split('\0'):
+        (name, sep, value) = item.partition('=')
+        if sep:
+            env[name] = value
+    return env
+
+
+def mapped_modules(pid):
+    '''Returns the paths of the files mapped by the process, in the order of
+    their addresses.'''
+    modules = []
+    with open('/proc/%d/maps' % pid, 'r') as f:
+        for line in f:
+            fields = line.split(None, 5)
+            if len(fields) == 6 and fields[5].startswith('/'):
+                path = fields[5].strip()
+                if path not in modules:
+                    modules.append(path)
+    return modules
+
+
+def core_dir(pid, env):
+    '''Returns the path to the directory (on the host) to save the core of
+    the process to, None if the process is not checked in a chroot of the
+    autotests or the directory is not in RESULT_DIR of the chroot.'''
+    try:
+        root = os.readlink('/proc/%d/root' % pid)
+    except OSError:
+        return None
+    if not CHROOT_RE.match(root):
+        return None
+    base = os.path.realpath(root + RESULT_DIR)
+    path = os.path.realpath(root + '/' + env[ENV_DIR].lstrip('/'))
+    if os.path.dirname(path) != base:
+        return None
+    return path
+
+
+def open_dir(path):
+    '''Returns the descriptor of the directory, making sure it is 'path'
+    itself, not a symlink put in place of it meanwhile.'''
+    fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY | os.O_NOFOLLOW | os.O_CLOEXEC)
+    if os.readlink('/proc/self/fd/%d' % fd) != path:
+        os.close(fd)
+        raise OSError('%s has been replaced' % path)
+    return fd
+
+
+def create(dir_fd, name, mode='wb'):
+    '''Create a new file in the directory, fails if it exists.'''
+    return os.fdopen(os.open(name, CREATE_FLAGS, 0o644, dir_fd=dir_fd), mode)
+
+
+def write_info(dir_fd, name, info):
+    '''Write the details of the crash so that the checker never sees them
+    partially written.'''
+    tmp = '.' + name
+    with create(dir_fd, tmp, 'w') as f:
+        json.dump(info, f, indent=1, sort_keys=True)
+    os.rename(tmp, name, src_dir_fd=dir_fd, dst_dir_fd=dir_fd)
+
+
+def save_core(src, dir_fd, name, limit, compress=True):
+    '''Copy at most 'limit' bytes of the core from 'src' to the new file
+    'name' in the directory, through zstd (or gzip) if 'compress' is set.
+
+    Returns (name of the file written, number of the bytes of the core
+    saved, whether the core has been truncated).
+    '''
+    proc = None
+    if not compress:
+        out = create(dir_fd, name)
+    elif zstandard is not None:
+        name += '.zst'
+        out = zstandard.ZstdCompressor(level=COMPRESSION_LEVEL).stream_writer(
+            create(dir_fd, name))
+    elif shutil.which('zstd'):
+        name += '.zst'
+        with create(dir_fd, name) as f:
+            proc = subprocess.Popen(['zstd', '-q', '-c', '-%d' % COMPRESSION_LEVEL],
+                                    stdin=subprocess.PIPE, stdout=f)
+        out = proc.stdin
+    else:
+        name += '.gz'
+        out = gzip.GzipFile(fileobj=create(dir_fd, name), mode='wb',
+                            compresslevel=COMPRESSION_LEVEL)
+
+    size = 0
+    try:
+        while size < limit:
+            chunk = src.read(min(READ_CHUNK, limit - size))
+            if not chunk:
+                break
+            out.write(chunk)
+            size += len(chunk)
+    finally:
+        out.close()
+        if proc:
+            proc.wait()
+    # The rest of the core is not read, the kernel stops dumping it then
+    return (name, size, size >= limit and len(src.read(1)) > 0)
+
+
+def backtrace(pid, core):
+    '''Returns the backtraces of all the threads of the crashed process from
+    its core (None if gdb is not available). The executable and the
+    libraries are taken from the root of the process.'''
+    gdb = shutil.which('gdb')
+    if not gdb:
+        return None
+    try:
+        out = subprocess.run([gdb, '-batch', '-nx', '-ex', 'set sysroot /proc/%d/root' % pid,
+                              '-ex', 'thread apply all bt', '/proc/%d/exe' % pid, core],
+                             stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                             stdin=subprocess.DEVNULL, timeout=GDB_TIMEOUT)
+    except subprocess.TimeoutExpired:
+        return 'gdb has not finished in %d seconds' % GDB_TIMEOUT
+    return out.stdout.decode('utf-8', 'replace')
+
+
+def collect(pid, sig, timestamp, comm):
+    '''Save the core of the process from stdin, if it is tagged and checked
+    in a chroot of the autotests.'''
+    env = read_environ(pid)
+    if ENV_DIR not in env:
+        return
+    dest = core_dir(pid, env)
+    if dest is None:
+        return
+    dir_fd = open_dir(dest)
+    info_name = 'core.%d.json' % pid
+    info = {'pid': pid, 'signal': sig, 'time': timestamp, 'comm': comm,
+            'package': env.get(ENV_PACKAGE), 'command': env.get(ENV_COMMAND),
+            'mode': env.get(ENV_MODE, 'full'), 'status': 'dumping'}
+    try:
+        write_info(dir_fd, info_name, info)
+        try:
+            info['modules'] = mapped_modules(pid)
+            limit = int(env.get(ENV_LIMIT, DEFAULT_LIMIT)) * 1024 * 1024
+            if info['mode'] == 'backtrace':
+                # gdb needs the core as a file, it is removed afterwards
+                tmp = '.core.%d' % pid
+                (_, info['size'], info['truncated']) = save_core(sys.stdin.buffer, dir_fd, tmp,
+                                                                 limit, compress=False)
+                info['backtrace'] = backtrace(pid, os.path.join(dest, tmp))
+                os.remove(tmp, dir_fd=dir_fd)
+            else:
+                (info['core'], info['size'], info['truncated']) = save_core(
+                    sys.stdin.buffer, dir_fd, 'core.%d' % pid, limit)
+            info['status'] = 'done'
+        except Exception as e:
+            info['status'] = 'failed'
+            info['error'] = str(e)
+        info['duration'] = time.time() - timestamp
+        write_info(dir_fd, info_name, info)
+    finally:
+        os.close(dir_fd)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Collect the core dumps of the checked "
+                                                 "applications")
+    parser.add_argument('--install', action='store_true',
+                               help='Register the handler in %s' % CORE_PATTERN_FILE)
+    parser.add_argument('--uninstall', action='store_true',
+                               help='Restore the core_pattern replaced by --install')
+    parser.add_argument('crash', action='store', nargs='*',
+                               help='PID, signal, time and name of the crashed process '\
+                                    '(given by the kernel)')
+    cmdline = parser.parse_args(sys.argv[1:])
+
+    if cmdline.install:
+        install()
+    elif cmdline.uninstall:
+        uninstall()
+    elif len(cmdline.crash) >= 4:
+        # The kernel splits the expanded pattern on spaces, so the name
+        # (the last argument) may come in several pieces
+        (pid, sig, timestamp) = cmdline.crash[:3]
+        collect(int(pid), int(sig), int(timestamp), ' '.join(cmdline.crash[3:]))
+    else:
+        parser.print_usage()
+        sys.exit(1)
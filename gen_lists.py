@@ -0,0 +1,94 @@
+#!/usr/bin/python3
+
+# Copyright (c) 2017-2021, Virtuozzo International GmbH
+#
+# Our contact details: Virtuozzo International GmbH, Vordergasse 59, 8200
+# Schaffhausen, Switzerland.
+
+# Generates the candidate desktop-vlN.list and service-vlN.list files for a
+# target from the metadata of its repositories: every package whose latest
+# version has a file matching re_desktop (re_service) gets into the desktop
+# (service) list. The difference against the committed lists is printed.
+#
+# Only filelists metadata is read, as a stream, and only the names and the
+# matching files of the packages are kept in memory.
+
+import argparse
+import difflib
+import os
+import sys
+
+import repodata
+
+# Lists to generate, with the regexps for the files the checkers look for
+LISTS = [('desktop', repodata.re_desktop), ('service', repodata.re_service)]
+
+
+def list_name(kind, target):
+    '''Returns file name of the list of the given kind for the target,
+    e.g. desktop-vl8.list for vzlinux-8.'''
+    return '%s-vl%s.list' % (kind, target.split('-')[-1])
+
+
+def read_list(path):
+    '''Returns names of the packages from the given file as a list.'''
+    with open(path, 'r') as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def print_diff(old_path, new_path, old, new):
+    '''Print the difference between the lists as a unified diff of sorted
+    names, followed by a summary.'''
+    for line in difflib.unified_diff(sorted(old), sorted(new), old_path,
+                                     new_path, lineterm=''):
+        print(line)
+    print('%s: %d package(s), %d new, %d dropped' %
+          (new_path, len(new), len(set(new) - set(old)), len(set(old) - set(new))))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Generate lists of the packages to check from repository metadata')
+    parser.add_argument('target', action='store', choices=['vzlinux-6', 'vzlinux-7', 'vzlinux-8'])
+    parser.add_argument('-r', '--repo', action='append',
+                               help='Base URL of a repository of the target. This option '\
+                                    'can be specified more than once. By default, the '\
+                                    'repositories from the autotest mock config are used.')
+    parser.add_argument('-l', '--list-dir', action='store',
+                               default=os.path.dirname(os.path.abspath(__file__)),
+                               help='Directory with the committed lists to compare '\
+                                    'with (default: %(default)s)')
+    parser.add_argument('-o', '--output-dir', action='store', default='.',
+                               help='Directory to write the generated lists to, the '\
+                                    'committed lists are refreshed if it is the same as '\
+                                    '--list-dir (default: %(default)s)')
+    parser.add_argument('--cache-dir', action='store', default=repodata.METADATA_DIR,
+                               help='Directory to keep downloaded metadata in '\
+                                    '(default: %(default)s)')
+    cmdline = parser.parse_args(sys.argv[1:])
+
+    try:
+        urls = cmdline.repo or repodata.mock_repos(cmdline.target + '-autotest-x86_64')
+        metadata = [repodata.fetch_repodata(url, cmdline.cache_dir) for url in urls]
+    except (OSError, repodata.Error) as e:
+        print('Cannot load repository metadata: %s' % str(e))
+        sys.exit(1)
+    if not all('filelists' in md for md in metadata):
+        print('Some repositories have no filelists metadata')
+        sys.exit(1)
+
+    files = repodata.latest_files([md['filelists'] for md in metadata],
+                                  [regexp for (kind, regexp) in LISTS])
+
+    for (i, (kind, regexp)) in enumerate(LISTS):
+        name = list_name(kind, cmdline.target)
+        old_path = os.path.join(cmdline.list_dir, name)
+        new_path = os.path.join(cmdline.output_dir, name)
+        if not os.path.exists(old_path):
+            # E.g. services are not checked on VzLinux 6
+            continue
+        old = read_list(old_path)
+        new = sorted(pkg for pkg in files if files[pkg][i])
+        print_diff(old_path, new_path, old, new)
+        with open(new_path, 'w') as f:
+            f.write(''.join(pkg + '\n' for pkg in new))
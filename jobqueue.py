@@ -0,0 +1,293 @@
+#!/usr/bin/python3
+
+# Copyright (c) 2017-2021, Virtuozzo International GmbH
+#
+# Our contact details: Virtuozzo International GmbH, Vordergasse 59, 8200
+# Schaffhausen, Switzerland.
+
+# The queue of the test jobs: an SQLite database with a row per package to
+# check in a mode (apps or services) on a target, a row per running
+# launcher instance, a row per claimed chroot slot and a row per runner
+# collecting the core dumps of the applications (see collect_core.py).
+#
+# Every launcher instance submits its packages to the queue. A package
+# already queued for the same target and mode is not queued again, only its
+# priority is raised. Then the instance becomes the runner of the target and
+# mode, unless there is one already: the runner takes all the queued jobs of
+# its target and mode as one batch, checks them and repeats until the queue
+# is empty, so a burst of submissions is checked in as few runs as possible.
+#
+# Chroot slots are claimed by the runners one by one, so runners of
+# different modes of a target (and of different targets) can work at once
+# as long as they use different slots.
+#
+# Runners and slots of dead processes are taken over, jobs they were
+# running are queued again.
+#
+# Usage:
+#       python3 jobqueue.py [options]
+# prints the queued and running jobs.
+
+import argparse
+import os
+import sqlite3
+import sys
+import time
+from contextlib import contextmanager
+
+DB_PATH = '/var/lib/vzlinux-autotest/queue.db'
+
+# How long (in seconds) to wait for a lock held by another writer.
+BUSY_TIMEOUT = 60
+
+# Job states
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+
+# Jobs finished earlier than this (in seconds) are removed from the queue.
+DONE_TTL = 7 * 24 * 3600
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    target TEXT NOT NULL,
+    mode TEXT NOT NULL,
+    package TEXT NOT NULL,
+    priority INTEGER NOT NULL DEFAULT 0,
+    state TEXT NOT NULL,
+    owner INTEGER,
+    submitted REAL NOT NULL,
+    started REAL,
+    finished REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs (target, mode, state);
+
+CREATE TABLE IF NOT EXISTS runners (
+    target TEXT NOT NULL,
+    mode TEXT NOT NULL,
+    pid INTEGER NOT NULL,
+    started REAL NOT NULL,
+    PRIMARY KEY (target, mode)
+);
+
+CREATE TABLE IF NOT EXISTS slots (
+    target TEXT NOT NULL,
+    slot INTEGER NOT NULL,
+    pid INTEGER NOT NULL,
+    mode TEXT NOT NULL,
+    PRIMARY KEY (target, slot)
+);
+
+CREATE TABLE IF NOT EXISTS core_users (
+    pid INTEGER PRIMARY KEY
+);
+'''
+
+
+def connect(path=None):
+    '''Returns a new connection to the queue (DB_PATH by default), creating
+    it if needed. Transactions are started explicitly, see transaction().'''
+    conn = sqlite3.connect(path or DB_PATH, timeout=BUSY_TIMEOUT,
+                           isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.executescript(SCHEMA)
+    return conn
+
+
+@contextmanager
+def transaction(conn):
+    '''Run the enclosed block in a write transaction, so that the launcher
+    instances see the queue changed by each other atomically.'''
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        yield
+    except BaseException:
+        conn.execute('ROLLBACK')
+        raise
+    conn.execute('COMMIT')
+
+
+def alive(pid):
+    '''Check if the process with the given PID exists.'''
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def submit(conn, target, mode, pkgs, priority=0):
+    '''Queue the packages for checking. Returns the number of the packages
+    which have not been queued before.'''
+    now = time.time()
+    added = 0
+    with transaction(conn):
+        for pkg in pkgs:
+            row = conn.execute('SELECT id, priority FROM jobs WHERE target = ? AND mode = ? '
+                               'AND package = ? AND state = ?',
+                               (target, mode, pkg, QUEUED)).fetchone()
+            if row:
+                if priority > row['priority']:
+                    conn.execute('UPDATE jobs SET priority = ? WHERE id = ?',
+                                 (priority, row['id']))
+                continue
+            conn.execute('INSERT INTO jobs (target, mode, package, priority, state, submitted) '
+                         'VALUES (?, ?, ?, ?, ?, ?)',
+                         (target, mode, pkg, priority, QUEUED, now))
+            added += 1
+        conn.execute('DELETE FROM jobs WHERE state = ? AND finished < ?',
+                     (DONE, now - DONE_TTL))
+    return added
+
+
+def become_runner(conn, target, mode):
+    '''Make this process the runner of the target and mode, unless another
+    live process is. Returns True on success.'''
+    with transaction(conn):
+        row = conn.execute('SELECT pid FROM runners WHERE target = ? AND mode = ?',
+                           (target, mode)).fetchone()
+        if row and row['pid'] != os.getpid() and alive(row['pid']):
+            return False
+        conn.execute('INSERT OR REPLACE INTO runners (target, mode, pid, started) '
+                     'VALUES (?, ?, ?, ?)', (target, mode, os.getpid(), time.time()))
+        # Jobs of the dead runner are checked once more
+        conn.execute('UPDATE jobs SET state = ?, owner = NULL, started = NULL '
+                     'WHERE target = ? AND mode = ? AND state = ?',
+                     (QUEUED, target, mode, RUNNING))
+    return True
+
+
+def resign(conn, target, mode, force=False):
+    '''Stop being the runner of the target and mode if there are no queued
+    jobs left for it (or anyway, if 'force' is set). Returns True on
+    success, False if the runner should take the queued jobs.'''
+    with transaction(conn):
+        if not force:
+            row = conn.execute('SELECT COUNT(*) FROM jobs WHERE target = ? AND mode = ? '
+                               'AND state = ?', (target, mode, QUEUED)).fetchone()
+            if row[0]:
+                return False
+        conn.execute('DELETE FROM runners WHERE target = ? AND mode = ? AND pid = ?',
+                     (target, mode, os.getpid()))
+    return True
+
+
+def take_jobs(conn, target, mode):
+    '''Mark all the queued jobs of the target and mode as running by this
+    process. Returns the names of their packages, the ones with higher
+    priority first, then in the order of submission.'''
+    with transaction(conn):
+        rows = conn.execute('SELECT id, package FROM jobs WHERE target = ? AND mode = ? '
+                            'AND state = ? ORDER BY priority DESC, submitted, id',
+                            (target, mode, QUEUED)).fetchall()
+        conn.execute('UPDATE jobs SET state = ?, owner = ?, started = ? '
+                     'WHERE target = ? AND mode = ? AND state = ?',
+                     (RUNNING, os.getpid(), time.time(), target, mode, QUEUED))
+    return [row['package'] for row in rows]
+
+
+def priorities(conn, target, mode):
+    '''Returns a dict mapping names of the packages of the jobs of the target
+    and mode run by this process to their priorities.'''
+    rows = conn.execute('SELECT package, priority FROM jobs WHERE target = ? AND mode = ? '
+                        'AND state = ? AND owner = ?',
+                        (target, mode, RUNNING, os.getpid())).fetchall()
+    return dict((row['package'], row['priority']) for row in rows)
+
+
+def finish_jobs(conn, target, mode):
+    '''Mark the jobs of the target and mode run by this process as done.'''
+    with transaction(conn):
+        conn.execute('UPDATE jobs SET state = ?, finished = ? WHERE target = ? AND mode = ? '
+                     'AND state = ? AND owner = ?',
+                     (DONE, time.time(), target, mode, RUNNING, os.getpid()))
+
+
+def pending(conn, target, mode):
+    '''Returns the rows of the queued and running jobs of the target and
+    mode, the running ones first, then in the order they are taken.'''
+    return conn.execute('SELECT * FROM jobs WHERE target = ? AND mode = ? AND state != ? '
+                        'ORDER BY state = ?, priority DESC, submitted, id',
+                        (target, mode, DONE, QUEUED)).fetchall()
+
+
+def use_cores(conn, install):
+    '''Register this process as a user of the core dump collector, then
+    call 'install' to set the collector up.'''
+    with transaction(conn):
+        conn.execute('INSERT OR REPLACE INTO core_users (pid) VALUES (?)', (os.getpid(),))
+        install()
+
+
+def release_cores(conn, uninstall):
+    '''Unregister this process and the dead ones as users of the core dump
+    collector and call 'uninstall' if some were unregistered and no users
+    are left. Every runner calls this on exit, so the collector is removed
+    even if its last user has been killed.
+
+    The users are registered and unregistered in the same transactions as
+    the collector is set up and removed, so they never race.
+    '''
+    with transaction(conn):
+        pids = [row['pid'] for row in conn.execute('SELECT pid FROM core_users')]
+        gone = [pid for pid in pids if pid == os.getpid() or not alive(pid)]
+        conn.executemany('DELETE FROM core_users WHERE pid = ?', [(pid,) for pid in gone])
+        if gone and len(gone) == len(pids):
+            uninstall()
+
+
+def claim_slots(conn, target, mode, candidates, count):
+    '''Claim up to 'count' free chroot slots of the target from
+    'candidates' (in their order). Returns the list of the claimed slots.'''
+    claimed = []
+    with transaction(conn):
+        taken = {}
+        for row in conn.execute('SELECT slot, pid FROM slots WHERE target = ?', (target,)):
+            taken[row['slot']] = row['pid']
+        for slot in candidates:
+            if len(claimed) >= count:
+                break
+            if slot in taken and alive(taken[slot]):
+                continue
+            conn.execute('INSERT OR REPLACE INTO slots (target, slot, pid, mode) '
+                         'VALUES (?, ?, ?, ?)', (target, slot, os.getpid(), mode))
+            claimed.append(slot)
+    return claimed
+
+
+def release_slots(conn, target, slots):
+    with transaction(conn):
+        conn.executemany('DELETE FROM slots WHERE target = ? AND slot = ? AND pid = ?',
+                         [(target, slot, os.getpid()) for slot in slots])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Show the queue of the test jobs")
+    parser.add_argument('--db', action='store', default=DB_PATH,
+                               help='Path to the queue (default: %(default)s)')
+    parser.add_argument('-t', '--target', action='store')
+    parser.add_argument('-a', '--all', action='store_true',
+                               help='Show the finished jobs as well')
+    cmdline = parser.parse_args(sys.argv[1:])
+
+    conn = connect(cmdline.db)
+    for row in conn.execute('SELECT * FROM runners ORDER BY target, mode'):
+        if not cmdline.target or row['target'] == cmdline.target:
+            print('runner %s %s: pid %d%s' % (row['target'], row['mode'], row['pid'],
+                                              '' if alive(row['pid']) else ' (dead)'))
+    for row in conn.execute('SELECT * FROM slots ORDER BY target, slot'):
+        if not cmdline.target or row['target'] == cmdline.target:
+            print('slot %s %d: %s, pid %d' % (row['target'], row['slot'], row['mode'],
+                                              row['pid']))
+    query = 'SELECT * FROM jobs'
+    if not cmdline.all:
+        query += " WHERE state != 'done'"
+    for row in conn.execute(query + ' ORDER BY priority DESC, submitted, id'):
+        if not cmdline.target or row['target'] == cmdline.target:
+            print('%s %s %s %s %s priority %d' % (
+                time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(row['submitted'])),
+                row['target'], row['mode'], row['package'], row['state'], row['priority']))
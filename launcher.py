@@ -12,125 +12,1596 @@ import tempfile
 import os
 import time
 import shutil
-from lockfile import LockFile, LockTimeout
+import queue
+import threading
+import hashlib
+import itertools
+import json
+import re
+import signal
+import socketserver
+import traceback
 
-def init_chroot(target):
+# Helper modules are installed along with the checkers
+sys.path.append('/usr/share/vzlinux-autotest')
+import archive
+import jobqueue
+import repodata
+import resultstore
+import timing
+
+# Mock keeps its chroots here
+MOCK_DIR = '/var/lib/mock/'
+# Test results are collected here, per target and per package
+LOG_DIR = '/var/log/vzlinux-autotests/'
+# Checkers and package lists are installed here
+AUTOTEST_DIR = '/usr/share/vzlinux-autotest/'
+
+# Host directories bind-mounted into a chroot (in mount order)
+BIND_MOUNTS = ['/proc', '/dev', '/dev/shm', '/dev/pts']
+
+# The apps checker runs every application in a cgroup of its own under the
+# cgroup of its chroot slot, CGROUP_NAME/<target>-<slot> in the cgroup v2
+# hierarchy of the host, which is bind-mounted to CGROUP_MOUNT in the chroot;
+# the controllers to account the applications by are enabled for it.
+CGROUP_NAME = 'vzlinux-autotest'
+CGROUP_MOUNT = '/sys/fs/cgroup'
+CGROUP_CONTROLLERS = ['cpu', 'memory', 'pids']
+
+# Packages downloaded in chroots are collected here, per target, and served
+# back to the chroots as a local repository
+CACHE_DIR = '/var/cache/vzlinux-autotest/'
+CACHE_REPO = 'vzlinux-autotest-cache'
+# Yum configuration files in a chroot the cache repository is added to
+YUM_CONFIGS = ['/etc/yum.conf', '/etc/yum/yum.conf', '/etc/dnf/dnf.conf']
+# Package caches of yum and dnf in a chroot
+YUM_CACHES = ['/var/cache/yum', '/var/cache/dnf']
+# Metadata of the remote repositories fetched by yum in the chroots is kept
+# here, per target, and copied into every new chroot of the target
+YUM_METADATA_DIR = CACHE_DIR + 'chroot-metadata/'
+# Default limit for the size of the package cache of a target, in megabytes
+CACHE_SIZE = 10240
+
+# Keys and results of the packages that passed the checks are kept here, per
+# target and mode, see result_keys()
+STATE_DIR = '/var/lib/vzlinux-autotest/'
+# Only these results are remembered, other packages are always rechecked
+CACHED_RESULTS = ['succeeded', 'skipped']
+# The services checker runs right on the host and leaves its results here
+SERVICE_RESULT_DIR = '/tmp/results/'
+CHECKERS = {'apps': 'check_apps_in_chroot.py',
+            'services': 'check_services_in_vm.py'}
+
+# Timing spans of the runs are kept here, see timing.py
+SPANS_DIR = STATE_DIR + 'spans/'
+# Archives of the finished runs are kept here, see archive.py
+ARCHIVE_DIR = LOG_DIR + 'archive/'
+
+# Ways to make a throwaway copy of a chroot, in order of preference
+SNAPSHOT_METHODS = ['overlay', 'reflink', 'hardlink']
+# Directories of a chroot with files modified in place (the rpm database,
+# the history and the metadata caches of yum/dnf, configs): a hardlink farm
+# gets their real copies, otherwise the changes would leak into the base
+HARDLINK_COPIED = ['/var/lib/rpm', '/var/lib/yum', '/var/lib/dnf', '/etc'] + YUM_CACHES
+
+# Packages needed to boot a chroot as a systemd-nspawn container and run the
+# services checker in it; the other targets (vzlinux-6) use SysV init and
+# cannot be booted so
+NSPAWN_PACKAGES = {
+    'vzlinux-7': ['systemd', 'dbus', 'sudo', 'python', 'python-psutil',
+                  'dbus-python', 'pygobject2'],
+    'vzlinux-8': ['systemd', 'dbus', 'sudo', 'python2', 'python2-psutil'],
+}
+# How long (in seconds) to wait for a container to boot and to power off
+NSPAWN_BOOT_TIMEOUT = 120
+NSPAWN_STOP_TIMEOUT = 60
+
+# Chroot slots of a target to claim from the job queue (see jobqueue.py);
+# services checked on the host use the pseudo slot HOST_SLOT
+MAX_SLOTS = 16
+HOST_SLOT = -1
+# How often (in seconds) to look for a free slot if all are claimed
+SLOT_POLL_INTERVAL = 5
+
+# X display used by the checker in the first chroot slot; every next slot
+# gets its own range of displays so that X servers of different slots never
+# clash on the (network namespace wide) abstract X sockets.
+DISPLAY_BASE = 99
+DISPLAYS_PER_SLOT = 10
+
+# Printed by the apps checker running with --serve when it is done with a
+# request, must match SERVE_DONE in check_apps_in_chroot.py
+CHECKER_DONE = '@@autotest-done@@'
+# How long (in seconds) to wait for such a checker to exit
+CHECKER_STOP_TIMEOUT = 60
+
+# Core dumps of the crashed applications are collected by collect_core.py
+# (--cores), see CORE_MODES in check_apps_in_chroot.py
+CORE_MODES = ['full', 'backtrace']
+CORE_LIMIT = 256
+
+# Expected duration (in seconds) of the check of a package if no package of
+# the run has been checked before, see expected_durations()
+DEFAULT_DURATION = 30
+# Packages taking more than SLOW_FACTOR times as long as expected are reported
+# after a run, at most SLOW_REPORTED of them
+SLOW_FACTOR = 2
+SLOW_REPORTED = 5
+
+# How often (in seconds) the daemon looks for the packages queued by other
+# instances of the launcher and the log of a package is polled for the
+# clients following it
+DAEMON_POLL_INTERVAL = 1
+
+
+# Timing spans of the phases of this run
+spans = timing.Recorder()
+
+
+def mock_config(target):
+    return target + '-autotest-x86_64'
+
+def mock_cmd(target, slot=0, config=None):
+    '''Returns mock command line for the given chroot slot of the target.
+
+    Slot 0 is the usual mock chroot, other slots are its independent copies
+    created by means of mock's --uniqueext option. 'config' is the path to
+    the mock config to use instead of the one of the target, see
+    cache_mock_config().
+    '''
+    cmd = ['sudo', 'mock', '-r', config or mock_config(target)]
+    if slot:
+        cmd.append('--uniqueext=slot%d' % slot)
+    return cmd
+
+def slot_dir(target, slot=0):
+    name = mock_config(target)
+    if slot:
+        name += '-slot%d' % slot
+    return MOCK_DIR + name
+
+def chroot_dir(target, slot=0):
+    return slot_dir(target, slot) + '/root'
+
+def cache_dir(target):
+    return CACHE_DIR + target
+
+def cgroup2_root():
+    '''Returns the mount point of the cgroup v2 hierarchy of the host, None if
+    it is not mounted.'''
+    with open('/proc/mounts', 'r') as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) > 2 and fields[2] == 'cgroup2':
+                return fields[1]
+    return None
+
+def slot_cgroup(target, slot):
+    '''Returns the path to the cgroup of the chroot slot on the host, None if
+    cgroup v2 is not available.'''
+    root = cgroup2_root()
+    if root is None:
+        return None
+    return '%s/%s/%s-%d' % (root, CGROUP_NAME, target, slot)
+
+def setup_cgroup(target, slot):
+    '''Create the cgroup of the chroot slot, see CGROUP_NAME. The chroot gets
+    it in mount_chroot().
+
+    Returns False if cgroup v2 is not available, True otherwise.
+    '''
+    path = slot_cgroup(target, slot)
+    if path is None:
+        return False
+    subprocess.call(['sudo', 'mkdir', '-p', path])
+    if not os.path.isdir(path):
+        return False
+    # A controller is available in a cgroup if it is enabled in the
+    # subtree_control of all its ancestors; the cgroups created here have
+    # no processes of their own, so this is allowed
+    parent = os.path.dirname(path)
+    for group in [os.path.dirname(parent), parent, path]:
+        with open(group + '/cgroup.controllers', 'r') as f:
+            available = f.read().split()
+        enable = ' '.join('+' + name for name in CGROUP_CONTROLLERS if name in available)
+        if enable:
+            subprocess.call(['sudo', 'sh', '-c', 'echo %s > %s/cgroup.subtree_control' %
+                                                 (enable, group)])
+    return True
+
+def mount_chroot(target, slot=0, cache=False):
+    root = chroot_dir(target, slot)
+    with spans.timed('mount', target=target, slot=slot):
+        for path in BIND_MOUNTS:
+            subprocess.call(['sudo', 'mount', '-o', 'bind', path, root + path])
+        if cache:
+            subprocess.call(['sudo', 'mount', '-o', 'bind', cache_dir(target),
+                                     root + cache_dir(target)])
+        cgroup = slot_cgroup(target, slot)
+        if cgroup and os.path.isdir(cgroup) and not os.path.ismount(root + CGROUP_MOUNT):
+            subprocess.call(['sudo', 'mkdir', '-p', root + CGROUP_MOUNT])
+            subprocess.call(['sudo', 'mount', '-o', 'bind', cgroup, root + CGROUP_MOUNT])
+
+def umount_chroot(target, slot=0, quiet=False):
+    root = chroot_dir(target, slot)
+    if os.path.ismount(root + CGROUP_MOUNT):
+        subprocess.call(['sudo', 'umount', root + CGROUP_MOUNT])
+    if os.path.ismount(root + cache_dir(target)):
+        subprocess.call(['sudo', 'umount', root + cache_dir(target)])
+    for path in reversed(BIND_MOUNTS):
+        subprocess.call(['sudo', 'umount', root + path],
+                        stderr=subprocess.DEVNULL if quiet else None)
+
+def init_chroot(target, slot=0, config=None):
     try:
-        subprocess.call(['sudo', 'mock', '-r', target + '-autotest-x86_64',
-                                 '--init'])
-        # For 6.x / 7.x tests can be launched in chroot created by 8.x mock/rpm,
-        # rebuild rpm db by means of native rpm
-        if target == "vzlinux-6" or target == "vzlinux-7":
-            subprocess.call(['sudo', 'mock', '-r', target + '-autotest-x86_64',
-                                     '--chroot', 'rm -f /var/lib/rpm/__*'])
-            subprocess.call(['sudo', 'mock', '-r', target + '-autotest-x86_64',
-                                     '--chroot', 'rpm --rebuilddb'])
-        subprocess.call(['sudo', 'mount', '-o', 'bind', '/proc',
-                                 '/var/lib/mock/' + target + '-autotest-x86_64/root/proc'])
+        with spans.timed('init_chroot', target=target, slot=slot):
+            with spans.timed('mock_init', target=target, slot=slot):
+                subprocess.call(mock_cmd(target, slot, config) + ['--init'])
+            # For 6.x / 7.x tests can be launched in chroot created by 8.x mock/rpm,
+            # rebuild rpm db by means of native rpm
+            if target == "vzlinux-6" or target == "vzlinux-7":
+                with spans.timed('rebuilddb', target=target, slot=slot):
+                    subprocess.call(mock_cmd(target, slot) +
+                                    ['--chroot', 'rm -f /var/lib/rpm/__*'])
+                    subprocess.call(mock_cmd(target, slot) + ['--chroot', 'rpm --rebuilddb'])
     except:
         print("mock failed to initialize chroot, probably incorrect target name")
         sys.exit(1)
 
-def run_app_tests(target, pkgs_list):
-    # Prepare a folder for logs
-    subprocess.call(['sudo', 'mkdir', "-m777", "/var/log/vzlinux-autotests/"])
+def cleanup_chroot(target, slot=0):
+    with spans.timed('cleanup_chroot', target=target, slot=slot):
+        subprocess.call(mock_cmd(target, slot) + ['--orphanskill'])
+        umount_chroot(target, slot)
+        cgroup = slot_cgroup(target, slot)
+        if cgroup and os.path.isdir(cgroup):
+            subprocess.call(['sudo', 'rmdir', cgroup])
 
-    subprocess.call(['sudo', 'cp', '/usr/share/vzlinux-autotest/check_apps_in_chroot.py',
-                             '/var/lib/mock/' + target + '-autotest-x86_64/root/root'])
+# Serializes updates of the package cache by the chroot slots
+cache_lock = threading.Lock()
 
-    f = open(pkgs_list, 'r')
-    for pkg in f.readlines():
-    #    subprocess.call(['sudo', 'cp', pkgs_list,
-    #                             '/var/lib/mock/' + target + '-autotest-x86_64/root/root/list'])
-        pkg_file = open('/var/lib/mock/' + target + '-autotest-x86_64/root/tmp/list', 'w')
-        pkg_file.write(pkg)
-        pkg_file.close()
-        subprocess.call(['sudo', 'chroot', '/var/lib/mock/' + target + '-autotest-x86_64/root',
-                                 'python', 'root/check_apps_in_chroot.py', 'tmp/list'])
-
-        # Copy results to /var/log
-        result_dir = "/var/log/vzlinux-autotests/" + target + "/" + pkg.rstrip()
+def createrepo_cmd():
+    for cmd in ['createrepo_c', 'createrepo']:
+        if shutil.which(cmd):
+            return cmd
+    return None
+
+def cache_repo(target):
+    '''Returns yum config section of the package cache of the target.'''
+    return ("\n[%s]\nname=Packages cached by vzlinux-autotest\nbaseurl=file://%s\n"
+            "enabled=1\ngpgcheck=0\ncost=100\nmetadata_expire=0\n"
+            "skip_if_unavailable=1\n" % (CACHE_REPO, cache_dir(target)))
+
+def create_cache(target):
+    '''Create the package cache of the target unless it exists.
+
+    Returns True if the cache can be used, False otherwise.
+    '''
+    createrepo = createrepo_cmd()
+    if not createrepo:
+        print("createrepo is not available, package cache is disabled")
+        return False
+
+    cache = cache_dir(target)
+    with cache_lock:
+        if not os.path.exists(cache + '/repodata'):
+            subprocess.call(['sudo', 'mkdir', '-p', cache])
+            subprocess.call(['sudo', createrepo, '-q', cache])
+    return True
+
+def cache_mock_config(target, offline=False):
+    '''Write the mock config to initialize the chroots of the target with: the
+    config of the target with the package cache added to its repositories
+    (the only repository used if 'offline' is set).
+
+    Returns the path to the config.
+    '''
+    text = ("include(%r)\n"
+            "for key in ['yum.conf', 'dnf.conf']:\n"
+            "    if key in config_opts:\n"
+            "        config_opts[key] += %r\n" %
+            (repodata.MOCK_CONFIG_DIR + mock_config(target) + '.cfg', cache_repo(target)))
+    if offline:
+        text += ("for key in ['yum_common_opts', 'dnf_common_opts']:\n"
+                 "    config_opts[key] = config_opts.get(key, []) + %r\n" %
+                 ['--disablerepo=*', '--enablerepo=' + CACHE_REPO])
+    path = '%s%s%s.cfg' % (CACHE_DIR, mock_config(target), '-offline' if offline else '')
+    with cache_lock:
+        try:
+            with open(path, 'r') as f:
+                current = f.read()
+        except OSError:
+            current = None
+        # Other slots may be reading it right now
+        if current != text:
+            subprocess.run(['sudo', 'tee', path], input=text.encode(),
+                           stdout=subprocess.DEVNULL)
+    return path
+
+def setup_cache(target, slot=0):
+    '''Point yum in the chroot at the package cache of the target, see
+    create_cache().
+
+    The cache is a local repository which is bind-mounted into the chroot
+    (see mount_chroot()) and preferred by yum over the remote ones. The
+    metadata of the remote repositories saved by save_metadata() is copied
+    into the chroot too, so yum downloads only what has changed since then.
+    '''
+    root = chroot_dir(target, slot)
+    subprocess.call(['sudo', 'mkdir', '-p', root + cache_dir(target)])
+    with cache_lock:
+        for path in YUM_CACHES:
+            if os.path.isdir(YUM_METADATA_DIR + target + path):
+                subprocess.call(['sudo', 'mkdir', '-p', root + path])
+                subprocess.call(['sudo', 'cp', '-a', '-T', YUM_METADATA_DIR + target + path,
+                                 root + path])
+
+    # Repositories can be disabled in the chroot (reposdir=/dev/null), so the
+    # repository goes right into the main config file(s), as mock does it;
+    # mock has put it there already if the chroot was initialized with
+    # cache_mock_config()
+    repo = cache_repo(target)
+    for conf in YUM_CONFIGS:
+        if os.path.isfile(root + conf) and not os.path.islink(root + conf):
+            with open(root + conf, 'r') as f:
+                if re.search(r'^\[%s\]' % re.escape(CACHE_REPO), f.read(), re.M):
+                    continue
+            subprocess.run(['sudo', 'tee', '-a', root + conf], input=repo.encode(),
+                           stdout=subprocess.DEVNULL)
+
+def save_metadata(target, slot):
+    '''Save the metadata of the remote repositories fetched by yum in the
+    chroot for the chroots set up later, see setup_cache(). The packages must
+    have been moved to the cache by collect_packages() already.'''
+    root = chroot_dir(target, slot)
+    with cache_lock:
+        for path in YUM_CACHES:
+            if os.path.isdir(root + path) and os.listdir(root + path):
+                dest = YUM_METADATA_DIR + target + path
+                subprocess.call(['sudo', 'rm', '-rf', dest])
+                subprocess.call(['sudo', 'mkdir', '-p', os.path.dirname(dest)])
+                subprocess.call(['sudo', 'cp', '-a', root + path, dest])
+
+def evict_packages(target, size_limit):
+    '''Remove least recently used packages from the cache of the target
+    until the cache is not larger than 'size_limit' megabytes.'''
+    cache = cache_dir(target)
+    rpms = []
+    total = 0
+    for name in os.listdir(cache):
+        if name.endswith('.rpm'):
+            st = os.stat(os.path.join(cache, name))
+            rpms.append((st.st_atime, st.st_size, os.path.join(cache, name)))
+            total += st.st_size
+    rpms.sort()
+
+    victims = []
+    while rpms and total > size_limit * 1024 * 1024:
+        (atime, size, path) = rpms.pop(0)
+        victims.append(path)
+        total -= size
+    if victims:
+        subprocess.call(['sudo', 'rm', '-f'] + victims)
+        subprocess.call(['sudo', createrepo_cmd(), '-q', '--update', cache])
+
+def collect_packages(target, slot):
+    '''Move the packages downloaded by yum in the chroot to the package cache.
+
+    The repository metadata of the cache is updated afterwards.
+    '''
+    root = chroot_dir(target, slot)
+    rpms = []
+    for path in YUM_CACHES:
+        for (dirpath, dirnames, filenames) in os.walk(root + path):
+            rpms += [os.path.join(dirpath, f) for f in filenames if f.endswith('.rpm')]
+    if not rpms:
+        return
+
+    with cache_lock:
+        # Packages which are in the cache already are just dropped
+        subprocess.call(['sudo', 'mv', '-n', '-t', cache_dir(target)] + rpms)
+        subprocess.call(['sudo', 'rm', '-f'] + rpms)
+        subprocess.call(['sudo', createrepo_cmd(), '-q', '--update', cache_dir(target)])
+
+# Numbers of the directories being removed by discard_dir(), the list of the
+# removals in progress is reaped, so its length does not make a unique name
+discarded = itertools.count()
+
+def discard_dir(path, trash):
+    '''Move 'path' out of the way and remove it in background.
+
+    The directory is renamed first, so the caller can reuse 'path' at once;
+    returns Popen object of the removal process.
+    '''
+    subprocess.call(['sudo', 'mv', path, trash])
+    return subprocess.Popen(['sudo', 'rm', '-rf', trash])
+
+def populate_chroot(target, slot, method):
+    '''Make a throwaway chroot from the snapshot base using given method.
+
+    Returns True on success, False otherwise.
+    '''
+    base = slot_dir(target, slot) + '/autotest-base'
+    root = chroot_dir(target, slot)
+    if method == 'overlay':
+        overlay = slot_dir(target, slot) + '/autotest-overlay'
+        subprocess.call(['sudo', 'mkdir', '-p', root, overlay + '/upper', overlay + '/work'])
+        return subprocess.call(['sudo', 'mount', '-t', 'overlay', 'overlay', '-o',
+                                'lowerdir=%s,upperdir=%s/upper,workdir=%s/work' % (
+                                    base, overlay, overlay),
+                                root], stderr=subprocess.DEVNULL) == 0
+    elif method == 'reflink':
+        return subprocess.call(['sudo', 'cp', '-a', '--reflink=always', base, root],
+                               stderr=subprocess.DEVNULL) == 0
+    elif method == 'hardlink':
+        if subprocess.call(['sudo', 'cp', '-al', base, root], stderr=subprocess.DEVNULL) != 0:
+            return False
+        for path in HARDLINK_COPIED:
+            if os.path.isdir(base + path):
+                subprocess.call(['sudo', 'rm', '-rf', root + path])
+                if subprocess.call(['sudo', 'cp', '-a', base + path, root + path]) != 0:
+                    return False
+        return True
+    return False
+
+def snapshot_chroot(target, slot=0):
+    '''Capture freshly initialized chroot as the base for later resets.
+
+    The chroot contents are moved aside and the chroot is recreated on top of
+    them with the cheapest method available: overlayfs upper layer, reflink
+    copy (btrfs, XFS) or hardlink farm. The hardlink farm has real copies of
+    HARDLINK_COPIED directories, other files modified in place (rather than
+    replaced) would leak into the base.
+
+    Returns name of the method or None if the snapshot could not be made.
+    '''
+    base = slot_dir(target, slot) + '/autotest-base'
+    root = chroot_dir(target, slot)
+    subprocess.call(['sudo', 'rm', '-rf', base, slot_dir(target, slot) + '/autotest-overlay'])
+    subprocess.call(['sudo', 'mv', root, base])
+    for method in SNAPSHOT_METHODS:
+        if populate_chroot(target, slot, method):
+            print("Chroot '%s' is reset by means of %s snapshot" % (root, method))
+            return method
+        subprocess.call(['sudo', 'rm', '-rf', root])
+    print("Failed to snapshot chroot '%s', packages will be removed after test" % root)
+    subprocess.call(['sudo', 'mv', base, root])
+    return None
+
+def reset_chroot(target, slot, method, trash):
+    '''Discard all changes made in the chroot since snapshot_chroot().
+
+    Removal of the old contents is started in background, its Popen object is
+    appended to 'trash' list.
+
+    Returns True on success. Otherwise the snapshot is released, so the chroot
+    is the one captured by snapshot_chroot() without snapshot, and False is
+    returned.
+    '''
+    root = chroot_dir(target, slot)
+    umount_chroot(target, slot, quiet=True)
+    if method == 'overlay':
+        overlay = slot_dir(target, slot) + '/autotest-overlay'
+        subprocess.call(['sudo', 'umount', root])
+        trash.append(discard_dir(overlay, '%s.%d.%d' % (overlay, os.getpid(), next(discarded))))
+    else:
+        trash.append(discard_dir(root, '%s.%d.%d' % (root, os.getpid(), next(discarded))))
+    if not populate_chroot(target, slot, method):
+        print("Failed to reset chroot '%s', packages will be removed after test" % root)
+        release_snapshot(target, slot, method)
+        return False
+    return True
+
+def release_snapshot(target, slot, method):
+    '''Turn the snapshot base back into a plain mock chroot.'''
+    root = chroot_dir(target, slot)
+    if method == 'overlay':
+        subprocess.call(['sudo', 'umount', root])
+        subprocess.call(['sudo', 'rm', '-rf', slot_dir(target, slot) + '/autotest-overlay'])
+    subprocess.call(['sudo', 'rm', '-rf', root])
+    subprocess.call(['sudo', 'mv', slot_dir(target, slot) + '/autotest-base', root])
+
+def checker_options(slot, options, cache=False):
+    '''Returns the options of the apps checker run in the chroot slot.'''
+    display = DISPLAY_BASE + slot * DISPLAYS_PER_SLOT
+    cmd = ['--display', str(display), '--jobs', str(options.launches),
+           '--batch', str(options.batch)]
+    if cache:
+        cmd.append('--keep-cache')
+    if options.offline:
+        cmd += ['--only-repo', CACHE_REPO]
+    if options.cores:
+        cmd += ['--cores', options.cores, '--core-limit', str(options.core_limit)]
+    return cmd
+
+def start_checker(target, slot, options, cache=False):
+    '''Start the apps checker serving the requests of test_app_packages() in
+    the chroot slot (see --serve option of the checker), so that its X
+    servers and the set of installed packages are kept between the batches.
+
+    Returns Popen object of the checker.
+    '''
+    cmd = ['python', 'root/check_apps_in_chroot.py', '--serve'] + \
+          checker_options(slot, options, cache)
+    return subprocess.Popen(['sudo', 'chroot', chroot_dir(target, slot)] + cmd,
+                            stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                            universal_newlines=True)
+
+def ask_checker(checker, request):
+    '''Send the request to the checker started by start_checker() and pass
+    its output on until it is done with the request.
+
+    Returns False if the checker has exited meanwhile, True otherwise.
+    '''
+    try:
+        checker.stdin.write(json.dumps(request) + '\n')
+        checker.stdin.flush()
+    except OSError:
+        return False
+    for line in checker.stdout:
+        if line.rstrip('\n') == CHECKER_DONE:
+            return True
+        sys.stdout.write(line)
+    return False
+
+def stop_checker(checker):
+    checker.stdin.close()
+    try:
+        checker.wait(timeout=CHECKER_STOP_TIMEOUT)
+    except subprocess.TimeoutExpired:
+        # It is killed along with the other orphans of the chroot then
+        print("The checker has not exited in %d seconds" % CHECKER_STOP_TIMEOUT)
+    checker.stdout.close()
+
+def collect_logs(target, slot, pkgs):
+    '''Move the logs of the given packages from the chroot slot to their
+    directories in LOG_DIR, replacing the ones of the previous run.
+
+    Only the logs of these packages (and the core dumps of their
+    applications, dump_<package>.<pid>.*) are moved (renamed, if the chroot
+    is on the same file system), so the cost does not depend on how many
+    packages have been checked in the chroot before and the results there do
+    not pile up. The results of the whole run are exported by
+    check_packages().
+    '''
+    src = chroot_dir(target, slot) + '/tmp/results/'
+    names = os.listdir(src) if os.path.isdir(src) else []
+    for pkg in pkgs:
+        result_dir = LOG_DIR + target + "/" + pkg
         if os.path.exists(result_dir):
             shutil.rmtree(result_dir)
-        testdir = '/var/lib/mock/' + target + '-autotest-x86_64/root/tmp/results'
-        shutil.copytree(testdir, result_dir)
-
-        # Kill orphans - that's why we call check_apps_in_chroot.py per every package, not
-        # per all packages at once. Orphans will be killed after each package test and won't
-        # occupy too many resources
-        subprocess.call(['sudo', 'mock', '-r', target + '-autotest-x86_64',
-                                 '--orphanskill'])
-        # We have to remount /proc after orpahskill
-        subprocess.call(['sudo', 'mount', '-o', 'bind', '/proc',
-                                 '/var/lib/mock/' + target + '-autotest-x86_64/root/proc'])
-        subprocess.call(['sudo', 'mount', '-o', 'bind', '/dev',
-                                 '/var/lib/mock/' + target + '-autotest-x86_64/root/dev'])
-        # mount /dev/shm too
-        subprocess.call(['sudo', 'mount', '-o', 'bind', '/dev/shm',
-                                 '/var/lib/mock/' + target + '-autotest-x86_64/root/dev/shm'])
-        # need to mount /dev/pts if we still want to use sudo in chroot
-        subprocess.call(['sudo', 'mount', '-o', 'bind', '/dev/pts',
-                                 '/var/lib/mock/' + target + '-autotest-x86_64/root/dev/pts'])
-
-def run_service_tests(target, pkgs_list):
-    subprocess.call(['python', '/usr/share/vzlinux-autotest/check_services_in_vm.py', pkgs_list])
+        os.makedirs(result_dir)
+        dump = re.compile(r'dump_%s\.\d+\.' % re.escape(pkg))
+        files = [src + name for name in names
+                 if name == 'pkg_' + pkg + '.log' or dump.match(name)]
+        if files:
+            # The files belong to root in the chroot
+            subprocess.call(['sudo', 'mv', '-f'] + files + [result_dir])
+
+def test_app_packages(target, slot, pkgs, options, store, snapshot=None,
+                      trash=None, cache=False, files=None, nevras=None,
+                      checker=None):
+    '''Check the given packages in the chroot slot by one checker run.
+
+    'pkgs' - list of package names.
+    'options' - parsed command line options.
+    'store' - connection to the result store.
+    'snapshot' - method to reset the chroot by, see snapshot_chroot().
+    'cache' - whether the package cache is set up in the chroot.
+    'files' - .desktop files of the packages, see repodata.file_index().
+    'nevras' - dict mapping names of the packages to their NEVRAs.
+    'checker' - the checker serving the requests in the chroot, see
+    start_checker(); the orphans are not killed and the chroot is not
+    remounted after the check then, as that would kill the checker too.
+
+    Returns the method to reset the chroot by from now on: 'snapshot' or
+    None if the chroot could not be reset, see reset_chroot().
+
+    If the cgroup of the slot is mounted in the chroot (see setup_cgroup()),
+    the checker kills all the processes of every application itself, so
+    the orphans are not killed and the chroot is not remounted either
+    (unless it is reset to the snapshot).
+    '''
+    root = chroot_dir(target, slot)
+    pkg_file = open(root + '/tmp/list', 'w')
+    for pkg in pkgs:
+        pkg_file.write(pkg + "\n")
+    pkg_file.close()
+    cmd = ['python', 'root/check_apps_in_chroot.py'] + checker_options(slot, options, cache)
+    if snapshot:
+        # The chroot will be reset anyway, do not waste time on 'yum remove'
+        cmd.append('--keep-installed')
+    index = None
+    if files is not None:
+        write_file_index(root + '/tmp/index', pkgs, files)
+        index = 'tmp/index'
+        cmd += ['--index', index]
+    tags = {'target': target, 'slot': slot, 'package': ' '.join(pkgs)}
+    with spans.timed('checker', **tags):
+        if checker:
+            if not ask_checker(checker, {'list': 'tmp/list', 'index': index}):
+                print("The checker in chroot '%s' has exited" % root)
+        else:
+            subprocess.call(['sudo', 'chroot', root] + cmd + ['tmp/list'])
+    spans.load(root + '/tmp/results/spans.jsonl', target=target, slot=slot)
+
+    if cache:
+        with spans.timed('collect_packages', **tags):
+            collect_packages(target, slot)
+
+    # Move results to /var/log
+    with spans.timed('copy_results', **tags):
+        collect_logs(target, slot, pkgs)
+    resultstore.ingest(store, target, 'apps', root + '/tmp/results/results.jsonl',
+                       lambda pkg: package_log(target, 'apps', pkg), nevras)
+    if checker:
+        return snapshot
+
+    confined = os.path.ismount(root + CGROUP_MOUNT)
+    if not confined:
+        # Kill orphans - that's why we call check_apps_in_chroot.py per every package
+        # (or a small batch of packages), not per all packages at once. Orphans will be
+        # killed after each package test and won't occupy too many resources
+        with spans.timed('orphanskill', **tags):
+            subprocess.call(mock_cmd(target, slot) + ['--orphanskill'])
+    # Start the next package from the pristine chroot, if possible
+    method = snapshot
+    if snapshot:
+        with spans.timed('reset', **tags):
+            if not reset_chroot(target, slot, snapshot, trash):
+                method = None
+    # We have to remount /proc after orpahskill; /dev/shm is needed too
+    # and we need to mount /dev/pts if we still want to use sudo in chroot
+    if snapshot or not confined:
+        mount_chroot(target, slot, cache)
+    return method
+
+def next_batch(batches, resident=False):
+    '''Returns the next item of 'batches' queue or None if there are no more:
+    the queue is empty or, for a resident worker, None has been put in it.'''
+    if resident:
+        return batches.get()
+    try:
+        return batches.get_nowait()
+    except queue.Empty:
+        return None
+
+def app_worker(target, slot, batches, options, resident=False):
+    '''Set up the given chroot slot and test packages from 'batches' queue in
+    it until the queue is empty.
+
+    'batches' - queue of (packages to check by one checker run, .desktop
+    files of the packages (see repodata.file_index()), dict mapping names of
+    the packages to their NEVRAs) tuples.
+    'options' - parsed command line options.
+    'resident' - whether to keep the slot set up and wait for more batches
+    until None is put in the queue, see SlotPool. The checker keeps running
+    in the chroot for the whole time then, unless the chroot is reset.
+
+    If snapshot option is set, the chroot is reset to its initial state after
+    every batch instead of removing the installed packages.
+    '''
+    cache = not options.no_cache and create_cache(target)
+    init_chroot(target, slot, cache_mock_config(target, options.offline) if cache else None)
+    subprocess.call(['sudo', 'cp', AUTOTEST_DIR + 'check_apps_in_chroot.py',
+                             chroot_dir(target, slot) + '/root'])
+    if not setup_cgroup(target, slot):
+        print("cgroup v2 is not available, the applications in chroot '%s' are not confined "
+              "to cgroups" % chroot_dir(target, slot))
+    if cache:
+        setup_cache(target, slot)
+    method = None
+    if options.snapshot:
+        with spans.timed('snapshot', target=target, slot=slot):
+            method = snapshot_chroot(target, slot)
+    mount_chroot(target, slot, cache)
+    # Connections to the store cannot be shared between threads
+    store = resultstore.connect()
+    trash = []
+    checker = None
+    try:
+        while True:
+            item = next_batch(batches, resident)
+            if item is None:
+                break
+            (pkgs, files, nevras) = item
+            try:
+                if resident and not method and (checker is None or
+                                                checker.poll() is not None):
+                    checker = start_checker(target, slot, options, cache)
+                method = test_app_packages(target, slot, pkgs, options, store, method,
+                                           trash, cache, files, nevras, checker)
+                # Reap the removals of the discarded chroots done by now
+                trash[:] = [proc for proc in trash if proc.poll() is None]
+            except Exception:
+                # A resident worker stays for the next batches
+                if not resident:
+                    raise
+                traceback.print_exc()
+            finally:
+                batches.task_done()
+    finally:
+        if checker:
+            stop_checker(checker)
+        store.close()
+        if cache:
+            save_metadata(target, slot)
+        cleanup_chroot(target, slot)
+        if method:
+            release_snapshot(target, slot, method)
+        for proc in trash:
+            proc.wait()
+
+def read_list(pkgs_list):
+    '''Returns names of the packages from the given file as a list.'''
+    pkgs = []
+    f = open(pkgs_list, 'r')
+    for pkg in f.readlines():
+        if pkg.strip():
+            pkgs.append(pkg.strip())
+    f.close()
+    return pkgs
+
+class SlotPool(object):
+    '''The chroot slots of the daemon: every slot is set up once by its
+    resident worker (see app_worker() and service_worker()) and kept for
+    all the runs, the packages are handed out to the slots from a shared
+    queue.'''
+    def __init__(self, target, mode, slots, options):
+        self.batch = options.batch
+        self.batches = queue.Queue()
+        worker = app_worker if mode == 'apps' else service_worker
+        self.workers = []
+        for slot in slots:
+            t = threading.Thread(target=worker,
+                                 args=(target, slot, self.batches, options, True))
+            t.start()
+            self.workers.append(t)
+
+    def run(self, pkgs, files=None, nevras=None):
+        '''Check the packages in the slots, returns when all are checked.'''
+        for i in range(0, len(pkgs), self.batch):
+            self.batches.put((pkgs[i:i + self.batch], files, nevras))
+        self.batches.join()
+
+    def close(self):
+        '''Clean up the slots once they are done with the queued packages.'''
+        for t in self.workers:
+            self.batches.put(None)
+        for t in self.workers:
+            t.join()
+
+def run_app_tests(target, pkgs, options, files=None, nevras=None, slots=None,
+                  pool=None):
+    '''Check the applications of the packages in the given chroot slots
+    (slots 0 .. options.jobs - 1 by default) or in the slots of the pool.'''
+    # Prepare a folder for logs
+    subprocess.call(['sudo', 'mkdir', "-m777", LOG_DIR])
+
+    if pool:
+        pool.run(pkgs, files, nevras)
+    else:
+        batches = queue.Queue()
+        for i in range(0, len(pkgs), options.batch):
+            batches.put((pkgs[i:i + options.batch], files, nevras))
+
+        # Every slot is an independent mock chroot with its own /tmp/list,
+        # /tmp/results and mounts, packages are handed out from the shared queue
+        workers = []
+        for slot in (slots or list(range(options.jobs)))[:batches.qsize()]:
+            t = threading.Thread(target=app_worker,
+                                 args=(target, slot, batches, options))
+            t.start()
+            workers.append(t)
+        for t in workers:
+            t.join()
+
+    # Packages are evicted when no chroot uses the cache any more
+    if not options.no_cache and os.path.isdir(cache_dir(target)):
+        evict_packages(target, options.cache_size)
+
+def machine_name(target, slot):
+    return '%s-autotest-%d' % (target, slot)
+
+def boot_container(target, slot):
+    '''Boot the chroot slot of the target as a systemd-nspawn container. The
+    container shares the network with the host, as yum in it needs the
+    repositories.
+
+    Returns (Popen object of systemd-nspawn, PID of init of the container),
+    None if the container has failed to boot.
+    '''
+    name = machine_name(target, slot)
+    proc = subprocess.Popen(['sudo', 'systemd-nspawn', '-q', '--boot',
+                             '-D', chroot_dir(target, slot), '-M', name],
+                            stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                            stderr=subprocess.DEVNULL)
+    deadline = time.time() + NSPAWN_BOOT_TIMEOUT
+    while proc.poll() is None and time.time() < deadline:
+        # 'degraded' means some units have failed, the services are checked anyway
+        state = subprocess.run(['sudo', 'systemctl', '-M', name, 'is-system-running'],
+                               stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        if state.stdout.decode().strip() in ['running', 'degraded']:
+            out = subprocess.run(['sudo', 'machinectl', 'show', name, '-p', 'Leader'],
+                                 stdout=subprocess.PIPE).stdout.decode()
+            return (proc, out.strip().partition('=')[2])
+        time.sleep(1)
+    print("Container '%s' has failed to boot" % name)
+    stop_container(target, slot, proc)
+    return None
+
+def stop_container(target, slot, proc):
+    name = machine_name(target, slot)
+    if proc.poll() is None:
+        subprocess.call(['sudo', 'machinectl', 'poweroff', name], stderr=subprocess.DEVNULL)
+    try:
+        proc.wait(timeout=NSPAWN_STOP_TIMEOUT)
+    except subprocess.TimeoutExpired:
+        subprocess.call(['sudo', 'machinectl', 'terminate', name])
+        proc.wait()
+
+# Serializes merging of the results of the containers into SERVICE_RESULT_DIR
+results_lock = threading.Lock()
+
+def merge_service_results(target, slot, pkgs):
+    '''Merge the results of a checker run in the container slot into
+    SERVICE_RESULT_DIR: the logs of the packages are moved, the records are
+    appended to results.jsonl and other logs to <name>-<slot>.log, except
+    the journal of the boot, which is replaced.'''
+    src = chroot_dir(target, slot) + '/tmp/results/'
+    if not os.path.isdir(src):
+        return
+    with results_lock:
+        for name in os.listdir(src):
+            if name.startswith('pkg_'):
+                if name[len('pkg_'):-len('.log')] in pkgs:
+                    subprocess.call(['sudo', 'mv', '-f', src + name, SERVICE_RESULT_DIR + name])
+            elif name == 'journalctl_ab.log':
+                shutil.copy(src + name, SERVICE_RESULT_DIR + 'journalctl_ab-%d.log' % slot)
+            elif name == 'results.jsonl' or name.endswith('.log'):
+                dest = name
+                if name != 'results.jsonl':
+                    dest = '%s-%d.log' % (name[:-len('.log')], slot)
+                with open(src + name, 'r') as fin, open(SERVICE_RESULT_DIR + dest, 'a') as fout:
+                    shutil.copyfileobj(fin, fout)
+
+def record_unchecked(pkgs, reason):
+    '''Record the packages the checker has not been run for as failed to
+    check in SERVICE_RESULT_DIR, with the reason in their logs.'''
+    with results_lock:
+        with open(SERVICE_RESULT_DIR + 'results.jsonl', 'a') as f:
+            for pkg in pkgs:
+                f.write(json.dumps({'type': 'package', 'package': pkg,
+                                    'status': 'failed-to-check', 'time': time.time()}) + '\n')
+        for pkg in pkgs:
+            with open(SERVICE_RESULT_DIR + 'pkg_' + pkg + '.log', 'w') as f:
+                f.write(reason + '\n')
+
+def test_service_packages(target, slot, leader, pkgs, options, files=None):
+    '''Check the given packages in the container slot by one checker run.
+
+    'leader' - PID of init of the container.
+    '''
+    root = chroot_dir(target, slot)
+    with open(root + '/tmp/list', 'w') as f:
+        f.write(''.join(pkg + '\n' for pkg in pkgs))
+    cmd = ['python2', '/root/check_services_in_vm.py', '--jobs', str(options.launches),
+           '--batch', str(options.batch)]
+    if options.journal_dump:
+        cmd.append('--journal-dump')
+    if files is not None:
+        write_file_index(root + '/tmp/index', pkgs, files)
+        cmd += ['--index', '/tmp/index']
+    nsenter = ['sudo', 'nsenter', '--target', leader, '--mount', '--uts', '--ipc', '--pid',
+               '--root', '--wd']
+    with spans.timed('checker', target=target, slot=slot, package=' '.join(pkgs)):
+        subprocess.call(nsenter + cmd + ['/tmp/list'])
+    spans.load(root + '/tmp/results/spans.jsonl', target=target, slot=slot)
+    with spans.timed('copy_results', target=target, slot=slot, package=' '.join(pkgs)):
+        merge_service_results(target, slot, pkgs)
+
+def service_worker(target, slot, batches, options, resident=False):
+    '''Boot the given chroot slot as a container and test packages from
+    'batches' queue in it until the queue is empty.
+
+    Every container has its own systemd, so the services of the packages
+    checked in different containers do not affect each other.
+
+    See app_worker() for the arguments; .service files of the packages are
+    given in the queue rather than .desktop ones. A resident worker boots
+    the container again if it is down when the next batch comes.
+    '''
+    init_chroot(target, slot)
+    with spans.timed('nspawn_install', target=target, slot=slot):
+        subprocess.call(mock_cmd(target, slot) + ['--install'] +
+                        NSPAWN_PACKAGES[target])
+    subprocess.call(['sudo', 'cp', AUTOTEST_DIR + 'check_services_in_vm.py',
+                     chroot_dir(target, slot) + '/root'])
+    with spans.timed('boot', target=target, slot=slot):
+        container = boot_container(target, slot)
+    if container is None and not resident:
+        return
+    try:
+        while True:
+            item = next_batch(batches, resident)
+            if item is None:
+                break
+            (pkgs, files, nevras) = item
+            try:
+                if container is None or container[0].poll() is not None:
+                    with spans.timed('boot', target=target, slot=slot):
+                        container = boot_container(target, slot)
+                if container is None:
+                    print("Container '%s' is down, %s not checked" % (
+                        machine_name(target, slot), ', '.join(pkgs)))
+                    record_unchecked(pkgs, "Container '%s' is down" %
+                                           machine_name(target, slot))
+                else:
+                    test_service_packages(target, slot, container[1], pkgs, options,
+                                          files)
+            except Exception:
+                if not resident:
+                    raise
+                traceback.print_exc()
+            finally:
+                batches.task_done()
+    finally:
+        if container:
+            with spans.timed('shutdown', target=target, slot=slot):
+                stop_container(target, slot, container[0])
+
+def run_services_in_containers(target, pkgs, options, files=None, slots=None,
+                               pool=None):
+    '''Check the services of the packages in the containers booted from
+    the given chroot slots (slots 0 .. options.jobs - 1 by default) or from
+    the slots of the pool, the results are merged into SERVICE_RESULT_DIR.'''
+    os.makedirs(SERVICE_RESULT_DIR, exist_ok=True)
+    # The logs of the containers are appended to by merge_service_results()
+    for name in os.listdir(SERVICE_RESULT_DIR):
+        if name.endswith('.jsonl') or name.endswith('.list') or \
+                (name.endswith('.log') and not name.startswith('pkg_')):
+            os.remove(SERVICE_RESULT_DIR + name)
+
+    if pool:
+        pool.run(pkgs, files)
+        return
+    batches = queue.Queue()
+    for i in range(0, len(pkgs), options.batch):
+        batches.put((pkgs[i:i + options.batch], files, None))
+    workers = []
+    for slot in (slots or list(range(options.jobs)))[:batches.qsize()]:
+        t = threading.Thread(target=service_worker,
+                             args=(target, slot, batches, options))
+        t.start()
+        workers.append(t)
+    for t in workers:
+        t.join()
+    # The packages left by the workers, e.g. if no container has booted
+    while not batches.empty():
+        record_unchecked(batches.get()[0], 'No container to check the package in')
+
+def run_service_tests(target, pkgs, options, files=None, nevras=None, slots=None,
+                      pool=None):
+    if options.nspawn:
+        run_services_in_containers(target, pkgs, options, files, slots, pool)
+    else:
+        run_services_on_host(target, pkgs, options, files)
+    store = resultstore.connect()
+    resultstore.ingest(store, target, 'services', SERVICE_RESULT_DIR + 'results.jsonl',
+                       lambda pkg: package_log(target, 'services', pkg), nevras)
+    store.close()
+
+def run_services_on_host(target, pkgs, options, files=None):
+    # The checker takes a file with the package list
+    (ftmp, pkgs_list) = tempfile.mkstemp()
+    os.write(ftmp, ''.join(pkg + '\n' for pkg in pkgs).encode())
+    os.close(ftmp)
+    # The checker starts and stops the services over D-Bus and waits for the
+    # results of the jobs, which is allowed only to root
+    cmd = ['sudo', 'python', AUTOTEST_DIR + 'check_services_in_vm.py',
+           '--jobs', str(options.launches), '--batch', str(options.batch)]
+    if options.journal_dump:
+        cmd.append('--journal-dump')
+    if files is not None:
+        (ftmp, index_file) = tempfile.mkstemp()
+        os.close(ftmp)
+        write_file_index(index_file, pkgs, files)
+        cmd += ['--index', index_file]
+    with spans.timed('checker', target=target, package=' '.join(pkgs)):
+        subprocess.call(cmd + [pkgs_list])
+    # The lists are exported over the ones written by the checker
+    subprocess.call(['sudo', 'chown', '-R', '%d:%d' % (os.getuid(), os.getgid()),
+                     SERVICE_RESULT_DIR])
+    spans.load(SERVICE_RESULT_DIR + 'spans.jsonl', target=target)
+    os.remove(pkgs_list)
+    if files is not None:
+        os.remove(index_file)
+
+def load_metadata(target, offline=False):
+    '''Fetch metadata of the repositories of the target's mock config, take
+    the copy fetched last time if 'offline' is set.
+
+    Returns the list of the dicts returned by repodata.fetch_repodata() or
+    None if the metadata is not available.
+    '''
+    subprocess.call(['sudo', 'mkdir', '-p', '-m777', repodata.METADATA_DIR])
+    try:
+        return [repodata.fetch_repodata(url, offline=offline)
+                for url in repodata.mock_repos(mock_config(target))]
+    except (OSError, repodata.Error) as e:
+        print('Cannot load repository metadata: %s' % str(e))
+        return None
+
+# The indices of the repository metadata built by the daemon, kept while the
+# metadata does not change, see warm_index()
+warm_indices = {}
+
+def warm_index(kind, metadata, load, keep=False):
+    '''Returns load() result, the index of 'kind' metadata files (primary or
+    filelists). If 'keep' is set, the index is kept and returned again until
+    the files change.'''
+    if not keep:
+        return load()
+    key = tuple(md.get(kind) for md in metadata)
+    if kind not in warm_indices or warm_indices[kind][0] != key:
+        warm_indices[kind] = (key, load())
+    return warm_indices[kind][1]
+
+def write_file_index(path, pkgs, files):
+    '''Write the index of the files of the packages for the checkers.
+
+    'files' - dict returned by repodata.file_index(), the packages missing
+    from it are not written.
+    '''
+    with open(path, 'w') as f:
+        for pkg in pkgs:
+            if pkg not in files:
+                continue
+            if not files[pkg]:
+                f.write(pkg + '\n')
+            for fl in files[pkg]:
+                f.write('%s\t%s\n' % (pkg, fl))
+
+def result_keys(index, mode, pkgs):
+    '''Returns a dict mapping names of the packages to their result keys.
+
+    A key is a hash of NEVRA of the package, NEVRAs of all the packages it
+    requires (as resolved from the repository index) and the checker script,
+    so it changes whenever any of them does. Packages missing from the
+    repositories get no key.
+    '''
+    with open(AUTOTEST_DIR + CHECKERS[mode], 'rb') as f:
+        checker = hashlib.sha256(f.read()).hexdigest()
+
+    keys = {}
+    for pkg in pkgs:
+        if pkg in index.packages:
+            key = '%s\n%s\n%s' % (repodata.nevra(index.packages[pkg]),
+                                   index.dep_hash(pkg), checker)
+            keys[pkg] = hashlib.sha256(key.encode()).hexdigest()
+    return keys
+
+def result_cache_path(target, mode):
+    return STATE_DIR + target + '-' + mode + '.json'
+
+def load_result_cache(target, mode):
+    '''Returns the result cache: a dict mapping names of the packages to
+    dicts with their 'key' and 'result' in the last run they passed.'''
+    try:
+        with open(result_cache_path(target, mode), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_result_cache(target, mode, cache):
+    path = result_cache_path(target, mode)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(cache, f, indent=1, sort_keys=True)
+    os.rename(path + '.tmp', path)
+
+def package_log(target, mode, pkg):
+    '''Returns the path to the log of the package from its last run.'''
+    if mode == 'apps':
+        return LOG_DIR + target + '/' + pkg + '/pkg_' + pkg + '.log'
+    return SERVICE_RESULT_DIR + 'pkg_' + pkg + '.log'
+
+def socket_path(target, mode):
+    return STATE_DIR + target + '-' + mode + '.sock'
+
+def unchanged_packages(target, mode, pkgs, keys, cache):
+    '''Returns the packages which passed the checks with the same key
+    before and whose logs are still in place, as a dict mapping their names
+    to the results.'''
+    unchanged = {}
+    for pkg in pkgs:
+        entry = cache.get(pkg)
+        if entry and pkg in keys and entry['key'] == keys[pkg] and \
+           os.path.exists(package_log(target, mode, pkg)):
+            unchanged[pkg] = entry['result']
+    return unchanged
+
+def expected_durations(target, mode, pkgs):
+    '''Returns (expected durations of the checks of the packages, durations
+    from their history) as dicts mapping names of the packages to seconds,
+    see resultstore.durations(). Packages never checked before are expected
+    to take the median of the others.'''
+    store = resultstore.connect()
+    known = resultstore.durations(store, target, mode, set(pkgs))
+    store.close()
+    default = DEFAULT_DURATION
+    if known:
+        default = sorted(known.values())[len(known) // 2]
+    return (dict((pkg, known.get(pkg, default)) for pkg in pkgs), known)
+
+def schedule(pkgs, estimates, priorities=None):
+    '''Returns the packages ordered longest first (within the same
+    priority, higher priority first anyway).
+
+    The chroot slots take the packages from a shared queue, so the long ones
+    are spread over the slots and the short ones fill the gaps at the end,
+    instead of a long package started last keeping the run going alone.
+    '''
+    priorities = priorities or {}
+    return sorted(pkgs, key=lambda pkg: (-priorities.get(pkg, 0), -estimates[pkg]))
+
+def predict_run_time(pkgs, estimates, batch, slots):
+    '''Returns the expected time to check the packages in the given order,
+    'batch' of them per checker run, in 'slots' slots taking the batches from
+    a shared queue.'''
+    loads = [0.0] * max(slots, 1)
+    for i in range(0, len(pkgs), batch):
+        free = loads.index(min(loads))
+        loads[free] += sum(estimates[pkg] for pkg in pkgs[i:i + batch])
+    return max(loads)
+
+def report_run_time(predicted, actual, estimates, known, latest):
+    '''Print the predicted and the actual time of the run along with the
+    packages which took much longer than expected.
+
+    'latest' - dict mapping names of the checked packages to their rows in
+    the result store.
+    '''
+    print("Run time: predicted %.0f s (%d of %d package(s) checked before), actual %.0f s" %
+          (predicted, len(known), len(estimates), actual))
+    slow = sorted(((row['duration'] - estimates[pkg], pkg) for (pkg, row) in latest.items()
+                   if pkg in estimates and row['duration'] is not None and
+                   row['duration'] > estimates[pkg] * SLOW_FACTOR), reverse=True)
+    for (excess, pkg) in slow[:SLOW_REPORTED]:
+        print("  %s: %.0f s, expected %.0f s" % (pkg, estimates[pkg] + excess, estimates[pkg]))
+
+def archive_run(target, mode, run_name, pkgs, list_dir, checked):
+    '''Archive the logs of the packages checked in the run along with the
+    *.list files and the timing spans of the run as ARCHIVE_DIR/<run>.tar.zst,
+    see archive.py. The statuses of the packages are stored in the index of
+    the archive.
+
+    'checked' - dict mapping names of the packages checked in the run to
+    their rows in the result store.
+    '''
+    if not archive.available():
+        print("zstd is not available, the run is not archived")
+        return
+    members = [(pkg + '/pkg_' + pkg + '.log', package_log(target, mode, pkg)) for pkg in pkgs]
+    # The details of the crashes, the core dumps themselves are not archived
+    if mode == 'apps':
+        for pkg in pkgs:
+            result_dir = LOG_DIR + target + '/' + pkg + '/'
+            if os.path.isdir(result_dir):
+                members += [(pkg + '/' + name, result_dir + name)
+                            for name in sorted(os.listdir(result_dir))
+                            if name.startswith('dump_') and name.endswith('.json')]
+    members += [(name, os.path.join(list_dir, name)) for name in sorted(os.listdir(list_dir))
+                if name.endswith('.list')]
+    members.append(('spans.jsonl', SPANS_DIR + run_name + '.jsonl'))
+    subprocess.call(['sudo', 'mkdir', '-p', '-m777', ARCHIVE_DIR])
+    with spans.timed('archive', target=target):
+        archive.write(ARCHIVE_DIR + run_name + '.tar.zst', members,
+                      {'target': target, 'mode': mode,
+                       'results': dict((pkg, row['status']) for (pkg, row) in checked.items())})
+
+def check_packages(target, mode, pkgs, options, slots, pool=None, priorities=None):
+    '''Check the packages in the given chroot slots (or in the slots of the
+    daemon's pool) and export the results: the *.list files, the result cache
+    and the timing spans of the run.
+
+    The packages are checked longest first, as far as their history tells,
+    the ones with higher 'priorities' (dict mapping names of the packages to
+    their priorities in the queue) first anyway.'''
+    global spans
+    spans = timing.Recorder()
+    started = time.time()
+    with spans.timed('metadata', target=target):
+        metadata = load_metadata(target, options.offline)
+        index = None
+        if metadata is not None:
+            index = warm_index('primary', metadata,
+                               lambda: repodata.load_index(metadata), options.daemon)
+
+    # Skip the packages that passed before, nothing they depend on changed
+    keys = {}
+    if index is not None:
+        keys = result_keys(index, mode, pkgs)
+    results = load_result_cache(target, mode)
+    unchanged = {}
+    if not options.force:
+        unchanged = unchanged_packages(target, mode, pkgs, keys, results)
+        for pkg in pkgs:
+            if pkg in unchanged:
+                print("Skipping '%s': %s before and did not change since then" %
+                      (pkg, unchanged[pkg]))
+    to_check = [pkg for pkg in pkgs if pkg not in unchanged]
+
+    # .desktop/.service files of the packages, to skip the packages having
+    # none without installation and save the checkers querying rpm
+    files = None
+    if metadata and all('filelists' in md for md in metadata):
+        if mode == 'apps':
+            regexp = repodata.re_desktop
+        else:
+            regexp = repodata.re_service
+        # The daemon indexes all the packages, whatever it is asked to check
+        names = None if options.daemon else set(to_check)
+        with spans.timed('file_index', target=target):
+            files = warm_index('filelists', metadata,
+                               lambda: repodata.file_index([md['filelists'] for md in metadata],
+                                                           regexp, names),
+                               options.daemon)
+
+    nevras = {}
+    if index is not None:
+        for pkg in pkgs:
+            if pkg in index.packages:
+                nevras[pkg] = repodata.nevra(index.packages[pkg])
+
+    # Services on the host are checked by one checker
+    parallel = len(slots)
+    if mode == 'services' and not options.nspawn:
+        parallel = 1
+    (estimates, known) = expected_durations(target, mode, to_check)
+    to_check = schedule(to_check, estimates, priorities)
+    predicted = predict_run_time(to_check, estimates, options.batch, parallel)
+
+    run_started = time.time()
+    with spans.timed('run', target=target, predicted=predicted):
+        if mode == 'apps':
+            run_app_tests(target, to_check, options, files, nevras, slots, pool)
+            list_dir = LOG_DIR + target
+        elif mode == 'services':
+            run_service_tests(target, to_check, options, files, nevras, slots, pool)
+            list_dir = SERVICE_RESULT_DIR
+    run_time = time.time() - run_started
+
+    # The result lists are a view of the latest results of the packages,
+    # the skipped unchanged ones included
+    os.makedirs(list_dir, exist_ok=True)
+    store = resultstore.connect()
+    resultstore.export_lists(store, target, mode, pkgs, list_dir)
+    latest = resultstore.latest(store, target, mode, set(to_check))
+    store.close()
+    checked = dict((pkg, row) for (pkg, row) in latest.items() if row['time'] >= started)
+    if to_check:
+        report_run_time(predicted, run_time, estimates, known, checked)
+
+    for pkg in to_check:
+        row = latest.get(pkg)
+        if row and row['time'] >= started and row['status'] in CACHED_RESULTS \
+           and pkg in keys:
+            results[pkg] = {'key': keys[pkg], 'result': row['status']}
+        elif pkg in results:
+            del results[pkg]
+    save_result_cache(target, mode, results)
+
+    # Export the timing spans of the run
+    subprocess.call(['sudo', 'mkdir', '-p', '-m777', SPANS_DIR])
+    run_name = '%s-%s-%s' % (target, mode,
+                             time.strftime('%Y%m%d-%H%M%S', time.localtime(started)))
+    spans.write_jsonl(SPANS_DIR + run_name + '.jsonl')
+    if not options.no_archive and to_check:
+        archive_run(target, mode, run_name, to_check, list_dir, checked)
+    if options.textfile_dir:
+        spans.write_prometheus(
+            os.path.join(options.textfile_dir, 'vzlinux_autotest_%s_%s.prom' % (
+                target.replace('-', '_'), mode)),
+            target=target, mode=mode)
+
+class ApiHandler(socketserver.StreamRequestHandler):
+    '''A request to the daemon over its socket: a line with a JSON object.
+
+    {"command": "submit", "packages": [...], "priority": N} queues the
+    packages, the reply is {"queued": <number of the packages not queued
+    before>}.
+
+    {"command": "status", "packages": [...]} - the reply is {"target": ...,
+    "mode": ..., "slots": [...], "running": [...], "queued": [...],
+    "results": {<package>: {"status": ..., "nevra": ..., "time": ...,
+    "log": ...}}} with the latest results of the given packages (if any).
+
+    {"command": "log", "package": ..., "follow": true} - the reply is the
+    log of the package; with "follow" the log is streamed until the package
+    is checked, if it is queued or being checked.
+
+    Errors are replied with {"error": <message>}.
+    '''
+    def reply(self, data):
+        self.wfile.write((json.dumps(data) + '\n').encode())
+
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline().decode())
+            command = request['command']
+        except (ValueError, KeyError, TypeError):
+            self.reply({'error': 'invalid request'})
+            return
+        # Connections to the queue cannot be shared between threads
+        jobs = jobqueue.connect()
+        try:
+            if command == 'submit':
+                self.submit(jobs, request)
+            elif command == 'status':
+                self.status(jobs, request)
+            elif command == 'log':
+                self.log(jobs, request)
+            else:
+                self.reply({'error': "unknown command '%s'" % command})
+        finally:
+            jobs.close()
+
+    def submit(self, jobs, request):
+        pkgs = request.get('packages') or []
+        added = jobqueue.submit(jobs, self.server.target, self.server.mode, pkgs,
+                                request.get('priority', 0))
+        self.server.wakeup.set()
+        self.reply({'queued': added})
+
+    def status(self, jobs, request):
+        server = self.server
+        pending = jobqueue.pending(jobs, server.target, server.mode)
+        results = {}
+        if request.get('packages'):
+            store = resultstore.connect()
+            for (pkg, row) in resultstore.latest(store, server.target, server.mode,
+                                                 set(request['packages'])).items():
+                results[pkg] = {'status': row['status'], 'nevra': row['nevra'],
+                                'time': row['time'], 'log': row['log']}
+            store.close()
+        self.reply({'target': server.target, 'mode': server.mode, 'slots': server.slots,
+                    'running': [row['package'] for row in pending
+                                if row['state'] == jobqueue.RUNNING],
+                    'queued': [row['package'] for row in pending
+                               if row['state'] == jobqueue.QUEUED],
+                    'results': results})
+
+    def log(self, jobs, request):
+        server = self.server
+        pkg = request.get('package')
+        if not pkg:
+            self.reply({'error': 'no package given'})
+            return
+        # While the package is being checked its log is in the chroot, then
+        # it is copied (with the same beginning) to where package_log() is
+        paths = [package_log(server.target, server.mode, pkg)]
+        paths += [chroot_dir(server.target, slot) + '/tmp/results/pkg_' + pkg + '.log'
+                  for slot in server.slots if slot != HOST_SLOT]
+        sent = 0
+        current = None
+        while True:
+            states = [row['state'] for row in jobqueue.pending(jobs, server.target, server.mode)
+                      if row['package'] == pkg]
+            # The log of the last run is of no interest while the next one is queued
+            if not (request.get('follow') and jobqueue.QUEUED in states):
+                existing = [path for path in paths if os.path.exists(path)]
+                if existing:
+                    path = max(existing, key=os.path.getmtime)
+                    # A log smaller than the part sent is the one of a new run
+                    if path != current and os.path.getsize(path) < sent:
+                        sent = 0
+                    current = path
+                    with open(path, 'rb') as f:
+                        f.seek(sent)
+                        data = f.read()
+                    self.wfile.write(data)
+                    sent += len(data)
+            if not request.get('follow') or not states:
+                break
+            time.sleep(DAEMON_POLL_INTERVAL)
+
+def run_daemon(target, mode, options, jobs, slots):
+    '''Check the packages queued for the target and mode in the given slots
+    until terminated.
+
+    The slots are set up once and kept by SlotPool (along with the checkers
+    and their X servers in the chroots), so are the indices of the repository
+    metadata. The packages are queued by other instances of the launcher or
+    over the socket of the daemon, see ApiHandler.
+    '''
+    pool = None
+    if mode == 'apps' or options.nspawn:
+        pool = SlotPool(target, mode, slots, options)
+    path = socket_path(target, mode)
+    # Left by a daemon which is dead, as this one is the runner now
+    if os.path.exists(path):
+        os.remove(path)
+    server = socketserver.ThreadingUnixStreamServer(path, ApiHandler)
+    server.daemon_threads = True
+    server.target = target
+    server.mode = mode
+    server.slots = slots
+    server.wakeup = threading.Event()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print("Checking %s on '%s' as a daemon, the socket is %s" % (mode, target, path))
+    try:
+        while True:
+            server.wakeup.clear()
+            batch = jobqueue.take_jobs(jobs, target, mode)
+            if batch:
+                check_packages(target, mode, batch, options, slots, pool,
+                               jobqueue.priorities(jobs, target, mode))
+                jobqueue.finish_jobs(jobs, target, mode)
+            else:
+                server.wakeup.wait(DAEMON_POLL_INTERVAL)
+    finally:
+        server.shutdown()
+        server.server_close()
+        os.remove(path)
+        if pool:
+            pool.close()
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="VzLinux Autotest Launcher")
     parser.add_argument('target', action='store', choices=['vzlinux-6', 'vzlinux-7', 'vzlinux-8'])
     parser.add_argument('mode', action='store', choices=['apps','services'])
-    parser.add_argument('-t', '--timeout', action='store', nargs='?',
-                               help='Maximum time in seconds to wait for an exclusive lock '\
-                                    'on a test chroot')
+    parser.add_argument('-t', '--timeout', action='store', type=int, default=60,
+                               help='Maximum time in seconds to wait for a free chroot slot, '\
+                                    'the packages stay queued for the next run if there is '\
+                                    'none (default: %(default)s)')
+    parser.add_argument('--priority', action='store', type=int, default=0,
+                               help='Priority of the packages in the queue, the ones with '\
+                                    'higher priority are checked first (default: %(default)s)')
     parser.add_argument('-p', '--pkg', action='append',
                                help='Check only package with given name. This option can ' \
                                     'be specified more than once. By default, all packages ' \
                                     'from the autotest list are checked.')
+    parser.add_argument('-a', '--affected', action='append',
+                               help='Check only the packages from the autotest list (or '\
+                                    'given by --pkg) which require the package with given '\
+                                    'name, directly or indirectly, e.g. a freshly built one. '\
+                                    'This option can be specified more than once.')
+    parser.add_argument('-j', '--jobs', action='store', type=int, default=1,
+                               help='Number of chroots (containers with --nspawn) to test '\
+                                    'applications (services) in parallel, every chroot gets '\
+                                    'packages from a shared queue')
+    parser.add_argument('-n', '--nspawn', action='store_true',
+                               help='Check services in systemd-nspawn containers booted from '\
+                                    'the mock chroots of the target instead of the host')
+    parser.add_argument('-s', '--snapshot', action='store_true',
+                               help='Reset the chroot to its freshly initialized state '\
+                                    'after every package (by means of overlayfs, reflink '\
+                                    'or hardlink copy) instead of removing the package')
+    parser.add_argument('-l', '--launches', action='store', type=int, default=1,
+                               help='Number of applications (services) of a package to '\
+                                    'check at once, at most %d' % DISPLAYS_PER_SLOT)
+    parser.add_argument('-b', '--batch', action='store', type=int, default=1,
+                               help='Number of packages to install and remove in one yum '\
+                                    'transaction, packages are installed one by one if '\
+                                    'the transaction fails')
+    parser.add_argument('--journal-dump', action='store_true',
+                               help='Write the whole journal of the boot to '\
+                                    'journalctl_ab.log after checking the services, besides '\
+                                    'the journal of every service in the log of its package')
+    parser.add_argument('-f', '--force', action='store_true',
+                               help='Check all the packages, even those which passed '\
+                                    'the checks before and did not change since then')
+    parser.add_argument('--no-cache', action='store_true',
+                               help='Do not use the local cache of the packages '\
+                                    'downloaded in earlier chroots and runs')
+    parser.add_argument('--cache-size', action='store', type=int, default=CACHE_SIZE,
+                               help='Maximum size of the package cache of a target in '\
+                                    'megabytes, least recently used packages are '\
+                                    'removed above it (default: %(default)s)')
+    parser.add_argument('--offline', action='store_true',
+                               help='Do not use the remote repositories: install the packages '\
+                                    'only from the package cache of the target (apps only)')
+    parser.add_argument('--no-archive', action='store_true',
+                               help='Do not archive the logs of the run to '\
+                                    '%s<target>-<mode>-<time>.tar.zst' % ARCHIVE_DIR)
+    parser.add_argument('--cores', action='store', choices=CORE_MODES,
+                               help='Keep the core dumps of the crashed applications (full: '\
+                                    'compressed by zstd; backtrace: only their backtraces), '\
+                                    'collect_core.py is registered as core_pattern meanwhile')
+    parser.add_argument('--core-limit', action='store', type=int, default=CORE_LIMIT,
+                               help='Maximum size of a core dump to keep in megabytes, larger '\
+                                    'ones are truncated (default: %(default)s)')
+    parser.add_argument('--textfile-dir', action='store',
+                               help='Directory of Prometheus node_exporter textfile collector '\
+                                    'to write the time spent in the phases of the run to')
+    parser.add_argument('-d', '--daemon', action='store_true',
+                               help='Keep checking the packages queued for the target and mode '\
+                                    'until terminated, with the chroots (containers) set up '\
+                                    'once; packages can be queued over the UNIX socket '\
+                                    '%s<target>-<mode>.sock too. Only the packages given by '\
+                                    '--pkg or --affected are queued at start' % STATE_DIR)
     cmdline = parser.parse_args(sys.argv[1:])
+    cmdline.jobs = max(cmdline.jobs, 1)
+    cmdline.launches = min(max(cmdline.launches, 1), DISPLAYS_PER_SLOT)
+    cmdline.batch = max(cmdline.batch, 1)
+    if cmdline.nspawn and cmdline.mode == 'services' and cmdline.target not in NSPAWN_PACKAGES:
+        parser.error("'%s' does not use systemd, its services cannot be checked with --nspawn" %
+                     cmdline.target)
+    if cmdline.offline and (cmdline.no_cache or cmdline.mode != 'apps'):
+        parser.error("--offline needs the package cache, which is used to check apps only")
 
-    lock_name = "/tmp/vzlinux-autotest-" + cmdline.target
-    chroot_timeout = 60
-    if cmdline.timeout:
-        chroot_timeout = cmdline.timeout
+    subprocess.call(['sudo', 'mkdir', '-p', '-m777', STATE_DIR])
 
-    lock = LockFile(lock_name)
-    try:
-        print("Acquiring lock for '%s' chroot" % cmdline.target)
-        lock.acquire(timeout=chroot_timeout)    # wait up to 60 seconds
-    except LockTimeout:
-        print('Cannot acquire lock, likely another instance of a test is already running. '
-              'If this is not the case, please remove lock file "%s" manually.' % lock_name)
-        sys.exit(1)
-
-    # Form list of packages to be processed - checkers takes file with package list
+    # Form list of packages to be processed
     if cmdline.pkg:
-        (ftmp, pkg_list) = tempfile.mkstemp()
-        for p in cmdline.pkg:
-            os.write(ftmp, p + "\n")
-        os.close(ftmp)
+        pkgs = cmdline.pkg
+    elif cmdline.daemon and not cmdline.affected:
+        pkgs = []
     elif cmdline.mode == 'apps':
-        pkg_list = '/usr/share/vzlinux-autotest/' + cmdline.target + '.desktop.list'
+        pkgs = read_list(AUTOTEST_DIR + cmdline.target + '.desktop.list')
     elif cmdline.mode == 'services':
-        pkg_list = '/usr/share/vzlinux-autotest/' + cmdline.target + '.service.list'
-
-    if cmdline.mode == 'apps':
-        init_chroot(cmdline.target)
-        run_app_tests(cmdline.target, pkg_list)
-        subprocess.call(['sudo', 'mock', '-r', cmdline.target + '-autotest-x86_64',
-                                 '--orphanskill'])
-        subprocess.call(['sudo', 'umount',
-                                 '/var/lib/mock/' + cmdline.target + '-autotest-x86_64/root/proc'])
-        subprocess.call(['sudo', 'umount',
-                                 '/var/lib/mock/' + cmdline.target + '-autotest-x86_64/root/dev'])
-        subprocess.call(['sudo', 'umount',
-                                 '/var/lib/mock/' + cmdline.target + '-autotest-x86_64/root/dev/shm'])
-        subprocess.call(['sudo', 'umount',
-                                 '/var/lib/mock/' + cmdline.target + '-autotest-x86_64/root/dev/pts'])
-    elif cmdline.mode == 'services':
-        run_service_tests(cmdline.target, pkg_list)
+        pkgs = read_list(AUTOTEST_DIR + cmdline.target + '.service.list')
 
-    # Cleanup
-    if cmdline.pkg:
-        os.remove(pkg_list)
+    if cmdline.affected:
+        metadata = load_metadata(cmdline.target, cmdline.offline)
+        if metadata is None:
+            print('Cannot find the packages affected by %s without repository metadata' %
+                  ', '.join(cmdline.affected))
+            sys.exit(1)
+        affected = repodata.load_index(metadata).dependents(cmdline.affected)
+        pkgs = [pkg for pkg in pkgs if pkg in affected]
+        print('%d package(s) affected by %s' % (len(pkgs), ', '.join(cmdline.affected)))
 
-    lock.release()
+    # The packages are queued and checked by the runner of the target and
+    # mode, which is this instance unless there is one already
+    jobs = jobqueue.connect()
+    added = jobqueue.submit(jobs, cmdline.target, cmdline.mode, pkgs, cmdline.priority)
+    print('%d package(s) queued, %d of them already were' % (len(pkgs), len(pkgs) - added))
+    if not jobqueue.become_runner(jobs, cmdline.target, cmdline.mode):
+        print("Another instance is checking %s on '%s', it will check the queued packages" %
+              (cmdline.mode, cmdline.target))
+        sys.exit(1 if cmdline.daemon else 0)
+
+    # Chroot slots are shared by the runners of all the modes of the target;
+    # services checked on the host need no chroot and get a slot of their own
+    if cmdline.mode == 'services' and not cmdline.nspawn:
+        (candidates, count) = ([HOST_SLOT], 1)
+    else:
+        (candidates, count) = (list(range(MAX_SLOTS)), cmdline.jobs)
+    deadline = time.time() + cmdline.timeout
+    slots = jobqueue.claim_slots(jobs, cmdline.target, cmdline.mode, candidates, count)
+    while not slots and time.time() < deadline:
+        time.sleep(SLOT_POLL_INTERVAL)
+        slots = jobqueue.claim_slots(jobs, cmdline.target, cmdline.mode, candidates, count)
+    if not slots:
+        jobqueue.resign(jobs, cmdline.target, cmdline.mode, force=True)
+        print("No free chroot slot for '%s' in %d seconds, the packages stay queued for "
+              "the next run" % (cmdline.target, cmdline.timeout))
+        sys.exit(1)
+    print("Checking %s on '%s' in slot(s) %s" % (cmdline.mode, cmdline.target,
+                                                ', '.join(str(slot) for slot in slots)))
+
+    if cmdline.mode == 'apps' and cmdline.cores:
+        jobqueue.use_cores(jobs, lambda: subprocess.call(
+            ['sudo', 'python3', AUTOTEST_DIR + 'collect_core.py', '--install']))
+
+    try:
+        if cmdline.daemon:
+            # Let the daemon clean up its slots when stopped
+            signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+            run_daemon(cmdline.target, cmdline.mode, cmdline, jobs, slots)
+        else:
+            # Packages queued while a batch is being checked get into the next one
+            while not jobqueue.resign(jobs, cmdline.target, cmdline.mode):
+                batch = jobqueue.take_jobs(jobs, cmdline.target, cmdline.mode)
+                check_packages(cmdline.target, cmdline.mode, batch, cmdline, slots,
+                               priorities=jobqueue.priorities(jobs, cmdline.target,
+                                                              cmdline.mode))
+                jobqueue.finish_jobs(jobs, cmdline.target, cmdline.mode)
+    finally:
+        jobqueue.release_slots(jobs, cmdline.target, slots)
+        jobqueue.resign(jobs, cmdline.target, cmdline.mode, force=True)
+        # core_pattern is host-wide, it is restored by the last runner
+        # collecting the cores (or by any runner once they are all dead)
+        if cmdline.mode == 'apps':
+            jobqueue.release_cores(jobs, lambda: subprocess.call(
+                ['sudo', 'python3', AUTOTEST_DIR + 'collect_core.py', '--uninstall']))
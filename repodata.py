@@ -0,0 +1,396 @@
+#!/usr/bin/python3
+
+# Copyright (c) 2017-2021, Virtuozzo International GmbH
+#
+# Our contact details: Virtuozzo International GmbH, Vordergasse 59, 8200
+# Schaffhausen, Switzerland.
+
+# Helpers to work with the metadata (repodata) of yum repositories of the
+# targets: fetching it, streaming parsers for primary and filelists data and
+# an in-memory index of the packages and their dependencies.
+#
+# The metadata files are parsed incrementally and every package is dropped
+# as soon as it is processed, so memory usage does not depend on the size
+# of the metadata (only on what the caller keeps).
+
+import bz2
+import collections
+import gzip
+import hashlib
+import lzma
+import os
+import re
+import shutil
+import urllib.request
+import xml.etree.ElementTree as ET
+
+# Mock configs of the targets are here
+MOCK_CONFIG_DIR = '/etc/mock/'
+# Downloaded metadata is kept here, per repository
+METADATA_DIR = '/var/cache/vzlinux-autotest/metadata/'
+
+BASEARCH = 'x86_64'
+# Architectures of the packages we are interested in
+ARCHES = ['x86_64', 'noarch']
+
+# Files the checkers look for in the packages, keep in sync with re_desktop
+# in check_apps_in_chroot.py and re_service in check_services_in_vm.py
+re_desktop = re.compile('/usr/share/(applications|autostart|kde4/services)/.*\\.desktop')
+re_service = re.compile('.*/lib/systemd/system/[^/]*[^@]\\.service')
+
+NS_REPO = '{http://linux.duke.edu/metadata/repo}'
+NS_COMMON = '{http://linux.duke.edu/metadata/common}'
+NS_RPM = '{http://linux.duke.edu/metadata/rpm}'
+NS_FILELISTS = '{http://linux.duke.edu/metadata/filelists}'
+
+Package = collections.namedtuple(
+    'Package', 'name arch epoch version release requires provides files')
+
+
+class Error(Exception):
+    '''The custom error.'''
+    pass
+
+
+def nevra(pkg):
+    return '%s-%s:%s-%s.%s' % (pkg.name, pkg.epoch, pkg.version, pkg.release,
+                               pkg.arch)
+
+
+re_version_segment = re.compile('(~|[0-9]+|[a-zA-Z]+)')
+
+def rpmvercmp(a, b):
+    '''Compare two version (or release) strings the way rpm does it.
+
+    Returns a negative number if 'a' is older than 'b', zero if they are
+    equal and a positive number otherwise.
+    '''
+    if a == b:
+        return 0
+    segs_a = re_version_segment.findall(a)
+    segs_b = re_version_segment.findall(b)
+    while segs_a or segs_b:
+        x = segs_a.pop(0) if segs_a else None
+        y = segs_b.pop(0) if segs_b else None
+        # Tilde sorts before anything, even the end of the string
+        if x == '~' or y == '~':
+            if x != '~':
+                return 1
+            if y != '~':
+                return -1
+            continue
+        if x is None:
+            return -1
+        if y is None:
+            return 1
+        if x.isdigit() and y.isdigit():
+            x = int(x)
+            y = int(y)
+        elif x.isdigit():
+            return 1
+        elif y.isdigit():
+            return -1
+        if x != y:
+            return -1 if x < y else 1
+    return 0
+
+def evr_cmp(a, b):
+    '''Compare epoch, version and release of two packages.'''
+    epoch_a = int(a.epoch or 0)
+    epoch_b = int(b.epoch or 0)
+    if epoch_a != epoch_b:
+        return -1 if epoch_a < epoch_b else 1
+    return rpmvercmp(a.version, b.version) or rpmvercmp(a.release, b.release)
+
+
+def mock_repos(config):
+    '''Returns base URLs of the repositories enabled in the given mock config.
+
+    Only the repository sections embedded into the config (as mock does it
+    for yum.conf/dnf.conf) are taken into account; $basearch and $releasever
+    are expanded.
+    '''
+    with open(MOCK_CONFIG_DIR + config + '.cfg', 'r') as f:
+        text = f.read()
+
+    m = re.search(r"config_opts\['releasever'\]\s*=\s*['\"]([^'\"]+)", text)
+    releasever = m.group(1) if m else ''
+
+    urls = []
+    for section in re.split(r'^\[', text, flags=re.M)[1:]:
+        m = re.search(r'^enabled\s*=\s*(\S+)', section, re.M)
+        if m and m.group(1).lower() in ('0', 'no', 'false'):
+            continue
+        m = re.search(r'^baseurl\s*=\s*(\S+)', section, re.M)
+        if m:
+            urls.append(m.group(1).replace('$basearch', BASEARCH)
+                                  .replace('$releasever', releasever))
+    return urls
+
+
+def fetch_repodata(baseurl, cache_dir=METADATA_DIR, offline=False):
+    '''Download primary and filelists metadata of the repository.
+
+    The files are kept in 'cache_dir' under names containing their
+    checksums, so only the files changed since the last call are downloaded.
+    If 'offline' is set, the files kept by the last call are taken as they
+    are, without network access.
+
+    Returns a dict mapping metadata type to the path of the file.
+    '''
+    baseurl = baseurl.rstrip('/') + '/'
+    dest = os.path.join(cache_dir, hashlib.sha1(baseurl.encode()).hexdigest())
+    os.makedirs(dest, exist_ok=True)
+
+    try:
+        if offline:
+            with open(os.path.join(dest, 'repomd.xml'), 'rb') as f:
+                data = f.read()
+        else:
+            with urllib.request.urlopen(baseurl + 'repodata/repomd.xml') as resp:
+                data = resp.read()
+        repomd = ET.fromstring(data)
+    except (OSError, ET.ParseError) as e:
+        raise Error('Failed to get metadata of %s: %s' % (baseurl, str(e)))
+    if not offline:
+        with open(os.path.join(dest, 'repomd.xml.part'), 'wb') as f:
+            f.write(data)
+        os.rename(os.path.join(dest, 'repomd.xml.part'), os.path.join(dest, 'repomd.xml'))
+
+    files = {}
+    for data in repomd.iter(NS_REPO + 'data'):
+        dtype = data.get('type')
+        if dtype not in ('primary', 'filelists'):
+            continue
+        href = data.find(NS_REPO + 'location').get('href')
+        checksum = data.find(NS_REPO + 'checksum').text.strip()
+        suffix = '-' + dtype + os.path.splitext(href)[1]
+        path = os.path.join(dest, checksum + suffix)
+        if not os.path.exists(path):
+            if offline:
+                raise Error('No %s metadata of %s is kept' % (dtype, baseurl))
+            try:
+                with urllib.request.urlopen(baseurl + href) as resp:
+                    with open(path + '.part', 'wb') as f:
+                        shutil.copyfileobj(resp, f)
+            except OSError as e:
+                raise Error('Failed to download %s: %s' % (baseurl + href, str(e)))
+            os.rename(path + '.part', path)
+            # Drop outdated files of this type
+            for name in os.listdir(dest):
+                if name.endswith(suffix) and name != os.path.basename(path):
+                    os.remove(os.path.join(dest, name))
+        files[dtype] = path
+    return files
+
+
+def open_metadata(path):
+    '''Open (possibly compressed) metadata file for reading.'''
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    elif path.endswith('.xz'):
+        return lzma.open(path, 'rb')
+    elif path.endswith('.bz2'):
+        return bz2.open(path, 'rb')
+    elif path.endswith('.zst'):
+        try:
+            import zstandard
+        except ImportError:
+            raise Error('python3-zstandard is needed to read %s' % path)
+        return zstandard.open(path, 'rb')
+    return open(path, 'rb')
+
+
+def iter_packages(path, tag):
+    '''Iterate over the <package> elements of the given metadata file.
+
+    Every element is cleared as soon as the caller is done with it.
+    '''
+    with open_metadata(path) as f:
+        context = ET.iterparse(f, events=('start', 'end'))
+        (event, root) = next(context)
+        for (event, elem) in context:
+            if event == 'end' and elem.tag == tag:
+                yield elem
+                root.clear()
+
+
+def iter_primary(path):
+    '''Iterate over the packages from primary metadata, yields Package.
+
+    Only the names of the requirements and provides are kept, 'files' are
+    the (few) files listed in primary metadata.
+    '''
+    for elem in iter_packages(path, NS_COMMON + 'package'):
+        if elem.get('type') != 'rpm':
+            continue
+        version = elem.find(NS_COMMON + 'version')
+        fmt = elem.find(NS_COMMON + 'format')
+        requires = []
+        provides = []
+        files = []
+        if fmt is not None:
+            for entry in fmt.iterfind(NS_RPM + 'requires/' + NS_RPM + 'entry'):
+                if not entry.get('name').startswith('rpmlib('):
+                    requires.append(entry.get('name'))
+            for entry in fmt.iterfind(NS_RPM + 'provides/' + NS_RPM + 'entry'):
+                provides.append(entry.get('name'))
+            for fl in fmt.iterfind(NS_COMMON + 'file'):
+                files.append(fl.text)
+        yield Package(elem.findtext(NS_COMMON + 'name'),
+                      elem.findtext(NS_COMMON + 'arch'),
+                      version.get('epoch'), version.get('ver'), version.get('rel'),
+                      requires, provides, files)
+
+
+def iter_filelists(path):
+    '''Iterate over the packages from filelists metadata, yields Package.
+
+    Only 'files' are filled in, 'requires' and 'provides' are empty.
+    '''
+    for elem in iter_packages(path, NS_FILELISTS + 'package'):
+        version = elem.find(NS_FILELISTS + 'version')
+        yield Package(elem.get('name'), elem.get('arch'),
+                      version.get('epoch'), version.get('ver'), version.get('rel'),
+                      [], [], [fl.text for fl in elem.iterfind(NS_FILELISTS + 'file')])
+
+
+def latest_files(paths, regexps, names=None):
+    '''Find the files matching the given regexps in filelists metadata.
+
+    Only the latest version of every package is taken into account. If
+    'names' is given, the other packages are ignored.
+
+    Returns a dict mapping package names to the lists of matching files,
+    one list per regexp.
+    '''
+    latest = {}
+    for path in paths:
+        for pkg in iter_filelists(path):
+            if pkg.arch not in ARCHES or (names is not None and pkg.name not in names):
+                continue
+            old = latest.get(pkg.name)
+            if old is None or evr_cmp(pkg, old) > 0:
+                latest[pkg.name] = pkg._replace(
+                    files=[[fl for fl in pkg.files if regexp.match(fl)]
+                           for regexp in regexps])
+    return dict((name, pkg.files) for (name, pkg) in latest.items())
+
+
+def file_index(paths, regexp, names=None):
+    '''Returns the files matching 'regexp' of the packages from the given
+    filelists metadata files as a dict mapping package names to the lists of
+    the files, see latest_files(). Packages with no matching files are
+    mapped to empty lists.
+    '''
+    return dict((name, files[0])
+                for (name, files) in latest_files(paths, [regexp], names).items())
+
+
+class RepoIndex(object):
+    '''In-memory index of the packages from primary metadata.
+
+    Only the latest version of every package name is kept, packages of
+    other architectures than ARCHES are ignored. Dependencies are resolved
+    by capability names only, versions are not taken into account.
+    '''
+    def __init__(self):
+        self.packages = {}
+        self.providers = None
+        self.required_by = None
+
+    def add(self, pkg):
+        if pkg.arch not in ARCHES:
+            return
+        old = self.packages.get(pkg.name)
+        if old is None or evr_cmp(pkg, old) > 0:
+            self.packages[pkg.name] = pkg
+            self.providers = None
+            self.required_by = None
+
+    def load(self, path):
+        '''Add the packages from the given primary metadata file.'''
+        for pkg in iter_primary(path):
+            self.add(pkg)
+
+    def providers_of(self, capability):
+        '''Returns the set of names of the packages providing the capability.'''
+        if self.providers is None:
+            self.providers = {}
+            for pkg in self.packages.values():
+                for cap in [pkg.name] + pkg.provides + pkg.files:
+                    self.providers.setdefault(cap, set()).add(pkg.name)
+        return self.providers.get(capability, set())
+
+    def resolve(self, capability):
+        '''Returns the name of the package providing the capability or None.
+
+        If several packages provide it, the one named after the capability
+        is preferred, otherwise the first one by name is taken, so that the
+        result is stable.
+        '''
+        names = self.providers_of(capability)
+        if not names:
+            return None
+        if capability in names:
+            return capability
+        return min(names)
+
+    def requires(self, name):
+        '''Returns the set of names of the packages required by the package.'''
+        deps = set()
+        for cap in self.packages[name].requires:
+            provider = self.resolve(cap)
+            if provider and provider != name:
+                deps.add(provider)
+        return deps
+
+    def closure(self, name):
+        '''Returns the set of names of the packages the package requires,
+        directly or indirectly, including the package itself.'''
+        seen = set([name])
+        todo = [name]
+        while todo:
+            for dep in self.requires(todo.pop()):
+                if dep not in seen:
+                    seen.add(dep)
+                    todo.append(dep)
+        return seen
+
+    def dependents(self, names):
+        '''Returns the set of names of the packages that require any of the
+        given packages, directly or indirectly, including those packages.
+
+        Unlike requires(), all the providers of a capability are taken into
+        account here, so that no affected package is missed.
+        '''
+        if self.required_by is None:
+            self.required_by = {}
+            for pkg in self.packages.values():
+                for cap in pkg.requires:
+                    for dep in self.providers_of(cap):
+                        if dep != pkg.name:
+                            self.required_by.setdefault(dep, set()).add(pkg.name)
+        seen = set(names)
+        todo = list(names)
+        while todo:
+            for dep in self.required_by.get(todo.pop(), []):
+                if dep not in seen:
+                    seen.add(dep)
+                    todo.append(dep)
+        return seen
+
+    def dep_hash(self, name):
+        '''Returns a hash of the NEVRAs of all the packages the package
+        requires, directly or indirectly.'''
+        closure = sorted(nevra(self.packages[dep]) for dep in self.closure(name))
+        return hashlib.sha256('\n'.join(closure).encode()).hexdigest()
+
+
+def load_index(metadata):
+    '''Returns RepoIndex of the repositories with the given metadata, which
+    is a list of the dicts returned by fetch_repodata().'''
+    index = RepoIndex()
+    for files in metadata:
+        index.load(files['primary'])
+    return index
@@ -0,0 +1,294 @@
+#!/usr/bin/python3
+
+# Copyright (c) 2017-2021, Virtuozzo International GmbH
+#
+# Our contact details: Virtuozzo International GmbH, Vordergasse 59, 8200
+# Schaffhausen, Switzerland.
+
+# The store of the test results: an SQLite database with a row per checked
+# package and a row per checked command (application or service) of it.
+#
+# The checkers write the records of their results to results/results.jsonl,
+# the launcher loads them here with ingest(). The *.list files are exported
+# from the store with export_lists().
+#
+# The database is in WAL mode, so readers do not block the writers; each
+# thread must use its own connection, see connect().
+#
+# Usage:
+#       python3 resultstore.py [options]
+# prints the results matching the options, e.g. all crashes on VzLinux 8 in
+# the last 30 days:
+#       python3 resultstore.py -t vzlinux-8 -s crashed -d 30
+
+import argparse
+import json
+import os
+import sqlite3
+import sys
+import time
+
+DB_PATH = '/var/lib/vzlinux-autotest/results.db'
+
+# How long (in seconds) to wait for a lock held by another writer.
+BUSY_TIMEOUT = 60
+
+# Statuses of the packages, in the same order as the checkers report them:
+# the names of their *.list files.
+STATUSES = ['failed-to-install', 'failed-to-check', 'crashed', 'failed',
+            'succeeded', 'skipped']
+# The package has been checked but could not be removed afterwards; this is
+# kept in 'failed_to_remove' column rather than in the status.
+FAILED_TO_REMOVE = 'failed-to-remove'
+
+# The expected duration of the check of a package is the median of its last
+# HISTORY_RUNS runs, see durations().
+HISTORY_RUNS = 5
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS packages (
+    id INTEGER PRIMARY KEY,
+    target TEXT NOT NULL,
+    mode TEXT NOT NULL,
+    package TEXT NOT NULL,
+    nevra TEXT,
+    status TEXT NOT NULL,
+    failed_to_remove INTEGER NOT NULL DEFAULT 0,
+    time REAL NOT NULL,
+    duration REAL,
+    log TEXT
+);
+CREATE INDEX IF NOT EXISTS packages_status ON packages (target, status, time);
+CREATE INDEX IF NOT EXISTS packages_package ON packages (target, mode, package);
+
+CREATE TABLE IF NOT EXISTS checks (
+    id INTEGER PRIMARY KEY,
+    package_id INTEGER NOT NULL REFERENCES packages (id),
+    name TEXT,
+    command TEXT NOT NULL,
+    status TEXT NOT NULL,
+    outcome TEXT,
+    exit_code INTEGER,
+    signal INTEGER,
+    time REAL,
+    duration REAL,
+    log_start INTEGER,
+    log_end INTEGER,
+    memory_peak INTEGER,
+    cpu_user REAL,
+    cpu_system REAL
+);
+CREATE INDEX IF NOT EXISTS checks_package ON checks (package_id);
+CREATE INDEX IF NOT EXISTS checks_status ON checks (status, time);
+'''
+
+# Columns added to the tables since the first version of the store, they
+# are added to the older stores by connect(): (table, column, type).
+ADDED_COLUMNS = [
+    ('checks', 'memory_peak', 'INTEGER'),
+    ('checks', 'cpu_user', 'REAL'),
+    ('checks', 'cpu_system', 'REAL'),
+]
+
+
+def connect(path=None):
+    '''Returns a new connection to the store (DB_PATH by default), creating
+    it if needed.'''
+    conn = sqlite3.connect(path or DB_PATH, timeout=BUSY_TIMEOUT)
+    conn.row_factory = sqlite3.Row
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.executescript(SCHEMA)
+    for (table, column, kind) in ADDED_COLUMNS:
+        columns = [row['name'] for row in conn.execute('PRAGMA table_info(%s)' % table)]
+        if column not in columns:
+            try:
+                conn.execute('ALTER TABLE %s ADD COLUMN %s %s' % (table, column, kind))
+            except sqlite3.OperationalError:
+                # Added by another process meanwhile
+                pass
+    return conn
+
+
+def read_records(path):
+    '''Returns the records from the given results.jsonl file as a list of
+    dicts; a truncated last line (e.g. if the checker was killed) is
+    ignored.'''
+    records = []
+    if not os.path.exists(path):
+        return records
+    with open(path, 'r') as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                pass
+    return records
+
+
+def ingest(conn, target, mode, path, logs, nevras=None):
+    '''Load the records of a checker run from results.jsonl into the store.
+
+    'logs' - function returning the path to the log of the given package.
+    'nevras' - dict mapping package names to their NEVRAs, if known.
+
+    The status of a package is the last one reported for it; if the
+    checker has not reported any (e.g. it has been killed), the package is
+    considered 'failed-to-check'. The duration of a package is the one
+    reported by a 'timing' record (the packages installed in one
+    transaction share its time), the time from its first record to its last
+    one otherwise.
+
+    Returns a dict mapping names of the packages to their statuses.
+    '''
+    packages = {}
+    order = []
+    checks = []
+    for record in read_records(path):
+        pkg = record['package']
+        if pkg not in packages:
+            packages[pkg] = {'start': record['time'], 'end': record['time'],
+                             'status': None, 'failed_to_remove': 0}
+            order.append(pkg)
+        info = packages[pkg]
+        if record['type'] == 'check':
+            checks.append(record)
+            continue
+        if record['type'] == 'timing':
+            info['duration'] = record['duration']
+            continue
+        info['end'] = max(info['end'], record['time'])
+        if record['status'] == FAILED_TO_REMOVE:
+            info['failed_to_remove'] = 1
+        elif record['status'] != 'started':
+            info['status'] = record['status']
+
+    statuses = {}
+    with conn:
+        ids = {}
+        for pkg in order:
+            info = packages[pkg]
+            status = info['status'] or 'failed-to-check'
+            cur = conn.execute(
+                'INSERT INTO packages (target, mode, package, nevra, status, '
+                'failed_to_remove, time, duration, log) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (target, mode, pkg, (nevras or {}).get(pkg), status,
+                 info['failed_to_remove'], info['start'],
+                 info.get('duration', info['end'] - info['start']), logs(pkg)))
+            ids[pkg] = cur.lastrowid
+            statuses[pkg] = status
+        conn.executemany(
+            'INSERT INTO checks (package_id, name, command, status, outcome, '
+            'exit_code, signal, time, duration, log_start, log_end, '
+            'memory_peak, cpu_user, cpu_system) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            [(ids[c['package']], c.get('name'), c['command'], c['status'],
+              c.get('outcome'), c.get('exit_code'), c.get('signal'),
+              c.get('time'), c.get('duration'), c.get('log_start'),
+              c.get('log_end'), c.get('memory_peak'), c.get('cpu_user'),
+              c.get('cpu_system')) for c in checks])
+    return statuses
+
+
+def latest(conn, target, mode, pkgs=None):
+    '''Returns the latest results of the packages of the target as a dict
+    mapping names of the packages to their rows (all the packages checked
+    in the mode if 'pkgs' is None).'''
+    rows = conn.execute(
+        'SELECT * FROM packages WHERE id IN (SELECT MAX(id) FROM packages '
+        'WHERE target = ? AND mode = ? GROUP BY package)', (target, mode))
+    results = {}
+    for row in rows:
+        if pkgs is None or row['package'] in pkgs:
+            results[row['package']] = row
+    return results
+
+
+def durations(conn, target, mode, pkgs=None):
+    '''Returns the expected durations of the checks of the packages of the
+    target in the mode (all the packages if 'pkgs' is None) as a dict mapping
+    names of the packages to seconds. The packages never checked before are
+    missing from it.'''
+    history = {}
+    for row in conn.execute('SELECT package, duration FROM packages '
+                            'WHERE target = ? AND mode = ? AND duration IS NOT NULL '
+                            'ORDER BY id DESC', (target, mode)):
+        if pkgs is None or row['package'] in pkgs:
+            runs = history.setdefault(row['package'], [])
+            if len(runs) < HISTORY_RUNS:
+                runs.append(row['duration'])
+    return dict((pkg, sorted(runs)[len(runs) // 2])
+                for (pkg, runs) in history.items())
+
+
+def export_lists(conn, target, mode, pkgs, dest):
+    '''Write the latest results of the packages to the *.list files in
+    'dest' directory, the way the checkers do it.'''
+    results = latest(conn, target, mode, pkgs)
+    lists = dict((status, []) for status in STATUSES + [FAILED_TO_REMOVE])
+    for pkg in pkgs:
+        if pkg in results:
+            lists.setdefault(results[pkg]['status'], []).append(pkg)
+            if results[pkg]['failed_to_remove']:
+                lists[FAILED_TO_REMOVE].append(pkg)
+    for (status, names) in lists.items():
+        path = os.path.join(dest, status + '.list')
+        if os.path.exists(path):
+            os.remove(path)
+        if names:
+            with open(path, 'w') as f:
+                f.write(''.join(pkg + '\n' for pkg in names))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Query the test results")
+    parser.add_argument('--db', action='store', default=DB_PATH,
+                               help='Path to the store (default: %(default)s)')
+    parser.add_argument('-t', '--target', action='store')
+    parser.add_argument('-m', '--mode', action='store', choices=['apps', 'services'])
+    parser.add_argument('-p', '--pkg', action='append',
+                               help='Show only package with given name. This option can be '\
+                                    'specified more than once.')
+    parser.add_argument('-s', '--status', action='append',
+                               help='Show only the packages with given status (e.g. '\
+                                    'crashed). This option can be specified more than once.')
+    parser.add_argument('-d', '--days', action='store', type=float,
+                               help='Show only the results of the last given days')
+    parser.add_argument('-c', '--checks', action='store_true',
+                               help='Show the checked commands of the packages as well')
+    cmdline = parser.parse_args(sys.argv[1:])
+
+    where = []
+    params = []
+    for (column, value) in [('target', cmdline.target), ('mode', cmdline.mode)]:
+        if value:
+            where.append(column + ' = ?')
+            params.append(value)
+    for (column, values) in [('package', cmdline.pkg), ('status', cmdline.status)]:
+        if values:
+            where.append('%s IN (%s)' % (column, ', '.join('?' * len(values))))
+            params += values
+    if cmdline.days:
+        where.append('time >= ?')
+        params.append(time.time() - cmdline.days * 24 * 3600)
+    query = 'SELECT * FROM packages'
+    if where:
+        query += ' WHERE ' + ' AND '.join(where)
+
+    conn = connect(cmdline.db)
+    for row in conn.execute(query + ' ORDER BY time', params):
+        print('%s %s %s %s %s %s' % (
+            time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(row['time'])),
+            row['target'], row['mode'], row['nevra'] or row['package'],
+            row['status'], row['log']))
+        if cmdline.checks:
+            for check in conn.execute('SELECT * FROM checks WHERE package_id = ? '
+                                      'ORDER BY id', (row['id'],)):
+                usage = ''
+                if check['memory_peak'] is not None:
+                    usage += ', %d KiB' % (check['memory_peak'] // 1024)
+                if check['cpu_user'] is not None:
+                    usage += ', %.2f s CPU' % (check['cpu_user'] + (check['cpu_system'] or 0))
+                print('    %s: %s (%s%s)' % (check['status'], check['command'],
+                                             check['outcome'] or '-', usage))
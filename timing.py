@@ -0,0 +1,120 @@
+#!/usr/bin/python3
+
+# Copyright (c) 2017-2021, Virtuozzo International GmbH
+#
+# Our contact details: Virtuozzo International GmbH, Vordergasse 59, 8200
+# Schaffhausen, Switzerland.
+
+# Timing spans of the phases of a test run (chroot initialization, yum
+# transactions, application launches, ...).
+#
+# A span is a dict with 'phase', 'start' and 'duration' (in seconds) plus
+# arbitrary tags: 'target', 'package', 'command', etc. The launcher records
+# its own spans with Recorder.timed() and adds the spans recorded by the
+# checkers (results/spans.jsonl) with Recorder.load(). The spans are
+# exported as JSON lines and summarized per phase in a file for Prometheus
+# node_exporter textfile collector.
+
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# Prefix of the names of the exported metrics
+METRIC_PREFIX = 'vzlinux_autotest_'
+
+
+class Recorder(object):
+    '''Thread-safe collection of timing spans.'''
+    def __init__(self):
+        self.spans = []
+        self.lock = threading.Lock()
+
+    def add(self, span):
+        with self.lock:
+            self.spans.append(span)
+
+    @contextmanager
+    def timed(self, phase, **tags):
+        '''Record the time spent in the enclosed block as a span of the
+        given phase with the given tags.'''
+        start = time.time()
+        try:
+            yield
+        finally:
+            span = {'phase': phase, 'start': start,
+                    'duration': time.time() - start}
+            span.update(tags)
+            self.add(span)
+
+    def load(self, path, **tags):
+        '''Add the spans from the given JSON lines file, with the given tags
+        added to each of them. Truncated lines are ignored.'''
+        if not os.path.exists(path):
+            return
+        with open(path, 'r') as f:
+            for line in f:
+                try:
+                    span = json.loads(line)
+                except ValueError:
+                    continue
+                span.update(tags)
+                self.add(span)
+
+    def write_jsonl(self, path):
+        '''Write the spans to the given file as JSON lines, ordered by
+        their start times.'''
+        with self.lock:
+            spans = sorted(self.spans, key=lambda span: span['start'])
+        write_atomic(path, ''.join(json.dumps(span, sort_keys=True) + '\n'
+                                   for span in spans))
+
+    def write_prometheus(self, path, **labels):
+        '''Write the summary of the spans per phase to the given file in
+        Prometheus text format, with the given labels added.'''
+        with self.lock:
+            spans = list(self.spans)
+        phases = {}
+        for span in spans:
+            stats = phases.setdefault(span['phase'], [0, 0.0, 0.0])
+            stats[0] += 1
+            stats[1] += span['duration']
+            stats[2] = max(stats[2], span['duration'])
+
+        metrics = [
+            ('phase_count', 'Number of the spans of the phase in the last run', 0),
+            ('phase_seconds_total', 'Total time spent in the phase in the last run', 1),
+            ('phase_seconds_max', 'Longest span of the phase in the last run', 2)]
+        lines = []
+        for (name, help_text, field) in metrics:
+            lines.append('# HELP %s%s %s.' % (METRIC_PREFIX, name, help_text))
+            lines.append('# TYPE %s%s gauge' % (METRIC_PREFIX, name))
+            for phase in sorted(phases):
+                lines.append('%s%s{%s} %s' % (METRIC_PREFIX, name,
+                                              format_labels(labels, phase=phase),
+                                              phases[phase][field]))
+        lines.append('# HELP %slast_run_timestamp_seconds End time of the last run.' %
+                     METRIC_PREFIX)
+        lines.append('# TYPE %slast_run_timestamp_seconds gauge' % METRIC_PREFIX)
+        lines.append('%slast_run_timestamp_seconds{%s} %f' %
+                     (METRIC_PREFIX, format_labels(labels), time.time()))
+        write_atomic(path, '\n'.join(lines) + '\n')
+
+
+def format_labels(labels, **more):
+    '''Returns the labels formatted for Prometheus text format.'''
+    labels = dict(labels, **more)
+    return ','.join('%s="%s"' % (name, str(labels[name]).replace('\\', '\\\\')
+                                                       .replace('"', '\\"')
+                                                       .replace('\n', '\\n'))
+                    for name in sorted(labels))
+
+
+def write_atomic(path, data):
+    '''Write the data to the file so that readers never see it partially
+    written.'''
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp, 'w') as f:
+        f.write(data)
+    os.rename(tmp, path)